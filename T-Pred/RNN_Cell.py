@@ -944,4 +944,144 @@ class T_LSTMCell(LayerRNNCell):
         "reuse": self._reuse,
     }
     base_config = super(T_LSTMCell, self).get_config()
-    return dict(list(base_config.items()) + list(config.items()))
\ No newline at end of file
+    return dict(list(base_config.items()) + list(config.items()))
+
+class FusedT_GRUCell(T_GRUCell):
+  """`T_GRUCell` with its kernels fused into three GEMMs per step.
+  The variables are the ones of `T_GRUCell` (same names and shapes), so the
+  checkpoints of either cell load into the other; the fused matrices are
+  concatenated from them once per graph, not per step:
+    x @ [gates_x | time_gate_input | candidate_e_x]    [input_depth, 5 * units]
+    state @ gates_h                                     [units, 2 * units]
+    (r * state) @ [candidate_e_h | candidate_t_h]       [units, 2 * units]
+  The two matmuls with the scalar time are elementwise products.
+  Numerically equivalent to `T_GRUCell` up to float summation order.
+  """
+
+  @tf_utils.shape_type_conversion
+  def build(self, inputs_shape):
+    super(FusedT_GRUCell, self).build(inputs_shape)
+    input_depth = inputs_shape[-1] - 1
+    self._x_kernel = array_ops.concat(
+        [self._gate_kernel[:input_depth], self._time_gate_input_kernel,
+         self._candidate_kernel_e[:input_depth]], 1)
+    self._h_kernel = self._gate_kernel[input_depth:]
+    self._r_kernel = array_ops.concat(
+        [self._candidate_kernel_e[input_depth:], self._candidate_kernel_t[1:]], 1)
+    self._t_kernel = array_ops.concat(
+        [self._time_gate_t_kernel, self._candidate_kernel_t[:1]], 1)
+
+  def call(self, inputs, state):
+    """Gated recurrent unit (GRU) with nunits cells, fused kernels."""
+    n = self._num_units
+    t = inputs[:, -1:]
+    inputs_e = inputs[:, :-1]
+
+    x_parts = math_ops.matmul(inputs_e, self._x_kernel)
+    gate_x, time_gate_x, candidate_e_x = array_ops.split(x_parts, [2 * n, 2 * n, n], axis=1)
+    time_gate_t, candidate_t_t = array_ops.split(t * self._t_kernel, [2 * n, n], axis=1)
+
+    value = math_ops.sigmoid(nn_ops.bias_add(
+        gate_x + math_ops.matmul(state, self._h_kernel), self._gate_bias))
+    r, u = array_ops.split(value=value, num_or_size_splits=2, axis=1)
+
+    value = math_ops.sigmoid(nn_ops.bias_add(
+        time_gate_x + math_ops.sigmoid(time_gate_t), self._time_gate_bias))
+    t1, t2 = array_ops.split(value=value, num_or_size_splits=2, axis=1)
+
+    candidate_e_h, candidate_t_h = array_ops.split(
+        math_ops.matmul(r * state, self._r_kernel), 2, axis=1)
+    candidate_e = nn_ops.bias_add(candidate_e_x + candidate_e_h, self._candidate_bias_e)
+    candidate_t = nn_ops.bias_add(candidate_t_t + candidate_t_h, self._candidate_bias_t)
+
+    c = self._activation(t1 * candidate_e + t2 * candidate_t)
+    new_h = self._activation(u * state + (1 - u) * c)
+    return new_h, new_h
+
+
+class FusedT_LSTMCell(T_LSTMCell):
+  """`T_LSTMCell` with its kernels fused into three GEMMs per step.
+  The variables are the ones of `T_LSTMCell` (same names and shapes), so the
+  checkpoints of either cell load into the other; the fused matrices are
+  concatenated from them once per graph, not per step:
+    x @ [kernel_x | content_e_x | time_gate_input]      [input_depth, 7 * units]
+    m_prev @ [kernel_h | content_e_h]                   [units, 5 * units]
+    c_hua @ o_c                                         [units, units]
+  The matmuls with the scalar time are elementwise products, and the content
+  term shared by c and c_hua is computed once.
+  Numerically equivalent to `T_LSTMCell` up to float summation order.
+  Peepholes are not supported (`T_LSTMCell` has no c_hua for them either).
+  """
+
+  def __init__(self, num_units, use_peepholes=False, **kwargs):
+    if use_peepholes:
+      raise ValueError("FusedT_LSTMCell does not support peepholes")
+    super(FusedT_LSTMCell, self).__init__(num_units, use_peepholes=False, **kwargs)
+
+  @tf_utils.shape_type_conversion
+  def build(self, inputs_shape):
+    super(FusedT_LSTMCell, self).build(inputs_shape)
+    input_depth = inputs_shape[-1] - 1
+    kernel = self._kernel
+    if isinstance(kernel, tf_variables.PartitionedVariable):
+      kernel = kernel.as_tensor()
+    self._x_kernel = array_ops.concat(
+        [kernel[:input_depth], self._content_kernel[:input_depth],
+         self._time_gate_input_kernel], 1)
+    self._m_kernel = array_ops.concat(
+        [kernel[input_depth:], self._content_kernel[input_depth:]], 1)
+    self._fused_bias = array_ops.concat([self._bias, self._content_bias], 0)
+    self._t_kernel = array_ops.concat(
+        [self._time_gate_t1_kernel, self._time_gate_t2_kernel], 1)
+    self._o_t_kernel = self._o_kernel[:1]
+    self._o_c_kernel = self._o_kernel[1:]
+
+  def call(self, inputs, state):
+    """Run one step of T-LSTM with fused kernels, see `T_LSTMCell.call`."""
+    n = self._num_units
+    num_proj = self._num_units if self._num_proj is None else self._num_proj
+    sigmoid = math_ops.sigmoid
+    t = inputs[:, -1:]
+    inputs_e = inputs[:, :-1]
+
+    if self._state_is_tuple:
+      (c_prev, m_prev) = state
+    else:
+      c_prev = array_ops.slice(state, [0, 0], [-1, self._num_units])
+      m_prev = array_ops.slice(state, [0, self._num_units], [-1, num_proj])
+
+    x_parts = math_ops.matmul(inputs_e, self._x_kernel)
+    lstm_x, time_gate_x = array_ops.split(x_parts, [5 * n, 2 * n], axis=1)
+    lstm_matrix = nn_ops.bias_add(
+        lstm_x + math_ops.matmul(m_prev, self._m_kernel), self._fused_bias)
+    # i = input_gate, j = new_input, f = forget_gate, o = output_gate
+    i, j, f, o, content = array_ops.split(
+        value=lstm_matrix, num_or_size_splits=5, axis=1)
+
+    time_gates = nn_ops.bias_add(
+        time_gate_x + sigmoid(t * self._t_kernel), self._time_gate_bias)
+    t1, t2 = array_ops.split(value=sigmoid(time_gates), num_or_size_splits=2, axis=1)
+
+    i_content = i * sigmoid(content)
+    c_hua = (1 - i * t1) * c_prev + t1 * i_content
+    c = (1 - i) * c_prev + t2 * i_content
+
+    if self._cell_clip is not None:
+      # pylint: disable=invalid-unary-operand-type
+      c = clip_ops.clip_by_value(c, -self._cell_clip, self._cell_clip)
+      # pylint: enable=invalid-unary-operand-type
+
+    o_new = sigmoid(o + math_ops.matmul(c_hua, self._o_c_kernel) + t * self._o_t_kernel)
+    m = o_new * self._activation(c_hua)
+
+    if self._num_proj is not None:
+      m = math_ops.matmul(m, self._proj_kernel)
+
+      if self._proj_clip is not None:
+        # pylint: disable=invalid-unary-operand-type
+        m = clip_ops.clip_by_value(m, -self._proj_clip, self._proj_clip)
+        # pylint: enable=invalid-unary-operand-type
+
+    new_state = (LSTMStateTuple(c, m) if self._state_is_tuple else
+                 array_ops.concat([c, m], 1))
+    return m, new_state
@@ -9,6 +9,11 @@ import tensorflow as tf
 import numpy as np
 import utils
 import read_data
+import input_pipeline
+import ranking_metrics
+import prediction_store
+import time_sketch
+import vocab
 import model_config
 import logging
 
@@ -44,7 +49,8 @@ def make_noise(shape):
 
 
 class T_Pred(object):
-    def __init__(self, config, cell_type, event_file, time_file, is_training):
+    def __init__(self, config, cell_type, event_file, time_file, is_training, input_mode='feed', streaming=False,
+                 chunk_size=10000, buffer_size=100000, compact_vocab=False, fused_step=False):
         self.alpha = 1.0
         self.cell_type = cell_type
         self.event_file = event_file
@@ -62,20 +68,56 @@ class T_Pred(object):
         self.keep_prob = config.keep_prob
         self.res_rate = config.res_rate
         self.length = 1 # config.output_length
-        self.vocab_size = 1264466 # config.vocab_size
+        if compact_vocab:
+            # remap the raw item ids by frequency into a dense range with a shared OOV id
+            self.vocab = vocab.load_or_build_vocab(event_file, config.min_count, config.max_vocab_size)
+            self.vocab_size = self.vocab.size
+            encode = self.vocab.encode
+        else:
+            self.vocab = None
+            self.vocab_size = 1264466 # config.vocab_size
+            encode = None
         self.learning_rate = config.learning_rate
         self.lr = config.learning_rate
         self.LAMBDA = config.LAMBDA
         self.gamma = config.gamma
-        self.train_data, self.valid_data, self.test_data = read_data.data_split(
-            event_file, time_file, shuffle=True)
+        self.event_loss = config.event_loss
+        self.num_sampled = config.num_sampled
+        self.sampler = config.sampler
+        if input_mode == 'dataset' and not fused_step:
+            # every sess.run takes a new batch, the three-run generator step would see three batches
+            raise ValueError('--input_mode dataset needs --fused_step, which computes the time and joint '
+                             'gradients before the event update instead of after it')
+        self.fused_step = fused_step
+        self.softmax_head = config.softmax_head
+        self.adaptive_cutoffs = config.adaptive_cutoffs
+        self.adaptive_div = config.adaptive_div
+        self.adaptive_min_proj = config.adaptive_min_proj
+        if self.softmax_head == 'adaptive':
+            utils.check_adaptive_head(self.g_size/self.num_steps, self.adaptive_min_proj)
+        self.gen_select = config.gen_select
+        self.e4t_mode = config.e4t_mode
+        self.e4t_k = config.e4t_k
+        if streaming:
+            # read the trace files chunk by chunk instead of loading them
+            self.train_data, self.valid_data, self.test_data = None, None, None
+            self.plans = read_data.stream_split(
+                event_file, time_file, self.num_steps, self.length, self.batch_size, chunk_size, buffer_size,
+                encode=encode)
+        else:
+            self.train_data, self.valid_data, self.test_data = read_data.data_split(
+                event_file, time_file, shuffle=True)
+            # the windows of each split are cut once and reused by every epoch
+            self.plans = {
+                'train': read_data.BatchPlan(
+                    self.train_data, self.num_steps, self.length, self.batch_size, shuffle=True, encode=encode),
+                'valid': read_data.BatchPlan(
+                    self.valid_data, self.num_steps, self.length, self.batch_size, shuffle=False, encode=encode),
+                'test': read_data.BatchPlan(
+                    self.test_data, self.num_steps, self.length, self.batch_size, shuffle=False, encode=encode)}
         self.embeddings = tf.get_variable(
             "embedding", [self.vocab_size, self.hidden_size], dtype=tf.float32)
-        self.sample_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps + self.length])
-        self.target_t = tf.placeholder(tf.float32, [self.batch_size, self.length])
-        self.inputs_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps])
-        self.targets_e = tf.placeholder(tf.int64, [self.batch_size, self.length])
-        self.input_e = tf.placeholder(tf.int64, [self.batch_size, self.num_steps])
+        input_pipeline.build_inputs(self, input_mode, self.plans)
         self.build()
 
     def encoder_e_t(self, cell_type, inputs, t):
@@ -267,7 +309,15 @@ class T_Pred(object):
                 "G_E.RNN")
             output = tf.reshape(tf.concat(outputs, 1), [-1, self.g_size])
             output = utils.linear('G_E.Subsample', self.g_size, self.g_size/self.num_steps, output)
-            output = utils.linear('G_E.Output', self.g_size/self.num_steps, self.vocab_size, output)
+            self.event_hidden = output
+            if self.softmax_head == 'adaptive':
+                # normalized log-probabilities, a drop-in for the logits
+                output = utils.adaptive_log_probs('G_E.Output', self.g_size/self.num_steps, self.vocab_size, self.adaptive_cutoffs,
+                                                  output, self.adaptive_div, self.adaptive_min_proj)
+            else:
+                # class-major, so a sampled loss (utils.sampled_output_loss) can train the same layer
+                output = utils.linear('G_E.Output', self.g_size/self.num_steps, self.vocab_size, output,
+                                      class_major=True)
             logits = tf.reshape(output, [self.batch_size, self.length, self.vocab_size])
             return logits
 
@@ -291,6 +341,50 @@ class T_Pred(object):
             logits = tf.reshape(output, [self.batch_size, self.length, 1])
             return logits
 
+    def g_time_stacked(self, hidden_r, gen_ids=None):
+        """
+        The n_g time generators of g_time as one decoder with stacked weights
+        :param gen_ids: None to run every generator, [n_g, batch_size, length, 1];
+            or the generator of each example, [batch_size, length, 1] evaluating only that one
+        """
+        with tf.variable_scope('Generator/Time-g'):
+            outputs = utils.build_stacked_decoder(
+                hidden_r,
+                self.num_layers,
+                self.hidden_size,
+                self.n_g,
+                self.length,
+                "G_T.RNN",
+                gen_ids)
+            logits = utils.stacked_linear('G_T.Output', self.n_g, self.hidden_size, 1, outputs, gen_ids)
+            if gen_ids is None:
+                logits.set_shape([self.n_g, self.batch_size, self.length, 1])
+            else:
+                logits.set_shape([self.batch_size, self.length, 1])
+            return logits
+
+    def event_for_time(self, pred_e):
+        """
+        The predicted events as a condition of the time generators, [batch_size, length, g_size/num_steps]
+        mode (e4t_mode):
+        1. dense: a linear layer over the full logits, a vocab_size x g_size/num_steps weight
+        2. topk: the embeddings of the top e4t_k predicted events, weighted by the softmax over their logits
+        3. soft: the embedding table weighted by the softmax over the full logits, no extra vocab-sized weight
+        """
+        if self.e4t_mode == 'dense':
+            return utils.linear('Generator/pred_e4t.Iutput', self.vocab_size, self.g_size/self.num_steps, pred_e)
+        if self.e4t_mode == 'topk':
+            # the sorted top MAX_K of the ranking metrics, only the first e4t_k are needed
+            scores, ids = self.top_k_scores[:, :, :self.e4t_k], self.top_k_ids[:, :, :self.e4t_k]
+            weights = tf.expand_dims(tf.nn.softmax(scores), -1)
+            embedded = tf.reduce_sum(weights * tf.nn.embedding_lookup(self.embeddings, ids), 2)
+        elif self.e4t_mode == 'soft':
+            probs = tf.nn.softmax(tf.reshape(pred_e, [-1, self.vocab_size]))
+            embedded = tf.matmul(probs, self.embeddings)
+        else:
+            raise ValueError('Invalid e4t mode: %s' % self.e4t_mode)
+        return utils.linear('Generator/pred_e4t.Embedding', self.hidden_size, self.g_size/self.num_steps, embedded)
+
     def attention_g_t(self, hidden_re, hidden_rt, num_gen):
         """
         If there are multiple generator for time sequences,
@@ -342,12 +436,20 @@ class T_Pred(object):
         output = utils.conv1d(name + '.2', self.filter_output_dim, self.filter_output_dim, self.filter_size, output)
         return inputs + (self.res_rate * output)
 
+    def unigram_file(self):
+        """The smoothed frequency of every event id, written next to the event file for the unigram sampler"""
+        counts = self.vocab.counts if self.vocab is not None else vocab.count_events(self.event_file)
+        counts = np.concatenate([counts[:self.vocab_size], np.zeros(max(self.vocab_size - len(counts), 0))])
+        path = '%s.unigrams-%s.csv' % (read_data.binary_prefix(self.event_file),
+                                       'compact' if self.vocab is not None else 'raw')
+        return vocab.write_unigram_file(path, counts + 1)
+
     def params_with_name(self, name):
         variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
         return [v for v in variables if name in v.name]
 
     def loss_with_wasserstein(self, pred_e, pred_t, real_e, real_t, input_t, sample_t):
-        if self.cell_type == 'T_LSTMCell':
+        if self.cell_type in ('T_LSTMCell', 'FusedT_LSTMCell'):
             variable_content_e = self.params_with_name('time_gate_t1')
         else:
             variable_content_e = None
@@ -372,13 +474,30 @@ class T_Pred(object):
         # disc_cost += self.LAMBDA * gradient_penalty
 
         # Entropy for event sequence
-        gen_e_cost = tf.contrib.seq2seq.sequence_loss(pred_e, real_e, weights=tf.ones([self.batch_size, self.length]),
-                                                      name="SeqLoss")
+        if self.softmax_head == 'adaptive':
+            # exact, and cheaper than the softmax over the concatenated log-probabilities
+            with tf.variable_scope("Generator/Event-g"):
+                gen_e_cost = utils.adaptive_softmax_loss('G_E.Output', self.g_size/self.num_steps, self.vocab_size,
+                                                         self.adaptive_cutoffs, self.event_hidden, real_e,
+                                                         self.adaptive_div, self.adaptive_min_proj)
+        else:
+            gen_e_cost = tf.contrib.seq2seq.sequence_loss(pred_e, real_e,
+                                                          weights=tf.ones([self.batch_size, self.length]),
+                                                          name="SeqLoss")
+        if self.softmax_head == 'adaptive' or self.event_loss == 'full':
+            train_e_cost = gen_e_cost
+        else:
+            # train on a sampled estimate of the entropy, gen_e_cost keeps the full softmax for evaluation
+            with tf.variable_scope("Generator/Event-g"):
+                train_e_cost = utils.sampled_output_loss(
+                    'G_E.Output', self.event_hidden, real_e, self.vocab_size, self.num_sampled, self.event_loss,
+                    self.sampler, self.unigram_file() if self.sampler == 'unigram' else None)
         # huber loss for time sequence
         huber_t_loss = tf.losses.huber_loss(real_t, tf.exp(pred_t))
 
         gen_t_cost = gen_t_cost_1 + self.gamma * huber_t_loss
         gen_cost = gen_t_cost + self.alpha * gen_e_cost
+        train_cost = gen_t_cost + self.alpha * train_e_cost
 
         '''if the output of Discriminator is bi-classification, the losses used to train G and D is as follows'''
         # d_label_G = tf.one_hot(tf.ones([self.batch_size], dtype=tf.int32), 2)
@@ -404,13 +523,16 @@ class T_Pred(object):
         # disc_train_op = tf.train.AdamOptimizer(learning_rate=1e-4, beta1=0.5, beta2=0.9).minimize(disc_cost, var_list=disc_params)
 
         '''Use the RMSProp Optimizer to update the variables if we use basic wasserstein distance'''
-        gen_event_op = tf.train.RMSPropOptimizer(learning_rate=self.learning_rate).minimize(gen_e_cost,
-                                                                                            var_list=gen_event_params)
-        gen_time_op = tf.train.RMSPropOptimizer(learning_rate=self.learning_rate).minimize(huber_t_loss,
-                                                                                           var_list=gen_time_params)
-        gen_train_op = tf.train.RMSPropOptimizer(learning_rate=self.learning_rate).minimize(gen_cost,
-                                                                                            var_list=gen_params)
-        disc_train_op = tf.train.RMSPropOptimizer(learning_rate=self.learning_rate).minimize(disc_cost, var_list=disc_params)
+        # the gradients are kept so that the fused steps can apply them with the same optimizers (and slots)
+        self.optimizers = {}
+        for name, cost, var_list in [('g_e', train_e_cost, gen_event_params), ('g_t', huber_t_loss, gen_time_params),
+                                     ('g', train_cost, gen_params), ('d', disc_cost, disc_params)]:
+            optimizer = tf.train.RMSPropOptimizer(learning_rate=self.learning_rate)
+            self.optimizers[name] = optimizer, optimizer.compute_gradients(cost, var_list=var_list)
+        gen_event_op = self.optimizers['g_e'][0].apply_gradients(self.optimizers['g_e'][1])
+        gen_time_op = self.optimizers['g_t'][0].apply_gradients(self.optimizers['g_t'][1])
+        gen_train_op = self.optimizers['g'][0].apply_gradients(self.optimizers['g'][1])
+        disc_train_op = self.optimizers['d'][0].apply_gradients(self.optimizers['d'][1])
 
 
         # constraint the weight of t for t1 to be negative
@@ -431,8 +553,27 @@ class T_Pred(object):
         else:
             w_clip_op = None
 
+        # clip only once the update has been applied, the clip op alone would race with it in a shared sess.run
+        with tf.control_dependencies([disc_train_op]):
+            self.d_step_op = tf.group(*[tf.assign(v, tf.clip_by_value(v.read_value(), -0.1, 0.1))
+                                        for v in variable_content_w])
+
         return gen_train_op, disc_train_op, w_clip_op, gen_cost, disc_cost, gen_t_cost, gen_e_cost,\
-               gen_t_cost_1, huber_t_loss, gen_event_op, gen_time_op
+               gen_t_cost_1, huber_t_loss, gen_event_op, gen_time_op, train_cost, train_e_cost
+
+    def build_fused_step(self, fetches):
+        """
+        The generator step of train as one op: the gradients of the event, time and joint updates
+        come from one forward pass and are applied in that order, after the fetches are computed.
+        Unlike three sess.run calls, the time and joint gradients do not see the earlier updates of the step.
+        """
+        grads = [g for name in ('g_e', 'g_t', 'g') for g, _ in self.optimizers[name][1] if g is not None]
+        step_op = tf.group(*[g.op for g in grads] + [f.op for f in fetches])
+        for name in ('g_e', 'g_t', 'g'):
+            with tf.control_dependencies([step_op]):
+                optimizer, grads_and_vars = self.optimizers[name]
+                step_op = optimizer.apply_gradients(grads_and_vars)
+        return step_op
 
     def build(self):
         """
@@ -440,6 +581,10 @@ class T_Pred(object):
         define the loss function
         define the optimization method
         """
+        # the loss weights are re-estimated on the validation set after every epoch
+        self.alpha, self.alpha_value, self.alpha_assign = utils.loss_weight('alpha', self.alpha)
+        self.gamma, self.gamma_value, self.gamma_assign = utils.loss_weight('gamma', self.gamma)
+
         self.targets_t = tf.expand_dims(self.target_t, 2)
         self.inputs_e = tf.nn.embedding_lookup(self.embeddings, self.input_e)
 
@@ -463,7 +608,9 @@ class T_Pred(object):
         # use the extracted feature from input events and timestamps to generate the time sequence
 
         # take the prediction of events as input information for t_generators
-        pred_e4t = utils.linear('Generator/pred_e4t.Iutput', self.vocab_size, self.g_size/self.num_steps, self.pred_e)
+        # the top ids feed the ranking metrics and, with e4t_mode topk, the time generators
+        self.top_k_scores, self.top_k_ids = tf.nn.top_k(self.pred_e, ranking_metrics.MAX_K, name='top_k')
+        pred_e4t = self.event_for_time(self.pred_e)
         output_rt = tf.concat([tf.reshape(output_rt, [self.batch_size, -1]),
                                tf.reshape(pred_e4t, [self.batch_size, -1])], -1)
 
@@ -474,29 +621,20 @@ class T_Pred(object):
         # self.pred_t = pred_t = self.g_time(make_noise(hidden_r.get_shape()))
 
         else:
-            self.pred_t_list = []
-            for i in range(self.n_g):
-                pred_t = self.g_time(tf.reshape(output_rt, [self.batch_size, -1]), name=str(i))
-                pred_t = tf.expand_dims(pred_t, 1)
-                self.pred_t_list.append(pred_t)
-            # self.pred_t = self.g_time(output_rt)
-            # use random noise to generate the time sequence
-            # self.pred_t = pred_t = self.g_time(make_noise(hidden_r.get_shape()))
-            # the shape of pred_t_list: [batch_size, num_gen, predicted value]
-            self.pred_t_list = tf.concat(self.pred_t_list, 1)
-
             '''The attention module for select the pred_t from all t-generators'''
             attention_gt = self.attention_g_t(output_re, output_rt, self.n_g)
-            k = tf.argmax(attention_gt, 1)
-            # print(k.get_shape())
-            pred_t = []
-            for i in range(self.batch_size):
-                pred_t_e = self.pred_t_list[i][k[i]]
-                pred_t.append(tf.expand_dims(pred_t_e, 0))
-            self.pred_t = tf.concat(pred_t, 0)
+            k = tf.argmax(attention_gt, 1, output_type=tf.int32)
+            output_rt = tf.reshape(output_rt, [self.batch_size, -1])
+            if self.gen_select == 'argmax':
+                # the selection is an argmax, the other generators get no gradient either way
+                self.pred_t = self.g_time_stacked(output_rt, k)
+            else:
+                # the shape of pred_t_list: [batch_size, num_gen, length, 1]
+                self.pred_t_list = tf.transpose(self.g_time_stacked(output_rt), [1, 0, 2, 3])
+                self.pred_t = tf.gather_nd(self.pred_t_list, tf.stack([tf.range(self.batch_size), k], 1))
 
         gen_train_op, disc_train_op, w_clip_op, gen_cost, disc_cost, gen_t_cost, gen_e_cost, gen_t_cost_1, huber_t_loss,\
-        g_e_op, g_t_op = self.loss_with_wasserstein(
+        g_e_op, g_t_op, train_cost, train_e_cost = self.loss_with_wasserstein(
             self.pred_e,
             self.pred_t,
             self.targets_e,
@@ -516,29 +654,26 @@ class T_Pred(object):
         self.gen_t_cost_1 = gen_t_cost_1
         self.huber_t_loss = huber_t_loss
         self.g_e_op = g_e_op
+        # equal to g_cost and gen_e_cost unless the event loss is sampled
+        self.g_train_cost = train_cost
+        self.gen_e_train_cost = train_e_cost
 
         logging.info('pred_e shape {}'.format(self.pred_e.get_shape()))
         logging.info('targets_e shape {}'.format(self.targets_e.get_shape()))
-        Metric_k = 10
-        logging.info('Metric Base {}'.format(Metric_k))
+        self.metric_k = 10
+        logging.info('Metric Base {}'.format(self.metric_k))
         logging.info('Num of Generators {}'.format(self.n_g))
-        # MRR@k
-        self.batch_precision, self.batch_precision_op = tf.metrics.average_precision_at_k(
-            labels=self.targets_e, predictions=self.pred_e, k=Metric_k, name='precision_k')
-        # Isolate the variables stored behind the scenes by the metric operation
-        self.running_precision_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="precision_k")
-        # Define initializer to initialize/reset running variables
-        self.running_precision_vars_initializer = tf.variables_initializer(var_list=self.running_precision_vars)
-
-        # Recall@k
-        self.batch_recall, self.batch_recall_op = tf.metrics.recall_at_k(
-            labels=self.targets_e, predictions=self.pred_e, k=Metric_k, name='recall_k')
-        # Isolate the variables stored behind the scenes by the metric operation
-        self.running_recall_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="recall_k")
-        # Define initializer to initialize/reset running variables
-        self.running_recall_vars_initializer = tf.variables_initializer(var_list=self.running_recall_vars)
+        # the rank of each target among the top ids, accumulated into MRR/Recall/Precision/NDCG@k on the host
+        self.target_ranks = ranking_metrics.target_ranks_op(self.top_k_ids, self.targets_e)
 
         self.deviation = tf.math.reduce_mean(tf.math.abs(tf.exp(self.pred_t) - self.targets_t))
+
+        # eval fetches top_k_ids and the exp'd times instead of the full [batch_size, length, vocab_size] logits
+        self.pred_t_exp = tf.exp(self.pred_t)
+
+        self.g_step_fetches = [self.target_ranks, self.deviation, self.d_cost, self.g_train_cost,
+                               self.gen_e_train_cost, self.gen_t_cost, self.huber_t_loss]
+        self.fused_g_step_op = self.build_fused_step(self.g_step_fetches) if self.fused_step else None
         self.saver = tf.train.Saver(max_to_keep=None)
 
     def train(self, sess, args):
@@ -552,42 +687,33 @@ class T_Pred(object):
             os.makedirs('%s/logs' % self.logdir)
 
         if args.weights is not None:
-            self.saver.restore(sess, args.weights)
+            utils.restore_checkpoint(sess, args.weights)
 
         self.lr = self.learning_rate
 
         for epoch in range(args.iters):
             '''training'''
 
-            sess.run([self.running_precision_vars_initializer, self.running_recall_vars_initializer])
-            # re initialize the metric variables of metric.precision and metric.recall,
-            # to calculate these metric for each epoch
-            batch_precision, batch_recall = 0.0, 0.0
+            metrics = ranking_metrics.RankingMetrics()
             average_deviation, sum_deviation = 0.0, 0.0
             d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss = 0.0, 0.0, 0.0, 0.0, 0.0
 
-            i_e, t_e, i_t, t_t = read_data.data_iterator(self.train_data, self.num_steps, self.length)
-
-            sample_t = read_data.generate_sample_t(self.batch_size, i_t, t_t)
-
             i = 0
             gap = 6
             sum_iter = 0.0
-            batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+            batch_num = len(self.plans['train'])
             logging.info('Training batch num {}'.format(batch_num))
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'train'):
 
                 if i % gap == 0:
 
-                    _, _ = sess.run([self.d_train_op, self.w_clip_op], feed_dict=feed_dict)
+                    _ = sess.run(self.d_step_op, feed_dict=feed_dict)
+
+                elif self.fused_step:
+                    # event, time and joint updates in one round trip
+                    _, target_ranks, deviation, d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss = sess.run(
+                        [self.fused_g_step_op] + self.g_step_fetches, feed_dict=feed_dict)
 
                 else:
                     # train event cross-entropy
@@ -595,11 +721,11 @@ class T_Pred(object):
                     # train time huber-loss
                     _ = sess.run(self.g_t_train_op, feed_dict=feed_dict)
                     # jointly update
-                    _, _, _, deviation, batch_precision, batch_recall, d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss = sess.run(
-                        [self.g_train_op, self.batch_precision_op, self.batch_recall_op,
-                         self.deviation, self.batch_precision, self.batch_recall,
-                         self.d_cost, self.g_cost, self.gen_e_cost, self.gen_t_cost, self.huber_t_loss], feed_dict=feed_dict)
+                    _, target_ranks, deviation, d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss = sess.run(
+                        [self.g_train_op] + self.g_step_fetches, feed_dict=feed_dict)
 
+                if i % gap != 0:
+                    metrics.update_ranks(target_ranks)
                     sum_iter = sum_iter + 1.0
                     sum_deviation = sum_deviation + deviation
                     average_deviation = sum_deviation / sum_iter
@@ -608,71 +734,61 @@ class T_Pred(object):
                 #     sess.run(self.clip_op)
 
                 if i % (batch_num // 10) == 0:
-                    logging.info('[epoch: {}, {}] precision: {}, recall: {}, deviation: {}'.format(
+                    logging.info('[epoch: {}, {}] MRR@{}: {}, recall: {}, deviation: {}'.format(
                         epoch,
                         float(i) / (batch_num // 10),
-                        batch_precision,
-                        batch_recall,
+                        self.metric_k,
+                        metrics['MRR@%d' % self.metric_k],
+                        metrics['Recall@%d' % self.metric_k],
                         average_deviation))
                     logging.info('d_loss: {}, g_loss: {}, gen_e_loss: {}, gen_t_loss: {}, hunber_t_loss: {}'.format(
                         d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss))
                 i += 1
 
-            '''evaluation'''
-            sess.run([self.running_precision_vars_initializer, self.running_recall_vars_initializer])
-            # re initialize the metric variables of metric.precision and metric.recall,
-            # to calculate these metric for each epoch
-
-            i_e, t_e, i_t, t_t = read_data.data_iterator(
-                self.valid_data,
-                self.num_steps,
-                self.length)
+            logging.info('[epoch: {}] train {}'.format(epoch, metrics.summary()))
 
-            sample_t = read_data.generate_sample_t(
-                self.batch_size,
-                i_t,
-                t_t)
+            '''evaluation'''
+            metrics = ranking_metrics.RankingMetrics()
 
             sum_iter = 0.0
             i = 0
             gen_cost_ratio = []
             t_cost_ratio = []
-            batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+            batch_num = len(self.plans['valid'])
             logging.info('Evaluation Batch Num {}'.format(batch_num))
 
             self.lr = self.learning_rate
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
-
-                _, _, deviation, batch_precision, batch_recall, d_loss, g_loss, gen_e_cost, gen_t_cost, gen_t_cost_1, huber_t_loss = sess.run(
-                    [self.batch_precision_op, self.batch_recall_op, self.deviation, self.batch_precision, self.batch_recall,
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'valid'):
+                target_ranks, deviation, d_loss, g_loss, gen_e_cost, gen_t_cost, gen_t_cost_1, huber_t_loss = sess.run(
+                    [self.target_ranks, self.deviation,
                      self.d_cost, self.g_cost, self.gen_e_cost, self.gen_t_cost, self.gen_t_cost_1, self.huber_t_loss],
                     feed_dict=feed_dict)
 
+                metrics.update_ranks(target_ranks)
                 sum_iter = sum_iter + 1.0
                 sum_deviation = sum_deviation + deviation
                 gen_cost_ratio.append(gen_t_cost / gen_e_cost)
                 t_cost_ratio.append(gen_t_cost_1 / huber_t_loss)
 
                 if i % (batch_num // 10) == 0:
-                    logging.info('{}, precision {}, recall {}, deviation {}, d_loss {}, g_loss {}, huber_t_loss {}'.format(
+                    logging.info('{}, MRR@{} {}, recall {}, deviation {}, d_loss {}, g_loss {}, huber_t_loss {}'.format(
                         float(i) / (batch_num// 10),
-                        batch_precision,
-                        batch_recall,
+                        self.metric_k,
+                        metrics['MRR@%d' % self.metric_k],
+                        metrics['Recall@%d' % self.metric_k],
                         sum_deviation / sum_iter,
                         d_loss,
                         g_loss,
                         huber_t_loss))
                 i += 1
-            self.alpha = tf.reduce_mean(gen_cost_ratio)
-            self.gamma = tf.reduce_mean(t_cost_ratio)
-            logging.info('alpha: {}, gamma: {}'.format(sess.run(self.alpha), sess.run(self.gamma)))
+            logging.info('[epoch: {}] valid {}'.format(epoch, metrics.summary()))
+            alpha, gamma = utils.estimate_loss_weight(gen_cost_ratio), utils.estimate_loss_weight(t_cost_ratio)
+            if alpha is not None:
+                sess.run(self.alpha_assign, feed_dict={self.alpha_value: alpha})
+            if gamma is not None:
+                sess.run(self.gamma_assign, feed_dict={self.gamma_value: gamma})
+            logging.info('alpha: {}, gamma: {}'.format(*sess.run([self.alpha, self.gamma])))
 
         self.save_model(sess, self.logdir, args.iters)
 
@@ -684,58 +800,62 @@ class T_Pred(object):
             self.test_data = read_data.load_test_dataset(self.dataset_file)
 
         if args.weights is not None:
-            self.saver.restore(sess, args.weights)
+            utils.restore_checkpoint(sess, args.weights)
             print_in_file("Saved")
 
         lr = self.learning_rate
 
-        batch_size = 100
-
-        input_event_data, target_event_data, input_time_data, target_time_data = read_data.data_iterator(
-            self.test_data,
-            self.num_steps,
-            self.length)
+        write_text = args.output_format in ('text', 'both')
+        write_binary = args.output_format in ('binary', 'both')
+        if write_text:
+            f = open(os.path.join(args.logdir, "output.txt"), 'w+')
+        if write_binary:
+            # written by a background thread, read back with prediction_store.PredictionReader
+            store = prediction_store.PredictionWriter(
+                os.path.join(args.logdir, 'output', 'predictions'),
+                raw_ids=self.vocab.raw_ids if self.vocab is not None else None)
 
-        sample_t = read_data.generate_sample_t(
-            batch_size,
-            input_time_data,
-            target_time_data)
+        # constant-memory distributions of the predicted and target times
+        sketches = time_sketch.TimeSketches()
 
-        f = open(os.path.join(args.logdir, "output.txt"), 'w+')
-        # batch_num = len(list(read_data.generate_batch))
+        for feed_dict in input_pipeline.feed_batches(sess, self, 'test'):
 
-        for e_x, e_y, t_x, t_y in read_data.generate_batch(
-                self.batch_size,
-                input_event_data,
-                target_event_data,
-                input_time_data,
-                target_time_data):
-
-            feed_dict = {
-                self.input_e: e_x,
-                self.inputs_t: np.maximum(np.log(t_x), 0),
-                # self.target_t : t_y_list[i],
-                # self.targets_e : e_y_list[i],
-                self.sample_t: np.maximum(np.log(sample_t), 0)}
             # correct_pred, deviation, pred_e, pred_t, d_loss, g_loss, gen_e_cost, gen_t_cost = sess.run(
             # 	[self.correct_pred, self.deviation, self.pred_e, self.pred_t, self.d_cost, self.g_cost,
             # 	self.gen_e_cost, self.gen_t_cost,self.disc_cost_1, self.gradient_penalty],
             # 	feed_dict = feed_dict)
-            pred_e, pred_t, = sess.run([self.pred_e, self.pred_t], feed_dict=feed_dict)
+            top_k_ids, top_k_scores, pred_t, e_y, t_y = sess.run(
+                [self.top_k_ids, self.top_k_scores, self.pred_t_exp, self.targets_e, self.target_t],
+                feed_dict=feed_dict)
 
             # sum_correct_pred = sum_correct_pred + correct_pred
             # sum_iter = sum_iter + 1
             # sum_deviation = sum_deviation + deviation
-            _, pred_e_index = tf.nn.top_k(pred_e, 1, name=None)
-            f.write('pred_e: ' + '\t'.join([str(v) for v in tf.reshape(tf.squeeze(pred_e_index), [-1]).eval()]))
+            sketches.update(pred_t, t_y)
+            if write_binary:
+                store.add(top_k_ids, top_k_scores, e_y, pred_t, t_y)
+            if not write_text:
+                continue
+            pred_e_index = top_k_ids[:, :, 0].flatten()
+            if self.vocab is not None:
+                # write the raw item ids, OOV as -1
+                pred_e_index, e_y = self.vocab.decode(pred_e_index), self.vocab.decode(e_y)
+            f.write('pred_e: ' + '\t'.join([str(v) for v in pred_e_index]))
             f.write('\n')
             f.write('targ_e: ' + '\t'.join([str(v) for v in np.array(e_y).flatten()]))
             f.write('\n')
-            f.write('pred_t: ' + '\t'.join([str(v) for v in tf.exp(pred_t).eval()]))
+            f.write('pred_t: ' + '\t'.join([str(v) for v in pred_t]))
             f.write('\n')
             f.write('targ_t: ' + '\t'.join([str(v) for v in np.array(t_y).flatten()]))
             f.write('\n')
 
+        if write_text:
+            f.close()
+        if write_binary:
+            store.close()
+        sketches.save(os.path.join(args.logdir, 'output', 'time_sketch.npz'))
+        logging.info('Time quantiles\n{}'.format(sketches.report()))
+
         # if i % (iterations // 10) == 0:
         # 	print('%f, precision: %f, deviation: %f' %(
         # 		i // (iterations // 10),
@@ -746,6 +866,8 @@ class T_Pred(object):
         ckpt_file = '%s/model-%d.ckpt' % (logdir, counter)
         logging.info('Checkpoint {}'.format(ckpt_file))
         self.saver.save(sess, ckpt_file)
+        # next to the weights, so export_numpy need not guess how the time generators were conditioned
+        utils.save_checkpoint_meta(ckpt_file, {'e4t_mode': self.e4t_mode, 'e4t_k': self.e4t_k})
 
 
 def get_config(config_mode):
@@ -773,20 +895,46 @@ def main():
     parser.add_argument('--eval_only', default=False, action='store_true')
     parser.add_argument('--logdir', default='log/log_kick', type=str)
     parser.add_argument('--iters', default=50, type=int)
-    parser.add_argument('--cell_type', default='T_GRUCell', type=str)
+    parser.add_argument('--cell_type', default='T_GRUCell', type=str,
+                        help='T_GRUCell, T_LSTMCell, FusedT_GRUCell or FusedT_LSTMCell')
+    parser.add_argument('--input_mode', default='feed', type=str, help='feed or dataset')
+    parser.add_argument('--streaming', default=False, action='store_true')
+    parser.add_argument('--chunk_size', default=10000, type=int, help='traces per chunk in streaming mode')
+    parser.add_argument('--buffer_size', default=100000, type=int, help='windows in the streaming shuffle buffer')
+    parser.add_argument('--compact_vocab', default=False, action='store_true',
+                        help='remap item ids by frequency, see min_count and max_vocab_size in model_config')
+    parser.add_argument('--event_loss', default=None, type=str, help='full, sampled or nce, overrides model_config')
+    parser.add_argument('--e4t_mode', default=None, type=str,
+                        help='dense, topk or soft: event conditioning of the time generators, overrides model_config')
+    parser.add_argument('--gen_select', default=None, type=str,
+                        help='all or argmax: run every time generator or only the selected one, overrides model_config')
+    parser.add_argument('--fused_step', default=False, action='store_true',
+                        help='run the event, time and joint generator updates as one op per batch, '
+                             'required by --input_mode dataset')
+    parser.add_argument('--output_format', default='text', type=str,
+                        help='eval output: text (output.txt), binary (output/predictions) or both')
     args = parser.parse_args()
 
     assert args.logdir[-1] != '/'
 
     model_config = get_config(args.mode)
+    if args.event_loss is not None:
+        model_config.event_loss = args.event_loss
+    if args.gen_select is not None:
+        model_config.gen_select = args.gen_select
+    if args.e4t_mode is not None:
+        model_config.e4t_mode = args.e4t_mode
     is_training = args.is_training
     cell_type = args.cell_type
-    model = T_Pred(model_config, cell_type, event_file, time_file, is_training)
+    model = T_Pred(model_config, cell_type, event_file, time_file, is_training, args.input_mode,
+                   args.streaming, args.chunk_size, args.buffer_size, args.compact_vocab, args.fused_step)
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     with tf.Session(config=config) as sess:
         sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+        # every op is built by now, adding one in the loops raises instead of growing the graph
+        sess.graph.finalize()
         if not args.eval_only:
             model.train(sess, args)
         model.eval(sess, args)
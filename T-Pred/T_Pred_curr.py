@@ -9,6 +9,7 @@ import tensorflow as tf
 import numpy as np
 import utils
 import read_data
+import ranking_metrics
 import model_config
 import logging
 
@@ -518,26 +519,14 @@ class T_Pred(object):
 
         logging.info('pred_e shape {}'.format(self.pred_e.get_shape()))
         logging.info('targets_e shape {}'.format(self.targets_e.get_shape()))
-        Metric_k = 10
-        logging.info('Metric Base {}'.format(Metric_k))
+        self.metric_k = 10
+        logging.info('Metric Base {}'.format(self.metric_k))
         logging.info('Num of Generators {}'.format(self.n_g))
         logging.info('Num steps {}'.format(self.num_steps))
         logging.info('Num length {}'.format(self.length))
-        # MRR@k
-        self.batch_precision, self.batch_precision_op = tf.metrics.average_precision_at_k(
-            labels=self.targets_e, predictions=self.pred_e, k=Metric_k, name='precision_k')
-        # Isolate the variables stored behind the scenes by the metric operation
-        self.running_precision_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="precision_k")
-        # Define initializer to initialize/reset running variables
-        self.running_precision_vars_initializer = tf.variables_initializer(var_list=self.running_precision_vars)
-
-        # Recall@k
-        self.batch_recall, self.batch_recall_op = tf.metrics.recall_at_k(
-            labels=self.targets_e, predictions=self.pred_e, k=Metric_k, name='recall_k')
-        # Isolate the variables stored behind the scenes by the metric operation
-        self.running_recall_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="recall_k")
-        # Define initializer to initialize/reset running variables
-        self.running_recall_vars_initializer = tf.variables_initializer(var_list=self.running_recall_vars)
+        # the rank of each target among the top ids, accumulated into MRR/Recall/Precision/NDCG@k on the host
+        self.top_k_scores, self.top_k_ids = tf.nn.top_k(self.pred_e, ranking_metrics.MAX_K, name='top_k')
+        self.target_ranks = ranking_metrics.target_ranks_op(self.top_k_ids, self.targets_e)
 
         self.deviation = tf.math.reduce_mean(tf.math.abs(tf.exp(self.pred_t) - self.targets_t))
         self.saver = tf.train.Saver(max_to_keep=None)
@@ -560,10 +549,7 @@ class T_Pred(object):
         for epoch in range(args.iters):
             '''training'''
 
-            sess.run([self.running_precision_vars_initializer, self.running_recall_vars_initializer])
-            # re initialize the metric variables of metric.precision and metric.recall,
-            # to calculate these metric for each epoch
-            batch_precision, batch_recall = 0.0, 0.0
+            metrics = ranking_metrics.RankingMetrics()
             average_deviation, sum_deviation = 0.0, 0.0
             d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss = 0.0, 0.0, 0.0, 0.0, 0.0
 
@@ -596,11 +582,11 @@ class T_Pred(object):
                     # train time huber-loss
                     _ = sess.run(self.g_t_train_op, feed_dict=feed_dict)
                     # jointly update
-                    _, _, _, deviation, batch_precision, batch_recall, d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss = sess.run(
-                        [self.g_train_op, self.batch_precision_op, self.batch_recall_op,
-                         self.deviation, self.batch_precision, self.batch_recall,
+                    _, target_ranks, deviation, d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss = sess.run(
+                        [self.g_train_op, self.target_ranks, self.deviation,
                          self.d_cost, self.g_cost, self.gen_e_cost, self.gen_t_cost, self.huber_t_loss], feed_dict=feed_dict)
 
+                    metrics.update_ranks(target_ranks)
                     sum_iter = sum_iter + 1.0
                     sum_deviation = sum_deviation + deviation
                     average_deviation = sum_deviation / sum_iter
@@ -609,20 +595,21 @@ class T_Pred(object):
                 #     sess.run(self.clip_op)
 
                 if i % (batch_num // 10) == 0:
-                    logging.info('[epoch: {}, {}] precision: {}, recall: {}, deviation: {}'.format(
+                    logging.info('[epoch: {}, {}] MRR@{}: {}, recall: {}, deviation: {}'.format(
                         epoch,
                         float(i) / (batch_num // 10),
-                        batch_precision,
-                        batch_recall,
+                        self.metric_k,
+                        metrics['MRR@%d' % self.metric_k],
+                        metrics['Recall@%d' % self.metric_k],
                         average_deviation))
                     logging.info('d_loss: {}, g_loss: {}, gen_e_loss: {}, gen_t_loss: {}, hunber_t_loss: {}'.format(
                         d_loss, g_loss, gen_e_cost, gen_t_cost, huber_t_loss))
                 i += 1
 
+            logging.info('[epoch: {}] train {}'.format(epoch, metrics.summary()))
+
             '''evaluation'''
-            sess.run([self.running_precision_vars_initializer, self.running_recall_vars_initializer])
-            # re initialize the metric variables of metric.precision and metric.recall,
-            # to calculate these metric for each epoch
+            metrics = ranking_metrics.RankingMetrics()
 
             i_e, t_e, i_t, t_t = read_data.data_iterator(
                 self.valid_data,
@@ -651,26 +638,29 @@ class T_Pred(object):
                     self.targets_e: e_y,
                     self.sample_t: np.maximum(np.log(sample_t), 0)}
 
-                _, _, deviation, batch_precision, batch_recall, d_loss, g_loss, gen_e_cost, gen_t_cost, gen_t_cost_1, huber_t_loss = sess.run(
-                    [self.batch_precision_op, self.batch_recall_op, self.deviation, self.batch_precision, self.batch_recall,
+                target_ranks, deviation, d_loss, g_loss, gen_e_cost, gen_t_cost, gen_t_cost_1, huber_t_loss = sess.run(
+                    [self.target_ranks, self.deviation,
                      self.d_cost, self.g_cost, self.gen_e_cost, self.gen_t_cost, self.gen_t_cost_1, self.huber_t_loss],
                     feed_dict=feed_dict)
 
+                metrics.update_ranks(target_ranks)
                 sum_iter = sum_iter + 1.0
                 sum_deviation = sum_deviation + deviation
                 gen_cost_ratio.append(gen_t_cost / gen_e_cost)
                 t_cost_ratio.append(gen_t_cost_1 / huber_t_loss)
 
                 if i % (batch_num // 10) == 0:
-                    logging.info('{}, precision {}, recall {}, deviation {}, d_loss {}, g_loss {}, huber_t_loss {}'.format(
+                    logging.info('{}, MRR@{} {}, recall {}, deviation {}, d_loss {}, g_loss {}, huber_t_loss {}'.format(
                         float(i) / (batch_num// 10),
-                        batch_precision,
-                        batch_recall,
+                        self.metric_k,
+                        metrics['MRR@%d' % self.metric_k],
+                        metrics['Recall@%d' % self.metric_k],
                         sum_deviation / sum_iter,
                         d_loss,
                         g_loss,
                         huber_t_loss))
                 i += 1
+            logging.info('[epoch: {}] valid {}'.format(epoch, metrics.summary()))
             self.alpha = tf.reduce_mean(gen_cost_ratio)
             self.gamma = tf.reduce_mean(t_cost_ratio)
             logging.info('alpha: {}, gamma: {}'.format(sess.run(self.alpha), sess.run(self.gamma)))
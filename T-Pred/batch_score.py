@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import read_data
+import prediction_store
+import ranking_metrics
+import numpy_infer
+
+'''
+Offline scoring of a whole trace file with numpy_infer, sharded across worker processes.
+The traces are split into contiguous shards of about the same number of events by their offsets in
+the memory-mapped binary layout of read_data; every worker loads the (memory-mapped, so shared)
+exported model, scores its shard in batches of --batch_size, the last one partial, and writes its
+own prediction_store. The shard stores are then merged, in trace order, by moving their segments.
+Two modes:
+    next     (default) one row per trace: the next event after its last num_steps events,
+             shorter traces left-padded with zeros; targ_e is 0 and targ_t NaN, there is no target
+    windows  one row per window of read_data.data_iterator, with its targets, like T_Pred.eval
+             but over every window (row order: trace after trace, window after window)
+The times are log-transformed like T_Pred's input, np.maximum(np.log(t), 0), before the model sees them.
+Each worker runs single-threaded BLAS by default (--threads), so the throughput scales with the
+number of workers rather than with the threads of one process; --scaling 1,2,4,8 scores the file with
+each worker count in turn and prints the throughput and the speedup over the first.
+Shard stores left over by an interrupted run are removed before scoring.
+usage: python batch_score.py exported data/events.txt data/times.txt scores --workers 8
+       python batch_score.py exported data/events.txt data/times.txt scores --scaling 1,2,4,8
+'''
+
+
+def shard_bounds(offsets, num_shards):
+    """Trace boundaries [num_shards + 1] splitting the events into contiguous, about equal shards"""
+    offsets = np.asarray(offsets)
+    targets = np.linspace(0, offsets[-1], num_shards + 1)
+    bounds = np.searchsorted(offsets, targets)
+    bounds[0], bounds[-1] = 0, len(offsets) - 1
+    return np.maximum.accumulate(bounds)
+
+
+def next_windows(events, times, begins, ends, num_steps):
+    """The last num_steps events and times before every end, left-padded with zeros at the trace begin"""
+    positions = ends[:, None] - num_steps + np.arange(num_steps)
+    valid = positions >= begins[:, None]
+    positions = np.where(valid, positions, 0)
+    return np.where(valid, events[positions], 0), np.where(valid, times[positions], 0.)
+
+
+def score_shard(task):
+    """Worker: score the traces [first, last) of the binary layout at prefix into the store at output"""
+    prefix, model_path, output, first, last, mode, batch_size = task
+    start = time.time()
+    model = numpy_infer.NumpyT_Pred.load(model_path)
+    encode = None
+    if model.raw_ids is not None:
+        import vocab
+        encode = vocab.Vocabulary(model.raw_ids, np.zeros(len(model.raw_ids))).encode
+
+    events, times, offsets = read_data.load_binary(prefix)
+    begins = np.asarray(offsets[first:last], dtype=np.int64)
+    ends = np.asarray(offsets[first + 1:last + 1], dtype=np.int64)
+    if mode == 'windows':
+        starts = read_data.window_starts(begins, ends - begins, model.num_steps, model.length)
+        num_rows = len(starts)
+    else:
+        num_rows = len(ends)
+
+    store = prediction_store.PredictionWriter(output, raw_ids=model.raw_ids)
+    for batch in range(0, num_rows, batch_size):
+        rows = slice(batch, min(batch + batch_size, num_rows))
+        if mode == 'windows':
+            window = starts[rows, None] + np.arange(model.num_steps + model.length)
+            input_e, targ_e = events[window[:, :model.num_steps]], events[window[:, model.num_steps:]]
+            input_t, targ_t = times[window[:, :model.num_steps]], times[window[:, model.num_steps:]]
+        else:
+            input_e, input_t = next_windows(events, times, begins[rows], ends[rows], model.num_steps)
+            targ_e = np.zeros((len(input_e), model.length), dtype=np.int64)
+            targ_t = np.full((len(input_e), model.length), np.nan, dtype=np.float32)
+        if encode is not None:
+            input_e, targ_e = encode(input_e), encode(targ_e)
+        with np.errstate(divide='ignore'):
+            input_t = np.maximum(np.log(input_t), 0)
+        pred_e, pred_t, _ = model.predict(input_e, input_t)
+        top_k_ids = ranking_metrics.top_k(pred_e, ranking_metrics.MAX_K)
+        top_k_scores = np.take_along_axis(pred_e.reshape(-1, pred_e.shape[-1]), top_k_ids, axis=1)
+        store.add(top_k_ids, top_k_scores, targ_e, np.exp(pred_t), targ_t)
+    store.close()
+    return num_rows, time.time() - start
+
+
+def export_checkpoint(checkpoint, config_mode, vocab_path=None):
+    """Export a checkpoint once for all the workers, into a temporary directory"""
+    import export_numpy
+    raw_ids = np.load(vocab_path)['raw_ids'] if vocab_path is not None else None
+    weights, meta = export_numpy.export(checkpoint, export_numpy.get_config(config_mode), raw_ids=raw_ids)
+    path = tempfile.mkdtemp(prefix='t_pred_export_')
+    export_numpy.save(path, weights, meta)
+    return path
+
+
+def score(prefix, model_path, output, workers, mode, batch_size):
+    """Score the binary layout at prefix with workers processes into the store at output"""
+    _, _, offsets = read_data.load_binary(prefix)
+    bounds = shard_bounds(offsets, workers)
+    # a crashed run's shards must not be merged in again
+    for stale in glob.glob('%s.shard-*' % output.rstrip('/')):
+        shutil.rmtree(stale)
+    shards = ['%s.shard-%03d' % (output.rstrip('/'), i) for i in range(workers)]
+    tasks = [(prefix, model_path, shards[i], int(bounds[i]), int(bounds[i + 1]), mode, batch_size)
+             for i in range(workers)]
+
+    start = time.time()
+    context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    pool = context.Pool(workers)
+    try:
+        results = pool.map(score_shard, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if os.path.exists(output):
+        prediction_store.clear(output)
+    meta = prediction_store.merge(shards, output)
+    return meta, results, bounds, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str, help='export_numpy.py output or a checkpoint prefix')
+    parser.add_argument('event_file', type=str)
+    parser.add_argument('time_file', type=str)
+    parser.add_argument('output', type=str, help='the merged prediction_store directory')
+    parser.add_argument('--mode', default='next', type=str, help='next or windows')
+    parser.add_argument('--workers', default=multiprocessing.cpu_count(), type=int)
+    parser.add_argument('--threads', default=1, type=int, help='BLAS threads per worker')
+    parser.add_argument('--batch_size', default=512, type=int)
+    parser.add_argument('--config_mode', default='small', type=str, help='model_config of a checkpoint')
+    parser.add_argument('--vocab', default=None, type=str, help='the .vocab.npz of a --compact_vocab checkpoint')
+    parser.add_argument('--scaling', default=None, type=str,
+                        help='comma-separated worker counts: measure the throughput of each instead of --workers')
+    args = parser.parse_args()
+
+    prefix = read_data.binary_prefix(args.event_file)
+    if not read_data.has_binary(prefix, args.event_file, args.time_file):
+        read_data.convert_to_binary(args.event_file, args.time_file, prefix)
+    model_path, exported = args.model, False
+    if not (os.path.isdir(model_path) or model_path.endswith('.npz')):
+        model_path, exported = export_checkpoint(model_path, args.config_mode, args.vocab), True
+
+    # inherited by the spawned workers before they import numpy
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[name] = str(args.threads)
+    try:
+        if args.scaling:
+            base = None
+            print('%d cores' % multiprocessing.cpu_count())
+            for workers in [int(w) for w in args.scaling.split(',')]:
+                meta, _, _, elapsed = score(prefix, model_path, args.output, workers, args.mode, args.batch_size)
+                rate = meta['rows'] / max(elapsed, 1e-9)
+                base = base or rate
+                print('%d workers: %d rows in %.1f s, %.0f rows/s, speedup %.2f, efficiency %.2f' % (
+                    workers, meta['rows'], elapsed, rate, rate / base, rate / base / workers))
+            return
+        meta, results, bounds, elapsed = score(prefix, model_path, args.output, args.workers, args.mode,
+                                               args.batch_size)
+    finally:
+        if exported:
+            shutil.rmtree(model_path)
+
+    for i, (rows, seconds) in enumerate(results):
+        print('shard %d: traces %d-%d, %d rows, %.0f rows/s' % (
+            i, bounds[i], bounds[i + 1], rows, rows / max(seconds, 1e-9)))
+    print('scored %d rows in %.1f s, %.0f rows/s with %d workers' % (
+        meta['rows'], elapsed, meta['rows'] / max(elapsed, 1e-9), args.workers))
+
+
+if __name__ == '__main__':
+    main()
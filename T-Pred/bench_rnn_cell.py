@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+import utils
+
+'''
+CPU microbenchmark of the fused T_GRUCell / T_LSTMCell against the original cells.
+The original encoder is initialized and saved to a checkpoint, which the fused encoder restores,
+so the outputs and gradients are compared on the same weights before timing the forward pass
+and the forward + backward pass.
+usage: python bench_rnn_cell.py --cell T_GRUCell --batch_size 100 --hidden_size 200
+'''
+
+
+def time_run(sess, fetch, feed, iters):
+    sess.run(fetch, feed)  # warm up
+    start = time.time()
+    for _ in range(iters):
+        sess.run(fetch, feed)
+    return (time.time() - start) / iters
+
+
+def build_encoder(cell_type, args):
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs = tf.placeholder(tf.float32, [args.batch_size, args.num_steps, args.hidden_size])
+        t = tf.placeholder(tf.float32, [args.batch_size, args.num_steps])
+        outputs = utils.build_encoder_graph_t(cell_type, inputs, t, args.hidden_size, args.num_layers,
+                                              args.batch_size, args.num_steps, 1., True, 'Encoder')
+        output = tf.concat(outputs, 1)
+        grads = tf.gradients(tf.reduce_sum(output), tf.trainable_variables() + [inputs])
+        saver = tf.train.Saver()
+    return graph, (inputs, t), output, grads, saver
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cell', default='T_GRUCell', type=str, help='T_GRUCell or T_LSTMCell')
+    parser.add_argument('--batch_size', default=100, type=int)
+    parser.add_argument('--hidden_size', default=200, type=int)
+    parser.add_argument('--num_steps', default=20, type=int)
+    parser.add_argument('--num_layers', default=2, type=int)
+    parser.add_argument('--iters', default=50, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='intra/inter op threads, 0 for the TF default')
+    args = parser.parse_args()
+
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            intra_op_parallelism_threads=args.threads,
+                            inter_op_parallelism_threads=args.threads)
+    values = [np.random.randn(args.batch_size, args.num_steps, args.hidden_size),
+              np.abs(np.random.randn(args.batch_size, args.num_steps))]
+    checkpoint = os.path.join(tempfile.mkdtemp(), 'encoder.ckpt')
+
+    results = {}
+    for cell_type in [args.cell, 'Fused' + args.cell]:
+        graph, placeholders, output, grads, saver = build_encoder(cell_type, args)
+        feed = dict(zip(placeholders, values))
+        with tf.Session(graph=graph, config=config) as sess:
+            if cell_type == args.cell:
+                sess.run(tf.variables_initializer(graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)))
+                saver.save(sess, checkpoint)
+            else:
+                # the fused cell reads the checkpoint of the original one
+                saver.restore(sess, checkpoint)
+            results[cell_type] = sess.run([output, grads], feed) + [
+                time_run(sess, output, feed, args.iters), time_run(sess, grads, feed, args.iters)]
+
+    (output_a, grads_a, forward_a, backward_a), (output_b, grads_b, forward_b, backward_b) = \
+        results[args.cell], results['Fused' + args.cell]
+    print('max abs output difference: %g' % np.max(np.abs(output_a - output_b)))
+    print('max abs gradient difference: %g' % max(np.max(np.abs(a - b)) for a, b in zip(grads_a, grads_b)))
+    steps = args.num_steps * args.num_layers
+    for name, time_a, time_b in [('forward', forward_a, forward_b),
+                                 ('forward + backward', backward_a, backward_b)]:
+        print('%s: %s %.1f us/step, Fused%s %.1f us/step, speedup %.2fx' % (
+            name, args.cell, 1e6 * time_a / steps, args.cell, 1e6 * time_b / steps, time_a / time_b))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import argparse
+import numpy as np
+import numpy_infer
+
+'''
+CPU microbenchmark of the event output head of pred_e.py: the dense head against the adaptive one
+(model_config softmax_head), both computing the full normalized distribution over the vocabulary.
+The heads are the NumPy ones of numpy_infer.NumpyT_Pred.event_output on random weights in the
+export_numpy layout, with the cluster and projection widths of utils.adaptive_log_probs, so it runs
+without TensorFlow; the TF graph does the same matmuls.
+usage: python bench_softmax_head.py --vocab_size 1264466 --input_dim 200 --batch_size 16
+'''
+
+
+def adaptive_weights(input_dim, vocab_size, cutoffs, div, min_proj):
+    """Random adaptive head weights, the clusters and projections as in utils.adaptive_clusters / _adaptive_tail"""
+    bounds = [0] + [c for c in cutoffs if 0 < c < vocab_size] + [vocab_size]
+    clusters = list(zip(bounds[:-1], bounds[1:]))
+    head_size = clusters[0][1] + len(clusters) - 1
+    weights = {'g_event.output.head.W': np.random.randn(input_dim, head_size).astype(np.float32) * 0.1,
+               'g_event.output.head.b': np.zeros(head_size, dtype=np.float32)}
+    macs = input_dim * head_size
+    for i, (begin, end) in enumerate(clusters[1:], 1):
+        proj_dim = min(input_dim, max(min_proj, input_dim // (div ** i)))
+        weights['g_event.output.tail%d.proj.W' % i] = np.random.randn(input_dim, proj_dim).astype(np.float32) * 0.1
+        weights['g_event.output.tail%d.W' % i] = np.random.randn(proj_dim, end - begin).astype(np.float32) * 0.1
+        weights['g_event.output.tail%d.b' % i] = np.zeros(end - begin, dtype=np.float32)
+        macs += input_dim * proj_dim + proj_dim * (end - begin)
+    return weights, macs
+
+
+def time_head(head, hidden, iters):
+    head(hidden)  # warm up
+    start = time.time()
+    for _ in range(iters):
+        head(hidden)
+    return (time.time() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab_size', default=1264466, type=int, help='lastfm, the vocabulary of T_Pred.py')
+    parser.add_argument('--input_dim', default=200, type=int, help='g_size, the head input of pred_e.py')
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--cutoffs', default='2000,20000,200000', type=str)
+    parser.add_argument('--div', default=4, type=int)
+    parser.add_argument('--min_proj', default=32, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    args = parser.parse_args()
+
+    hidden = np.random.randn(args.batch_size, args.input_dim).astype(np.float32)
+    dense = {'g_event.output.W': np.random.randn(args.input_dim, args.vocab_size).astype(np.float32) * 0.1,
+             'g_event.output.b': np.zeros(args.vocab_size, dtype=np.float32)}
+    adaptive, adaptive_macs = adaptive_weights(args.input_dim, args.vocab_size,
+                                               [int(c) for c in args.cutoffs.split(',')], args.div, args.min_proj)
+    # the dense logits are normalized too, so both heads return the log-probabilities
+    model = numpy_infer.NumpyT_Pred(dense, {'softmax_head': 'dense'})
+    dense_time = time_head(lambda h: numpy_infer.log_softmax(model.event_output(h)), hidden, args.iters)
+    del model, dense
+    model = numpy_infer.NumpyT_Pred(adaptive, {'softmax_head': 'adaptive'})
+    adaptive_time = time_head(model.event_output, hidden, args.iters)
+
+    dense_macs = args.input_dim * args.vocab_size
+    print('dense: %.1f ms/batch, %.2fM multiply-adds/example' % (1e3 * dense_time, dense_macs / 1e6))
+    print('adaptive: %.1f ms/batch, %.2fM multiply-adds/example' % (1e3 * adaptive_time, adaptive_macs / 1e6))
+    print('speedup %.2fx (%.2fx fewer multiply-adds)' % (dense_time / adaptive_time, dense_macs / adaptive_macs))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 import seaborn as sns
 import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
-import math
 from matplotlib.ticker import FormatStrFormatter
+import numpy as np
+import output_metrics
+import time_sketch
 
 
 font1 = {'family' : 'Times New Roman',
@@ -22,25 +23,28 @@ def plot_realvalue(pred, target):
     return 0
 
 
-def plot_distribution(pred, target):
+def sketch_bins(sketch, rebin=10):
+    """The inner bins of a time_sketch.TimeSketch merged rebin at a time, with their probability"""
+    edges = sketch.edges[::rebin]
+    counts = np.add.reduceat(sketch.counts[1:-1], np.arange(0, len(sketch.counts) - 2, rebin))[:len(edges) - 1]
+    return edges, counts / float(max(sketch.count, 1))
+
+
+def plot_distribution(sketches, rebin=10):
+    """Distributions of the predicted and target times from their sketches, on a log axis"""
     fig, ax = plt.subplots()
     fig.set_size_inches(10,8,forward=True)
-    pred = [float(p) for p in pred]
-    target = [float(t) for t in target]
 
     plt.xlabel('Value of t',fontdict=font1)
     plt.ylabel('Probability', fontdict=font1)
     # plt.title(r'Distribution of Modulator b for Predicting Next Attribute on BPIC12')
-    n, bins, patches1 = ax.hist(pred, bins=10, density=True, label='pred', facecolor='lightseagreen',
-                                edgecolor="grey")
-    sns.kdeplot(pred, shade=True, color='lightseagreen')
-    n, bins, patches2 = ax.hist(target, bins=50, density=True, label='target', facecolor='lightcoral',
-                                edgecolor="black",
-                                alpha=0.75)
-    sns.kdeplot(target, shade=True, color='lightcoral')
-
-    formatter = FuncFormatter(to_percent)
-    plt.gca().yaxis.set_major_formatter(formatter)
+    edges, probability = sketch_bins(sketches['pred_t'], rebin)
+    ax.hist(edges[:-1], bins=edges, weights=probability, label='pred', facecolor='lightseagreen',
+            edgecolor="grey")
+    edges, probability = sketch_bins(sketches['targ_t'], rebin)
+    ax.hist(edges[:-1], bins=edges, weights=probability, label='target', facecolor='lightcoral',
+            edgecolor="black", alpha=0.75)
+    ax.set_xscale('log')
 
     ax.yaxis.set_major_formatter(FormatStrFormatter('%.3f'))
 
@@ -55,47 +59,6 @@ def plot_distribution(pred, target):
     plt.show()
 
 
-def accuracy(pred, target):
-    count = 0.0
-    if len(pred) == len(target):
-        sum = len(pred)
-    else:
-        sum = 0
-        print('length of pred and target for computing accu is not equal!!')
-    for p, t in zip(pred, target):
-        if p == t:
-            count += 1
-        else:
-            pass
-    return count/float(sum)
-
-
-def mae(pred, target):
-    sum = 0.0
-    if len(pred) == len(target):
-        number = len(pred)
-    else:
-        number = 0
-        print('length of pred and target for computing mae is not equal!!')
-        print('length of pred: %d' % (len(pred)))
-        print('length of target: %d' % (len(target)))
-    for p, t in zip(pred, target):
-        ae = math.fabs(float(p) - float(t))
-        if float(t) == 0:
-            t = 0.1
-        # sum = sum + ae / float(t)
-        sum = sum + ae
-    return sum / float(number)
-
-
-def to_percent(y, position):
-    number = str(y).split('.')[0]
-    if len(number) == 1:
-        return '0.0' + str(y).split('.')[0]
-    else:
-        return '0.' + str(y).split('.')[0]
-
-
 # style set
 sns.set_palette('deep', desat=.6)
 sns.set_context(rc={'figure.figsize': (8, 4)})
@@ -103,40 +66,13 @@ sns.set_context(rc={'figure.figsize': (8, 4)})
 # filename = 'output-1011-RECSYS15.txt'
 filename = 'output_t_gru-1013.txt'
 
-with open(filename) as f:
-    lines = f.readlines()
-    pred_t = []
-    mean_abs_error = []
-    for line in lines:
-        if 'pred_e' in line:
-            content = line.replace('\n', '').split(': ')[1].split('\t')
-            pred_e = content
-        elif 'targ_e' in line:
-            content = line.replace('\n', '').split(': ')[1].split('\t')
-            target_e = content
-        elif 'pred_t' in line:
-            content = line.replace('\n', '').split(': ')[1].replace('[', '').replace(']', '').replace(' ', '')
-            pred_t.append(content)
-        elif 'targ_t' in line:
-            content = line.replace('\n', '').split(': ')[1].split('\t')
-            target_t = content
-            print('Accuracy: %f' % (accuracy(pred_e, target_e)))
-            # plot_realvalue(pred_t, target_t)
-            plot_distribution(pred_t, target_t)
-            # print(pred_t)
-            mean_abs_error.append(mae(pred_t, target_t))
-            print('MAE: %f' % (mae(pred_t, target_t)))
-            pred_t = []
-
-
-        else:
-            content = line.split('\t')
-            if len(content) == 1:
-                content = content[0].split(']')[0].replace('[', '').replace(' ', '')
-                pred_t.append(content)
-            else:
-                for c in content:
-                    c = c.split(']')[0].replace('[', '').replace(' ', '')
-                    pred_t.append(c)
-
-    print('Final MAE for all test data: %f' % (math.fsum(mean_abs_error)/float(len(mean_abs_error))))
\ No newline at end of file
+# a saved sketch (output/time_sketch.npz of T_Pred.eval), or an output file summarized in one streaming pass
+if filename.endswith('.npz'):
+    sketches = time_sketch.TimeSketches.load(filename)
+    print(sketches.report())
+else:
+    metrics = output_metrics.evaluate(filename)
+    print(metrics.summary())
+    sketches = metrics.sketches
+# plot_realvalue(pred_t, targ_t)
+plot_distribution(sketches)
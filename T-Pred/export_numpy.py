@@ -0,0 +1,201 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+import model_config
+import utils
+
+'''
+Export the generator weights of a T_Pred checkpoint for numpy_infer.py, which runs without TensorFlow.
+Only the checkpoint is read, no graph is built. The discriminator, the optimizer slots and
+the T_GRU encoder (built but not used by the predictions) are left out.
+Every GRU (the event encoder, the event and time decoders) is stored in the same form:
+    W_x [input_dim, 3 * units]  W_h [units, 3 * units]  b [3 * units], reset | update | candidate
+the time decoders stacked on a leading generator axis.
+output: a directory of .npy files (memory-mapped at load) or a single .npz, plus the meta
+usage: python export_numpy.py log/log_kick.../model-10.ckpt exported --mode small
+'''
+META_KEY = 'meta'
+
+
+class CheckpointWeights(object):
+    def __init__(self, checkpoint):
+        self.reader = tf.train.load_checkpoint(checkpoint)
+        self.names = sorted(name for name in self.reader.get_variable_to_shape_map()
+                            if not re.search(r'/(RMSProp|Adam|Momentum)(_\d+)?$', name))
+
+    def find_all(self, pattern):
+        return [(name, re.search(pattern, name)) for name in self.names if re.search(pattern, name)]
+
+    def find(self, pattern, required=True):
+        found = self.find_all(pattern)
+        if len(found) > 1:
+            raise ValueError('%s matches several variables: %s' % (pattern, [name for name, _ in found]))
+        if not found:
+            if required:
+                raise ValueError('%s matches no variable of the checkpoint' % pattern)
+            return None
+        return self.reader.get_tensor(found[0][0])
+
+    def gru_block_layers(self, prefix):
+        """The GRUBlockCellV2 layers under prefix, converted to (W_x, W_h, b)"""
+        layers = {}
+        for name, match in self.find_all(prefix + r'.*/cell_(\d+)/[^/]+/(gates|candidate)/(kernel|bias)$'):
+            layers.setdefault(int(match.group(1)), {})[match.group(2) + '/' + match.group(3)] = \
+                self.reader.get_tensor(name)
+        return [utils.gru_block_weights(layers[layer]) for layer in sorted(layers)]
+
+
+def export_time_generators(weights, weights_out):
+    """The time decoders and output layers stacked over the generators, whatever form the checkpoint has"""
+    stacked = weights.find_all(r'(^|/)Time-g/G_T\.RNN/Layer(\d+)/W_x$')
+    if stacked:
+        for _, match in stacked:
+            layer = int(match.group(2))
+            for part in ('W_x', 'W_h', 'b'):
+                weights_out['g_time.layer%d.%s' % (layer, part)] = \
+                    weights.find(r'(^|/)Time-g/G_T\.RNN/Layer%d/%s$' % (layer, part))
+        weights_out['g_time.output.W'] = weights.find(r'(^|/)Time-g/G_T\.Output/W$')
+        weights_out['g_time.output.b'] = weights.find(r'(^|/)Time-g/G_T\.Output/b$')
+        return weights_out['g_time.output.W'].shape[0]
+
+    # one GRUBlockCellV2 decoder per generator: Time-g when there is one, Time-g0 ... otherwise
+    generators = sorted(set(match.group(2) for _, match in weights.find_all(r'(^|/)Time-g(\d*)/G_T\.RNN/')),
+                        key=lambda g: int(g) if g else 0)
+    layers = [weights.gru_block_layers(r'(^|/)Time-g%s/G_T\.RNN/' % g) for g in generators]
+    for layer in range(len(layers[0])):
+        for i, part in enumerate(('W_x', 'W_h', 'b')):
+            weights_out['g_time.layer%d.%s' % (layer, part)] = np.stack([g[layer][i] for g in layers])
+    weights_out['g_time.output.W'] = np.stack(
+        [weights.find(r'(^|/)Time-g%s/G_T\.Output/W$' % g) for g in generators])
+    weights_out['g_time.output.b'] = np.stack(
+        [weights.find(r'(^|/)Time-g%s/G_T\.Output/b$' % g) for g in generators])
+    return len(generators)
+
+
+def export(checkpoint, config, n_head=4, mh_size=50, length=1, raw_ids=None):
+    """:return: (weights, meta), weights keyed like 'encoder_e.layer0.W_x'"""
+    weights = CheckpointWeights(checkpoint)
+    out = {'embedding': weights.find(r'^embedding$')}
+
+    for layer, params in enumerate(weights.gru_block_layers(r'(^|/)Encoder_e(?!t)[^/]*/')):
+        for part, value in zip(('W_x', 'W_h', 'b'), params):
+            out['encoder_e.layer%d.%s' % (layer, part)] = value
+
+    conv_names = ['G.T.Input'] + ['G.T.%d.%d' % (block, i) for block in range(1, 6) for i in (1, 2)]
+    for name in conv_names:
+        out['conv.%s.filters' % name] = weights.find(r'(^|/)%s/Filters$' % re.escape(name))
+        out['conv.%s.biases' % name] = weights.find(r'(^|/)%s/Biases$' % re.escape(name))
+
+    # the self-attention Dense layers are plain tf.Variables: DenseLayer, DenseLayer_1, ... in creation
+    # order (q, k, v with biases, then the Q, K, V projections), W first then b within each
+    for branch in ('SA4E', 'SA4T'):
+        for name, match in weights.find_all(r'(^|/)%s/DenseLayer(_(\d+))?/Variable(_(\d+))?$' % branch):
+            dense = int(match.group(3) or 0)
+            out['%s.dense%d.%s' % (branch, dense, 'b' if match.group(4) else 'W')] = weights.reader.get_tensor(name)
+
+    for layer, params in enumerate(weights.gru_block_layers(r'(^|/)Event-g/G_E\.RNN/')):
+        for part, value in zip(('W_x', 'W_h', 'b'), params):
+            out['g_event.layer%d.%s' % (layer, part)] = value
+    out['g_event.subsample.W'] = weights.find(r'(^|/)G_E\.Subsample/W$')
+    out['g_event.subsample.b'] = weights.find(r'(^|/)G_E\.Subsample/b$')
+    head = weights.find(r'(^|/)G_E\.Output\.Head/W$', required=False)
+    if head is None:
+        softmax_head = 'dense'
+        output_w = weights.find(r'(^|/)G_E\.Output/W$', required=False)
+        if output_w is None:
+            # class-major layer of a sampled / nce trained model
+            output_w = weights.find(r'(^|/)G_E\.Output/W_t$').T
+        out['g_event.output.W'] = np.ascontiguousarray(output_w)
+        out['g_event.output.b'] = weights.find(r'(^|/)G_E\.Output/b$')
+    else:
+        softmax_head = 'adaptive'
+        out['g_event.output.head.W'] = head
+        out['g_event.output.head.b'] = weights.find(r'(^|/)G_E\.Output\.Head/b$')
+        for name, match in weights.find_all(r'(^|/)G_E\.Output\.Tail(\d+)\.Proj/W$'):
+            i = int(match.group(2))
+            out['g_event.output.tail%d.proj.W' % i] = weights.reader.get_tensor(name)
+            out['g_event.output.tail%d.W' % i] = weights.find(r'(^|/)G_E\.Output\.Tail%d\.Output/W$' % i)
+            out['g_event.output.tail%d.b' % i] = weights.find(r'(^|/)G_E\.Output\.Tail%d\.Output/b$' % i)
+
+    e4t = weights.find(r'(^|/)pred_e4t\.Iutput/W$', required=False)
+    saved = utils.load_checkpoint_meta(checkpoint)
+    e4t_k = int(saved.get('e4t_k', config.e4t_k))
+    if e4t is not None:
+        e4t_mode = 'dense'
+        out['e4t.W'] = e4t
+        out['e4t.b'] = weights.find(r'(^|/)pred_e4t\.Iutput/b$')
+    else:
+        # topk and soft share the same projection; T_Pred.save_model writes the mode next to the
+        # checkpoint, older checkpoints only have the config to go by
+        e4t_mode = saved.get('e4t_mode', config.e4t_mode)
+        if e4t_mode not in ('topk', 'soft'):
+            raise ValueError('%s has no dense pred_e4t layer but e4t_mode is %s, pass --e4t_mode topk or soft'
+                             % (checkpoint, e4t_mode))
+        out['e4t.W'] = weights.find(r'(^|/)pred_e4t\.Embedding/W$')
+        out['e4t.b'] = weights.find(r'(^|/)pred_e4t\.Embedding/b$')
+
+    n_g = export_time_generators(weights, out)
+    if n_g > 1:
+        out['g_time.attention.W'] = weights.find(r'(^|/)Time/Attention/a_w$')
+        out['g_time.attention.b'] = weights.find(r'(^|/)Time/Attention/a_b$')
+
+    vocab_size, hidden_size = out['embedding'].shape
+    meta = {'num_steps': config.num_steps, 'hidden_size': int(hidden_size), 'g_size': config.g_size,
+            'num_layers': config.num_layers, 'filter_size': config.filter_size, 'res_rate': config.res_rate,
+            'n_head': n_head, 'mh_size': mh_size, 'length': length, 'vocab_size': int(vocab_size), 'n_g': n_g,
+            'e4t_mode': e4t_mode, 'e4t_k': e4t_k, 'softmax_head': softmax_head,
+            'adaptive_cutoffs': list(config.adaptive_cutoffs), 'checkpoint': checkpoint}
+    if raw_ids is not None:
+        out['raw_ids'] = np.asarray(raw_ids, dtype=np.int64)
+    return out, meta
+
+
+def get_config(config_mode):
+    return {'small': model_config.SmallConfig, 'medium': model_config.MediumConfig,
+            'large': model_config.LargeConfig, 'test': model_config.TestConfig}[config_mode]()
+
+
+def save(path, weights, meta):
+    """A directory of .npy files (memory-mapped by numpy_infer), or one .npz when path ends with .npz"""
+    if path.endswith('.npz'):
+        np.savez(path, **dict(weights, **{META_KEY: np.array(json.dumps(meta))}))
+        return
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for key, value in weights.items():
+        np.save(os.path.join(path, key + '.npy'), value)
+    with open(os.path.join(path, META_KEY + '.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str, help='checkpoint prefix, e.g. log/.../model-10.ckpt')
+    parser.add_argument('output', type=str, help='output directory, or a .npz file')
+    parser.add_argument('--mode', default='small', type=str, help='model_config of the checkpoint')
+    parser.add_argument('--e4t_mode', default=None, type=str, help='topk or soft, overrides model_config')
+    parser.add_argument('--n_head', default=4, type=int)
+    parser.add_argument('--mh_size', default=50, type=int)
+    parser.add_argument('--length', default=1, type=int)
+    parser.add_argument('--vocab', default=None, type=str,
+                        help='the .vocab.npz of a --compact_vocab model, to decode the predicted ids')
+    args = parser.parse_args()
+
+    config = get_config(args.mode)
+    if args.e4t_mode is not None:
+        config.e4t_mode = args.e4t_mode
+    raw_ids = np.load(args.vocab)['raw_ids'] if args.vocab is not None else None
+    weights, meta = export(args.checkpoint, config, args.n_head, args.mh_size, args.length, raw_ids)
+    save(args.output, weights, meta)
+    print('exported %d arrays, %.1f MB' % (len(weights), sum(w.nbytes for w in weights.values()) / 2. ** 20))
+
+
+if __name__ == '__main__':
+    main()
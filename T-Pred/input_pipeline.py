@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+'''
+The input of the T-Pred models, in one of two modes:
+feed:    placeholders, filled batch by batch from a read_data.BatchPlan through feed_dict
+dataset: a tf.data pipeline over the same BatchPlan. The windows of a batch are gathered by
+         parallel map workers, the log-time transform runs in the graph and batches are
+         prefetched, so batch assembly overlaps with the train step.
+         The model reads the iterator directly: every sess.run pulls the next batch, so a step
+         has to be one sess.run: T_Pred refuses it without --fused_step.
+'''
+
+
+def log_time(t):
+    """The in-graph form of np.maximum(np.log(t), 0)"""
+    return tf.maximum(tf.log(t), 0.)
+
+
+def make_dataset(plan, num_steps, length, num_parallel_calls=4, prefetch_size=4):
+    """One pass over the plan as (input_e, targets_e, inputs_t, target_t, sample_t) batches."""
+    batch_size = plan.batch_size
+
+    def transform(e_x, e_y, t_x, t_y, sample_t):
+        e_x.set_shape([batch_size, num_steps])
+        e_y.set_shape([batch_size, length])
+        t_x.set_shape([batch_size, num_steps])
+        t_y.set_shape([batch_size, length])
+        return e_x, e_y, log_time(t_x), t_y, log_time(sample_t)
+
+    if not hasattr(plan, 'gather'):
+        # a read_data.StreamPlan assembles its batches while streaming the chunks
+        def generator():
+            sample_t = plan.sample_t().astype(np.float32)
+            for e_x, e_y, t_x, t_y in plan.epoch():
+                yield e_x.astype(np.int64), e_y.astype(np.int64), t_x.astype(np.float32), t_y.astype(np.float32), \
+                    sample_t
+
+        dataset = tf.data.Dataset.from_generator(
+            generator,
+            (tf.int64, tf.int64, tf.float32, tf.float32, tf.float32),
+            (tf.TensorShape([batch_size, num_steps]), tf.TensorShape([batch_size, length]),
+             tf.TensorShape([batch_size, num_steps]), tf.TensorShape([batch_size, length]),
+             tf.TensorShape([batch_size, num_steps + length])))
+        dataset = dataset.map(transform, num_parallel_calls=num_parallel_calls)
+        return dataset.prefetch(prefetch_size)
+
+    def generator():
+        sample_t = plan.sample_t().astype(np.float32)
+        for selected in plan.epoch_indices():
+            yield selected.astype(np.int64), sample_t
+
+    def gather(selected):
+        e_x, e_y, t_x, t_y = plan.gather(selected)
+        return e_x.astype(np.int64), e_y.astype(np.int64), t_x.astype(np.float32), t_y.astype(np.float32)
+
+    def assemble(selected, sample_t):
+        e_x, e_y, t_x, t_y = tf.py_func(
+            gather, [selected], [tf.int64, tf.int64, tf.float32, tf.float32], stateful=False)
+        return transform(e_x, e_y, t_x, t_y, sample_t)
+
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        (tf.int64, tf.float32),
+        (tf.TensorShape([batch_size]), tf.TensorShape([batch_size, num_steps + length])))
+    dataset = dataset.map(assemble, num_parallel_calls=num_parallel_calls)
+    return dataset.prefetch(prefetch_size)
+
+
+class DatasetInput(object):
+    """
+    The batches of the active dataset, straight from its iterator: the ops of one sess.run all
+    see the same batch, the next sess.run gets the next one.
+    """
+
+    def __init__(self, plans, batch_size, num_steps, length, num_parallel_calls=4, prefetch_size=4):
+        self.plans = plans
+        types = (tf.int64, tf.int64, tf.float32, tf.float32, tf.float32)
+        shapes = ([batch_size, num_steps], [batch_size, length], [batch_size, num_steps], [batch_size, length],
+                  [batch_size, num_steps + length])
+
+        with tf.name_scope('Input'):
+            self.iterator = tf.data.Iterator.from_structure(types, tuple(tf.TensorShape(s) for s in shapes))
+            self.initializers = {}
+            for name, plan in plans.items():
+                self.initializers[name] = self.iterator.make_initializer(
+                    make_dataset(plan, num_steps, length, num_parallel_calls, prefetch_size))
+            self.input_e, self.targets_e, self.inputs_t, self.target_t, self.sample_t = self.iterator.get_next()
+
+    def epoch(self, sess, name):
+        """Initialize the dataset of a split; every step of the loop then takes one batch in its sess.run"""
+        sess.run(self.initializers[name])
+        for _ in range(len(self.plans[name])):
+            yield
+
+
+def build_inputs(model, input_mode, plans=None):
+    """Create model.input_e, targets_e, inputs_t, target_t and sample_t for the given input mode."""
+    if input_mode == 'feed':
+        model.dataset_input = None
+        model.sample_t = tf.placeholder(tf.float32, [model.batch_size, model.num_steps + model.length])
+        model.target_t = tf.placeholder(tf.float32, [model.batch_size, model.length])
+        model.inputs_t = tf.placeholder(tf.float32, [model.batch_size, model.num_steps])
+        model.targets_e = tf.placeholder(tf.int64, [model.batch_size, model.length])
+        model.input_e = tf.placeholder(tf.int64, [model.batch_size, model.num_steps])
+    elif input_mode == 'dataset':
+        model.dataset_input = DatasetInput(plans, model.batch_size, model.num_steps, model.length)
+        model.sample_t = model.dataset_input.sample_t
+        model.target_t = model.dataset_input.target_t
+        model.inputs_t = model.dataset_input.inputs_t
+        model.targets_e = model.dataset_input.targets_e
+        model.input_e = model.dataset_input.input_e
+    else:
+        raise ValueError("Invalid input mode: %s" % input_mode)
+
+
+def feed_batches(sess, model, name):
+    """
+    Yield one feed_dict per batch of model.plans[name].
+    In dataset mode the batch comes from the iterator in the step's own sess.run and the feed_dict is None.
+    """
+    if model.dataset_input is not None:
+        for _ in model.dataset_input.epoch(sess, name):
+            yield None
+        return
+
+    plan = model.plans[name]
+    sample_t = np.maximum(np.log(plan.sample_t()), 0)
+    for e_x, e_y, t_x, t_y in plan.epoch():
+        yield {
+            model.input_e: e_x,
+            model.inputs_t: np.maximum(np.log(t_x), 0),
+            model.target_t: t_y,
+            model.targets_e: e_y,
+            model.sample_t: sample_t}
@@ -19,6 +19,18 @@ class SmallConfig(object):
   label_size = 10
   LAMBDA = 10
   gamma = 1000
+  min_count = 1  # rarer items share the OOV id when the vocabulary is compacted
+  max_vocab_size = 0  # keep only the most frequent items, 0 for no limit
+  event_loss = 'full'  # training loss of the event output layer: full, sampled or nce
+  num_sampled = 1000
+  sampler = 'log_uniform'  # log_uniform or unigram
+  softmax_head = 'dense'  # dense or adaptive, adaptive expects frequency-sorted ids (compact vocabulary)
+  adaptive_cutoffs = [2000, 20000, 200000]
+  adaptive_div = 4  # tail cluster i projects the input down by adaptive_div ** i ...
+  adaptive_min_proj = 32  # ... but never below this width (or the input width, if smaller)
+  gen_select = 'all'  # time generators run per example: all (then select) or argmax (only the selected one)
+  e4t_mode = 'dense'  # event conditioning of the time generators: dense, topk or soft (the last two use the embeddings)
+  e4t_k = 10  # predicted events embedded by e4t_mode topk, at most ranking_metrics.MAX_K
 
 
 class MediumConfig(object):
@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import threading
+import traceback
+import numpy as np
+import numpy_infer
+
+'''
+Hot reload of T_Pred.save_model checkpoints into a running predictor.
+A CheckpointWatcher thread polls a directory (T_Pred's --logdir parent: every timestamped logdir
+under it is searched) for the newest model-<iters>.ckpt, loads it into a second
+numpy_infer.NumpyT_Pred next to the serving one and then swaps which one a ModelHolder hands out.
+Callers take holder.current() once per batch, so a batch in flight finishes on the model it
+started with and no request waits for a load.
+A checkpoint is loaded once its .index and .data files have stopped changing for one poll interval,
+so a save in progress is never read half written. It is exported like the serving model: the same
+raw_ids (a compact vocabulary keeps answering in raw ids), e4t_mode, attention and output length.
+One that fails to load, differs from the serving model in any of these, its num_steps, vocab_size or
+softmax_head, or fails a one-row dry predict, is skipped and the serving model kept.
+'''
+CHECKPOINT_INDEX = re.compile(r'^model-(\d+)\.ckpt\.index$')
+
+
+def checkpoint_mtime(prefix, files=None):
+    """Latest mtime of the .index and .data files of a checkpoint, None while it is incomplete"""
+    root, base = os.path.split(prefix)
+    if files is None:
+        files = os.listdir(root or '.')
+    parts = [f for f in files if f == base + '.index' or f.startswith(base + '.data-')]
+    if base + '.index' not in parts or len(parts) < 2:
+        return None
+    try:
+        return max(os.path.getmtime(os.path.join(root, f)) for f in parts)
+    except OSError:  # deleted meanwhile
+        return None
+
+
+def checkpoint_version(prefix, mtime=None):
+    """The ModelHolder version of a checkpoint, changes when it is rewritten"""
+    return '%s@%d' % (prefix, checkpoint_mtime(prefix) if mtime is None else mtime)
+
+
+def find_checkpoints(directory):
+    """[(mtime, prefix)] of the complete model-<iters>.ckpt under directory"""
+    found = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if CHECKPOINT_INDEX.match(name) is None:
+                continue
+            prefix = os.path.join(root, name[:-len('.index')])
+            mtime = checkpoint_mtime(prefix, files)
+            if mtime is not None:
+                found.append((mtime, prefix))
+    return found
+
+
+def latest_checkpoint(directory):
+    found = find_checkpoints(directory)
+    return max(found)[1] if found else None
+
+
+class ModelHolder(object):
+    """The serving model and its version; swap() replaces both at once"""
+
+    def __init__(self, model, version):
+        self.model_version = (model, version)
+        self.swaps = 0
+        self.listeners = []
+
+    def current(self):
+        """:return: (model, version), read together"""
+        return self.model_version
+
+    @property
+    def model(self):
+        return self.model_version[0]
+
+    @property
+    def version(self):
+        return self.model_version[1]
+
+    def swap(self, model, version):
+        self.model_version = (model, version)
+        self.swaps += 1
+        for listener in self.listeners:
+            listener(version)
+
+
+class CheckpointWatcher(object):
+    def __init__(self, holder, directory, config_mode='small', interval=10., load_fn=None):
+        """
+        :param holder: the ModelHolder to swap new models into
+        :param directory: searched recursively for model-<iters>.ckpt
+        :param load_fn: checkpoint prefix -> model, export_like() by default
+        """
+        self.holder = holder
+        self.directory = directory
+        self.config_mode = config_mode
+        self.interval = interval
+        self.load_fn = load_fn or self.export_like
+        self.seen = {}  # prefix -> the mtime it was last seen with
+        self.failed = set()
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+
+    def start(self):
+        self.worker.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.worker.join()
+
+    def export_like(self, prefix):
+        """Export a checkpoint with the settings of the serving model rather than the config defaults"""
+        import export_numpy
+        serving = self.holder.model
+        config = export_numpy.get_config(self.config_mode)
+        config.e4t_mode, config.e4t_k = serving.e4t_mode, serving.e4t_k
+        return numpy_infer.NumpyT_Pred.from_checkpoint(prefix, config, n_head=serving.n_head,
+                                                       mh_size=serving.mh_size, length=serving.length,
+                                                       raw_ids=serving.raw_ids)
+
+    def compatible(self, model):
+        """:return: None if model can replace the serving one, else the reason it cannot"""
+        serving = self.holder.model
+        for name in ('num_steps', 'vocab_size', 'length', 'e4t_mode', 'softmax_head'):
+            if getattr(model, name) != getattr(serving, name):
+                return '%s %s, serving %s' % (name, getattr(model, name), getattr(serving, name))
+        if (model.raw_ids is None) != (serving.raw_ids is None) or \
+                (model.raw_ids is not None and not np.array_equal(model.raw_ids, serving.raw_ids)):
+            return 'another vocabulary'
+        # one row through the whole forward pass, so a bad export fails here and not on requests
+        pred_e, pred_t, _ = model.predict(np.zeros((1, model.num_steps), dtype=np.int64),
+                                          np.zeros((1, model.num_steps), dtype=np.float32))
+        if not (np.all(np.isfinite(pred_e)) and np.all(np.isfinite(pred_t))):
+            return 'non-finite dry run predictions'
+        return None
+
+    def poll(self):
+        """Load and swap in the newest settled checkpoint, if it is new; :return: its prefix or None"""
+        found = find_checkpoints(self.directory)
+        seen, self.seen = self.seen, dict((prefix, mtime) for mtime, prefix in found)
+        if not found:
+            return None
+        # only ever the newest, an older settled one would roll the model back
+        mtime, prefix = max(found)
+        if seen.get(prefix) != mtime:
+            return None
+        version = checkpoint_version(prefix, mtime)
+        if version == self.holder.version or version in self.failed:
+            return None
+        try:
+            model = self.load_fn(prefix)
+            reason = self.compatible(model)
+        except Exception as e:
+            traceback.print_exc()
+            reason = '%s: %s' % (type(e).__name__, e)
+        if reason is not None:
+            print('skipping checkpoint %s: %s' % (prefix, reason))
+            self.failed.add(version)
+            return None
+        self.holder.swap(model, version)
+        print('serving checkpoint %s' % prefix)
+        return prefix
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
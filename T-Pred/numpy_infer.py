@@ -0,0 +1,351 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import ranking_metrics
+
+'''
+TensorFlow-free forward pass of the T_Pred generators, on the weights written by export_numpy.py.
+For a batch of histories (num_steps event ids and times) it reproduces pred_e (the event logits,
+log-probabilities with the adaptive head) and pred_t (the log inter-event time) of T_Pred.build:
+    GRU event encoder + self-attention      -> output_re
+    conv1d res-blocks time encoder + self-attention -> output_rt
+    g_event(output_re) -> pred_e, e4t(pred_e) conditions g_time, attention picks one time generator
+Only the selected time generator of each example is evaluated.
+usage: python numpy_infer.py exported --batch_size 100
+'''
+
+
+def sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.)
+
+
+def softmax(x, axis=-1):
+    e = np.exp(x - x.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def log_softmax(x, axis=-1):
+    shifted = x - x.max(axis=axis, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=axis, keepdims=True))
+
+
+def gru_step(x_proj, state, w_h):
+    """GRUBlockCellV2, x_proj = x W_x + b already computed"""
+    units = state.shape[-1]
+    ru = sigmoid(x_proj[..., :2 * units] + np.matmul(state, w_h[..., :2 * units]))
+    r, u = ru[..., :units], ru[..., units:]
+    c = np.tanh(x_proj[..., 2 * units:] + np.matmul(r * state, w_h[..., 2 * units:]))
+    return u * state + (1. - u) * c
+
+
+def state_bytes(state):
+    return sum(v.nbytes if isinstance(v, np.ndarray) else state_bytes(dict(enumerate(v)))
+               for v in state.values() if isinstance(v, (np.ndarray, list)))
+
+
+def copy_state(state):
+    return dict((name, [x.copy() for x in value] if isinstance(value, list) else
+                 value.copy() if isinstance(value, np.ndarray) else value) for name, value in state.items())
+
+
+def conv1d(inputs, filters, biases):
+    """SAME padded, stride 1: inputs [N, width, in], filters [filter_size, in, out]"""
+    filter_size, width = filters.shape[0], inputs.shape[1]
+    left = (filter_size - 1) // 2
+    padded = np.pad(inputs, ((0, 0), (left, filter_size - 1 - left), (0, 0)), 'constant')
+    output = biases + np.matmul(padded[:, 0:width], filters[0])
+    for k in range(1, filter_size):
+        output += np.matmul(padded[:, k:k + width], filters[k])
+    return output
+
+
+class NumpyT_Pred(object):
+    def __init__(self, weights, meta):
+        """
+        :param weights: the arrays of export_numpy.export, keyed like 'encoder_e.layer0.W_x'
+        :param meta: the hyperparameters of export_numpy.export
+        """
+        self.weights = weights
+        self.meta = meta
+        for name, value in meta.items():
+            setattr(self, name, value)
+        self.raw_ids = self.weights.get('raw_ids')
+        self.padded_state = None
+
+    @classmethod
+    def load(cls, path):
+        """:param path: the export_numpy.py output, a directory (memory-mapped) or a .npz"""
+        if os.path.isdir(path):
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            weights = dict((name[:-len('.npy')], np.load(os.path.join(path, name), mmap_mode='r'))
+                           for name in os.listdir(path) if name.endswith('.npy'))
+        else:
+            data = np.load(path)
+            meta = json.loads(str(data['meta']))
+            weights = dict((name, data[name]) for name in data.files if name != 'meta')
+        return cls(weights, meta)
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, config, **kwargs):
+        """Export in memory; reading the checkpoint needs TensorFlow, the inference does not"""
+        import export_numpy
+        weights, meta = export_numpy.export(checkpoint, config, **kwargs)
+        return cls(weights, meta)
+
+    def w(self, name):
+        return self.weights[name]
+
+    def gru_layers(self, prefix):
+        layers = []
+        while '%s.layer%d.W_x' % (prefix, len(layers)) in self.weights:
+            layers.append(tuple(self.w('%s.layer%d.%s' % (prefix, len(layers), part))
+                                for part in ('W_x', 'W_h', 'b')))
+        return layers
+
+    def gru_encoder(self, inputs):
+        """The multi-layer GRU over the num_steps inputs [N, num_steps, dim], top layer outputs"""
+        outputs = inputs
+        for w_x, w_h, b in self.gru_layers('encoder_e'):
+            x_proj = np.matmul(outputs, w_x) + b
+            state = np.zeros((inputs.shape[0], w_h.shape[0]), dtype=np.float32)
+            steps = []
+            for step in range(inputs.shape[1]):
+                state = gru_step(x_proj[:, step], state, w_h)
+                steps.append(state)
+            outputs = np.stack(steps, 1)
+        return outputs
+
+    def gru_decoder(self, inputs, layers):
+        """build_rnn_graph_decoder1: the same inputs [..., N, dim] at each of the length steps"""
+        x_proj = np.matmul(inputs, layers[0][0]) + np.expand_dims(layers[0][2], -2)
+        states = [np.zeros(inputs.shape[:-1] + (w_h.shape[-2],), dtype=np.float32) for _, w_h, _ in layers]
+        outputs = []
+        for _ in range(self.length):
+            for layer, (w_x, w_h, b) in enumerate(layers):
+                proj = x_proj if layer == 0 else np.matmul(states[layer - 1], w_x) + np.expand_dims(b, -2)
+                states[layer] = gru_step(proj, states[layer], w_h)
+            outputs.append(states[-1])
+        return np.stack(outputs, -2)
+
+    def res_block(self, name, inputs):
+        output = conv1d(np.maximum(inputs, 0), self.w('conv.%s.1.filters' % name), self.w('conv.%s.1.biases' % name))
+        output = conv1d(np.maximum(output, 0), self.w('conv.%s.2.filters' % name), self.w('conv.%s.2.biases' % name))
+        return inputs + self.res_rate * output
+
+    def attention(self, branch, inputs):
+        """encoder_attention: q/k/v dense layers, multi-head scaled dot-product, mean over the steps"""
+        q, k, v = [x.transpose(0, 2, 1, 3) for x in self.attention_rows(branch, inputs)]
+        scores = softmax(np.matmul(q, k.transpose(0, 1, 3, 2)) / np.sqrt(float(self.mh_size)))
+        output = np.matmul(scores, v).transpose(0, 2, 1, 3)
+        return output.reshape(output.shape[0], output.shape[1], -1).mean(axis=1)
+
+    def event_output(self, hidden):
+        if self.softmax_head == 'dense':
+            return np.matmul(hidden, self.w('g_event.output.W')) + self.w('g_event.output.b')
+        # adaptive head: log p(tail item) = log p(its cluster) + log p(item in the cluster)
+        head = log_softmax(np.matmul(hidden, self.w('g_event.output.head.W')) + self.w('g_event.output.head.b'))
+        num_tails = 0
+        while 'g_event.output.tail%d.W' % (num_tails + 1) in self.weights:
+            num_tails += 1
+        head_end = head.shape[-1] - num_tails
+        log_probs = [head[:, :head_end]]
+        for i in range(1, num_tails + 1):
+            proj = np.matmul(hidden, self.w('g_event.output.tail%d.proj.W' % i))
+            tail = log_softmax(np.matmul(proj, self.w('g_event.output.tail%d.W' % i)) +
+                               self.w('g_event.output.tail%d.b' % i))
+            log_probs.append(tail + head[:, head_end + i - 1:head_end + i])
+        return np.concatenate(log_probs, 1)
+
+    def event_for_time(self, pred_e):
+        if self.e4t_mode == 'dense':
+            return np.matmul(pred_e, self.w('e4t.W')) + self.w('e4t.b')
+        if self.e4t_mode == 'topk':
+            flat = pred_e.reshape(-1, pred_e.shape[-1])
+            ids = ranking_metrics.top_k(flat, self.e4t_k)
+            weights = softmax(np.take_along_axis(flat, ids, axis=1))
+            embedded = (weights[:, :, None] * self.w('embedding')[ids]).sum(axis=1)
+        else:
+            embedded = np.matmul(softmax(pred_e.reshape(-1, pred_e.shape[-1])), self.w('embedding'))
+        return np.matmul(embedded, self.w('e4t.W')) + self.w('e4t.b')
+
+    def time_generators(self, output_re, output_rt):
+        """The log-time of the generator picked by the attention, only that generator runs per example"""
+        n = output_rt.shape[0]
+        if self.n_g > 1:
+            logits = np.matmul(np.concatenate([output_re, output_rt], 1), self.w('g_time.attention.W'))
+            gen_ids = np.argmax(logits + self.w('g_time.attention.b'), axis=1)
+        else:
+            gen_ids = np.zeros(n, dtype=np.int64)
+        layers = self.gru_layers('g_time')
+        output_w, output_b = self.w('g_time.output.W'), self.w('g_time.output.b')
+        pred_t = np.zeros((n, self.length, 1), dtype=np.float32)
+        for g in np.unique(gen_ids):
+            rows = np.nonzero(gen_ids == g)[0]
+            outputs = self.gru_decoder(output_rt[rows], [(w_x[g], w_h[g], b[g]) for w_x, w_h, b in layers])
+            pred_t[rows] = np.matmul(outputs, output_w[g]) + output_b[g]
+        return pred_t, gen_ids
+
+    def predict(self, input_e, input_t):
+        """
+        :param input_e: [N, num_steps] event ids, as fed to T_Pred (compacted ids for a compact vocabulary)
+        :param input_t: [N, num_steps] times, as fed to T_Pred
+        :return: pred_e [N, length, vocab_size], pred_t [N, length, 1] and the time generator of each example
+        """
+        hidden_re = self.gru_encoder(self.w('embedding')[np.asarray(input_e)])
+        return self.predict_encoded(hidden_re, input_t)
+
+    def predict_encoded(self, hidden_re, input_t):
+        """predict from the event encoder outputs [N, num_steps, hidden_size]"""
+        return self.predict_heads(self.attention('SA4E', hidden_re), input_t)
+
+    def predict_heads(self, output_re, input_t):
+        """The time branch and the heads, on the attended event representation [N, n_head * mh_size]"""
+        input_t = np.asarray(input_t, dtype=np.float32)
+        n = output_re.shape[0]
+        hidden_rt = conv1d(input_t[:, :, None], self.w('conv.G.T.Input.filters'), self.w('conv.G.T.Input.biases'))
+        for block in range(1, 6):
+            hidden_rt = self.res_block('G.T.%d' % block, hidden_rt)
+        output_rt = self.attention('SA4T', hidden_rt)
+
+        event_layers = self.gru_layers('g_event')
+        hidden = self.gru_decoder(output_re, event_layers).reshape(-1, event_layers[-1][1].shape[0])
+        hidden = np.matmul(hidden, self.w('g_event.subsample.W')) + self.w('g_event.subsample.b')
+        pred_e = self.event_output(hidden).reshape(n, self.length, -1)
+
+        output_rt = np.concatenate([output_rt, self.event_for_time(pred_e).reshape(n, -1)], 1)
+        pred_t, gen_ids = self.time_generators(output_re, output_rt)
+        return pred_e, pred_t, gen_ids
+
+    def attention_rows(self, branch, rows):
+        """The per-head query, key and value [..., n_head, mh_size] of representation rows [..., feature_size]"""
+        def dense(x, i):
+            return np.matmul(x, self.w('%s.dense%d.W' % (branch, i))) + self.w('%s.dense%d.b' % (branch, i))
+
+        q, k, v = [np.matmul(dense(rows, i), self.w('%s.dense%d.W' % (branch, i + 3))) for i in range(3)]
+        return [x.reshape(x.shape[:-1] + (self.n_head, self.mh_size)) for x in (q, k, v)]
+
+    def new_state(self, exact=False):
+        """
+        The state of step(): the recurrent state of the event encoder, the query/key/value rows
+        and the raw scores of its self-attention over the window, and the windows of event ids and times.
+        The window starts as num_steps events of id 0 at log-time 0, the padding of predict_server.window
+        and batch_score.next_windows, so a state that observed nothing predicts like predict() on a
+        window of padding.
+        """
+        if self.padded_state is None:
+            layers = self.gru_layers('encoder_e')
+            shape = (self.num_steps, self.n_head, self.mh_size)
+            state = {'gru': [np.zeros(w_h.shape[0], dtype=np.float32) for _, w_h, _ in layers],
+                     'q': np.zeros(shape, dtype=np.float32), 'k': np.zeros(shape, dtype=np.float32),
+                     'v': np.zeros(shape, dtype=np.float32),
+                     'scores': np.zeros((self.n_head, self.num_steps, self.num_steps), dtype=np.float32),
+                     'events': np.zeros(self.num_steps, dtype=np.int64),
+                     'times': np.zeros(self.num_steps, dtype=np.float32),
+                     'count': 0, 'exact': False}
+            for _ in range(self.num_steps):
+                self.step(state, 0, 0.)
+            state['count'] = 0
+            self.padded_state = state
+        state = copy_state(self.padded_state)
+        state['exact'] = exact
+        return state
+
+    def step(self, state, event, dt):
+        """
+        Advance a session by one event in place:
+        one GRU cell step per layer, one query/key/value row appended to the attention cache and
+        the score matrix shifted with one new row and column, O(window) instead of O(window^2).
+        The recurrent state carries over the whole session, so the encoding summarizes more than the
+        window T_Pred re-encodes from a zero state and the predictions drift from predict() on the same
+        window (session_store.py reports by how much). A new_state(exact=True) state re-encodes its
+        window of event ids from a zero state instead, num_steps GRU steps and a full attention per
+        event, and predicts exactly like predict().
+        The time branch is not cached: its conv stack is SAME padded, 11 convolutions deep over
+        the window, so every position changes when the window slides; it runs in predict_states.
+        """
+        for name, value in (('events', event), ('times', dt)):
+            state[name][:-1] = state[name][1:]
+            state[name][-1] = value
+        state['count'] += 1
+        scale = np.sqrt(float(self.mh_size))
+        if state['exact']:
+            hidden = self.gru_encoder(self.w('embedding')[state['events']][None])[0]
+            state['q'][:], state['k'][:], state['v'][:] = self.attention_rows('SA4E', hidden)
+            state['scores'][:] = np.einsum('ihd,jhd->hij', state['q'], state['k']) / scale
+            return state
+
+        x = self.w('embedding')[event]
+        for layer, (w_x, w_h, b) in enumerate(self.gru_layers('encoder_e')):
+            state['gru'][layer] = x = gru_step(np.matmul(x, w_x) + b, state['gru'][layer], w_h)
+
+        q, k, v = self.attention_rows('SA4E', x)
+        for name, row in (('q', q), ('k', k), ('v', v)):
+            state[name][:-1] = state[name][1:]
+            state[name][-1] = row
+        scores = state['scores']
+        scores[:, :-1, :-1] = scores[:, 1:, 1:]
+        scores[:, -1, :] = np.einsum('hd,jhd->hj', q, state['k']) / scale
+        scores[:, :, -1] = np.einsum('ihd,hd->hi', state['q'], k) / scale
+        return state
+
+    def attended(self, state):
+        """The SA4E output of a state: the mean over the queries of the attention, per head"""
+        weights = softmax(state['scores']).mean(axis=1)
+        return np.einsum('hj,jhd->hd', weights, state['v']).reshape(-1)
+
+    def predict_states(self, states):
+        """predict for a list of step() states in one batch, from their caches"""
+        return self.predict_heads(np.stack([self.attended(s) for s in states]),
+                                  np.stack([s['times'] for s in states]))
+
+    def top_k(self, pred_e, pred_t, k=ranking_metrics.MAX_K):
+        """:return: the top-k ids [N, length, k] (raw ids when exported with a vocabulary) and exp(pred_t)"""
+        ids = ranking_metrics.top_k(pred_e, k).reshape(pred_e.shape[0], pred_e.shape[1], -1)
+        if self.raw_ids is not None:
+            ids = self.raw_ids[ids]
+        return ids, np.exp(pred_t)
+
+    def predict_top_k(self, input_e, input_t, k=ranking_metrics.MAX_K):
+        pred_e, pred_t, _ = self.predict(input_e, input_t)
+        return self.top_k(pred_e, pred_t, k)
+
+
+def load_model(path, config_mode='small'):
+    """An export_numpy.py output, or a checkpoint prefix exported on the fly"""
+    if os.path.isdir(path) or path.endswith('.npz'):
+        return NumpyT_Pred.load(path)
+    import export_numpy
+    return NumpyT_Pred.from_checkpoint(path, export_numpy.get_config(config_mode))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='export_numpy.py output')
+    parser.add_argument('--batch_size', default=100, type=int)
+    parser.add_argument('--batches', default=10, type=int)
+    args = parser.parse_args()
+
+    start = time.time()
+    model = NumpyT_Pred.load(args.path)
+    print('loaded in %.3f s' % (time.time() - start))
+
+    input_e = np.random.randint(0, model.vocab_size, (args.batch_size, model.num_steps))
+    input_t = np.abs(np.random.randn(args.batch_size, model.num_steps)).astype(np.float32)
+    model.predict_top_k(input_e, input_t)  # page in the weights
+    start = time.time()
+    for _ in range(args.batches):
+        model.predict_top_k(input_e, input_t)
+    elapsed = time.time() - start
+    print('%.2f ms per batch of %d, %.0f histories/s' % (
+        1e3 * elapsed / args.batches, args.batch_size, args.batches * args.batch_size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import argparse
+import numpy as np
+import ranking_metrics
+import prediction_store
+import time_sketch
+
+'''
+Accuracy, MAE, RMSE and per-bucket time errors of an evaluation output, streamed in chunks:
+text:   the output.txt of T_Pred.eval, groups of pred_e / targ_e / pred_t / targ_t lines
+        (pred_t is a printed array that may continue over several lines)
+binary: a prediction_store directory, which also gives MRR/Recall/Precision/NDCG@k from the top-k ids
+The quantiles of the predicted and target times come from a time_sketch.TimeSketches, --sketch saves it.
+usage: python output_metrics.py output.txt
+'''
+# target time buckets, in the unit of the traces
+TIME_BUCKETS = (1., 10., 100., 1000., 10000., 100000., 1000000.)
+
+
+def parse_numbers(text, dtype=np.float64):
+    return np.array(text.replace('[', ' ').replace(']', ' ').split(), dtype=dtype)
+
+
+def iter_text_groups(filename):
+    """Yield (pred_e, targ_e, pred_t, targ_t) per group of lines, reading one line at a time"""
+    pred_e, targ_e, pred_t = None, None, []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('pred_e: '):
+                pred_e = line[len('pred_e: '):]
+            elif line.startswith('targ_e: '):
+                targ_e = line[len('targ_e: '):]
+            elif line.startswith('pred_t: '):
+                pred_t = [line[len('pred_t: '):]]
+            elif line.startswith('targ_t: '):
+                yield pred_e, targ_e, ' '.join(pred_t), line[len('targ_t: '):]
+                pred_e, targ_e, pred_t = None, None, []
+            elif pred_t:
+                pred_t.append(line)
+
+
+def iter_text_chunks(filename, chunk_groups=1000):
+    """Parse chunk_groups groups at a time into flat arrays"""
+    groups = []
+
+    def parse(groups):
+        events = [(np.array(p.split(), dtype=np.int64), np.array(t.split(), dtype=np.int64))
+                  for p, t, _, _ in groups if p is not None and t is not None]
+        times = [(parse_numbers(p), parse_numbers(t)) for _, _, p, t in groups]
+        return (np.concatenate([e[0] for e in events]) if events else np.zeros(0, np.int64),
+                np.concatenate([e[1] for e in events]) if events else np.zeros(0, np.int64),
+                np.concatenate([t[0] for t in times]) if times else np.zeros(0),
+                np.concatenate([t[1] for t in times]) if times else np.zeros(0))
+
+    for group in iter_text_groups(filename):
+        groups.append(group)
+        if len(groups) == chunk_groups:
+            yield parse(groups) + (None,)
+            groups = []
+    if groups:
+        yield parse(groups) + (None,)
+
+
+def iter_binary_chunks(path, chunk_rows=1000000):
+    """Slices of the memory-mapped segments, the top-k ids come last"""
+    reader = prediction_store.PredictionReader(path)
+    for segment in reader.iter_segments():
+        for begin in range(0, len(segment['targ_e']), chunk_rows):
+            end = begin + chunk_rows
+            top_ids = np.asarray(segment['pred_ids'][begin:end])
+            yield top_ids[:, 0], np.asarray(segment['targ_e'][begin:end]), \
+                np.asarray(segment['pred_t'][begin:end], dtype=np.float64), \
+                np.asarray(segment['targ_t'][begin:end], dtype=np.float64), top_ids
+
+
+class OutputMetrics(object):
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.edges = np.asarray(buckets, dtype=np.float64)
+        num_buckets = len(self.edges) + 1
+        self.count_e, self.correct = 0, 0
+        self.count_t, self.abs_error, self.square_error = 0, 0., 0.
+        self.bucket_count = np.zeros(num_buckets, dtype=np.int64)
+        self.bucket_abs_error = np.zeros(num_buckets)
+        self.bucket_square_error = np.zeros(num_buckets)
+        self.mismatched = 0
+        self.ranking = None
+        self.sketches = time_sketch.TimeSketches()
+
+    def update_events(self, pred_e, targ_e):
+        if len(pred_e) != len(targ_e):
+            self.mismatched += 1
+            n = min(len(pred_e), len(targ_e))
+            pred_e, targ_e = pred_e[:n], targ_e[:n]
+        self.count_e += len(targ_e)
+        self.correct += int(np.count_nonzero(pred_e == targ_e))
+
+    def update_times(self, pred_t, targ_t):
+        if len(pred_t) != len(targ_t):
+            self.mismatched += 1
+            n = min(len(pred_t), len(targ_t))
+            pred_t, targ_t = pred_t[:n], targ_t[:n]
+        error = np.abs(pred_t - targ_t)
+        self.sketches.update(pred_t, targ_t)
+        self.count_t += len(targ_t)
+        self.abs_error += error.sum()
+        self.square_error += np.square(error).sum()
+        bucket = np.digitize(targ_t, self.edges)
+        num_buckets = len(self.bucket_count)
+        self.bucket_count += np.bincount(bucket, minlength=num_buckets)
+        self.bucket_abs_error += np.bincount(bucket, weights=error, minlength=num_buckets)
+        self.bucket_square_error += np.bincount(bucket, weights=np.square(error), minlength=num_buckets)
+
+    def update(self, pred_e, targ_e, pred_t, targ_t, top_ids=None):
+        self.update_events(pred_e, targ_e)
+        self.update_times(pred_t, targ_t)
+        if top_ids is not None:
+            if self.ranking is None:
+                self.ranking = ranking_metrics.RankingMetrics()
+            self.ranking.update(top_ids, targ_e)
+
+    def bucket_names(self):
+        bounds = ['0'] + ['%g' % e for e in self.edges] + ['inf']
+        return ['[%s, %s)' % (lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    def summary(self):
+        lines = ['Accuracy: %f (%d events)' % (self.correct / max(self.count_e, 1), self.count_e),
+                 'MAE: %f' % (self.abs_error / max(self.count_t, 1)),
+                 'RMSE: %f' % np.sqrt(self.square_error / max(self.count_t, 1))]
+        for name, count, abs_error, square_error in zip(
+                self.bucket_names(), self.bucket_count, self.bucket_abs_error, self.bucket_square_error):
+            if count:
+                lines.append('target t in %s: %d, MAE: %f, RMSE: %f' % (
+                    name, count, abs_error / count, np.sqrt(square_error / count)))
+        lines.append(self.sketches.report())
+        if self.ranking is not None:
+            lines.append(self.ranking.summary())
+        if self.mismatched:
+            lines.append('%d chunks with unequal prediction and target lengths were truncated' % self.mismatched)
+        return '\n'.join(lines)
+
+
+def evaluate(path, output_format='auto', chunk_size=1000, buckets=TIME_BUCKETS):
+    """
+    :param chunk_size: groups per chunk for text output, thousands of rows per chunk for binary output
+    """
+    if output_format == 'auto':
+        output_format = 'binary' if os.path.isdir(path) else 'text'
+    if output_format == 'text':
+        chunks = iter_text_chunks(path, chunk_size)
+    elif output_format == 'binary':
+        chunks = iter_binary_chunks(path, chunk_size * 1000)
+    else:
+        raise ValueError('Invalid output format: %s' % output_format)
+
+    metrics = OutputMetrics(buckets)
+    for chunk in chunks:
+        metrics.update(*chunk)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='output.txt or a prediction store directory')
+    parser.add_argument('--format', default='auto', type=str, help='auto, text or binary')
+    parser.add_argument('--chunk_size', default=1000, type=int)
+    parser.add_argument('--buckets', default=None, type=str, help='comma separated target time bucket edges')
+    parser.add_argument('--sketch', default=None, type=str, help='save the time sketches to this .npz')
+    args = parser.parse_args()
+
+    buckets = TIME_BUCKETS if args.buckets is None else [float(b) for b in args.buckets.split(',')]
+    metrics = evaluate(args.path, args.format, args.chunk_size, buckets)
+    print(metrics.summary())
+    if args.sketch is not None:
+        metrics.sketches.save(args.sketch)
+
+
+if __name__ == '__main__':
+    main()
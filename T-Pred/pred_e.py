@@ -9,6 +9,9 @@ import tensorflow as tf
 import numpy as np
 import utils
 import read_data
+import input_pipeline
+import ranking_metrics
+import vocab
 import model_config
 import logging
 
@@ -47,7 +50,7 @@ def make_noise(shape):
 
 
 class T_Pred(object):
-    def __init__(self, config, cell_type, event_file, time_file, is_training):
+    def __init__(self, config, cell_type, event_file, time_file, is_training, input_mode='feed', compact_vocab=False):
         self.alpha = 1.0
         self.cell_type = cell_type
         self.event_file = event_file
@@ -64,19 +67,40 @@ class T_Pred(object):
         self.keep_prob = config.keep_prob
         self.res_rate = config.res_rate
         self.length = 1 # config.length
-        self.vocab_size = 122911 # config.vocab_size
+        if compact_vocab:
+            # remap the raw item ids by frequency into a dense range with a shared OOV id
+            self.vocab = vocab.load_or_build_vocab(event_file, config.min_count, config.max_vocab_size)
+            self.vocab_size = self.vocab.size
+            encode = self.vocab.encode
+        else:
+            self.vocab = None
+            self.vocab_size = 122911 # config.vocab_size
+            encode = None
         self.learning_rate = config.learning_rate
         self.lr = config.learning_rate
         self.LAMBDA = config.LAMBDA
         self.gamma = config.gamma
+        self.event_loss = config.event_loss
+        self.num_sampled = config.num_sampled
+        self.sampler = config.sampler
+        self.softmax_head = config.softmax_head
+        self.adaptive_cutoffs = config.adaptive_cutoffs
+        self.adaptive_div = config.adaptive_div
+        self.adaptive_min_proj = config.adaptive_min_proj
+        if self.softmax_head == 'adaptive':
+            utils.check_adaptive_head(self.g_size, self.adaptive_min_proj)
         self.train_data, self.valid_data, self.test_data = read_data.data_split(
             event_file, time_file, shuffle=False)
-
-        self.sample_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps + self.length])
-        self.target_t = tf.placeholder(tf.float32, [self.batch_size, self.length])
-        self.inputs_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps])
-        self.targets_e = tf.placeholder(tf.int64, [self.batch_size, self.length])
-        self.input_e = tf.placeholder(tf.int64, [self.batch_size, self.num_steps])
+        # the windows of each split are cut once and reused by every epoch
+        self.plans = {
+            'train': read_data.BatchPlan(
+                self.train_data, self.num_steps, self.length, self.batch_size, shuffle=True, encode=encode),
+            'valid': read_data.BatchPlan(
+                self.valid_data, self.num_steps, self.length, self.batch_size, shuffle=False, encode=encode),
+            'test': read_data.BatchPlan(
+                self.test_data, self.num_steps, self.length, self.batch_size, shuffle=False, encode=encode)}
+
+        input_pipeline.build_inputs(self, input_mode, self.plans)
         self.build()
 
     def encoder_e(self, cell_type, inputs):
@@ -111,7 +135,14 @@ class T_Pred(object):
                 self.length,
                 "G_E.RNN")
             output = tf.reshape(tf.concat(outputs, 1), [-1, self.g_size])
-            output = utils.linear('G_E.Output', self.g_size, self.vocab_size, output)
+            self.event_hidden = output
+            if self.softmax_head == 'adaptive':
+                # normalized log-probabilities, a drop-in for the logits
+                output = utils.adaptive_log_probs('G_E.Output', self.g_size, self.vocab_size, self.adaptive_cutoffs,
+                                                  output, self.adaptive_div, self.adaptive_min_proj)
+            else:
+                # class-major, so a sampled loss (utils.sampled_output_loss) can train the same layer
+                output = utils.linear('G_E.Output', self.g_size, self.vocab_size, output, class_major=True)
             logits = tf.reshape(output, [self.batch_size, self.length, self.vocab_size])
             return logits
 
@@ -119,24 +150,48 @@ class T_Pred(object):
         variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
         return [v for v in variables if name in v.name]
 
+    def unigram_file(self):
+        """The smoothed frequency of every event id, written next to the event file for the unigram sampler"""
+        counts = self.vocab.counts if self.vocab is not None else vocab.count_events(self.event_file)
+        counts = np.concatenate([counts[:self.vocab_size], np.zeros(max(self.vocab_size - len(counts), 0))])
+        path = '%s.unigrams-%s.csv' % (read_data.binary_prefix(self.event_file),
+                                       'compact' if self.vocab is not None else 'raw')
+        return vocab.write_unigram_file(path, counts + 1)
+
     def params_all(self):
         variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
         return variables
 
     def loss(self, pred_e, real_e):
 
-        gen_e_cost = tf.contrib.seq2seq.sequence_loss(pred_e, real_e, weights=tf.ones([self.batch_size, self.length]),
-                                                      name="SeqLoss")
+        if self.softmax_head == 'adaptive':
+            # exact, and cheaper than the softmax over the concatenated log-probabilities
+            with tf.variable_scope("Generator_E"):
+                gen_e_cost = utils.adaptive_softmax_loss('G_E.Output', self.g_size, self.vocab_size,
+                                                         self.adaptive_cutoffs, self.event_hidden, real_e,
+                                                         self.adaptive_div, self.adaptive_min_proj)
+        else:
+            gen_e_cost = tf.contrib.seq2seq.sequence_loss(pred_e, real_e,
+                                                          weights=tf.ones([self.batch_size, self.length]),
+                                                          name="SeqLoss")
+        if self.softmax_head == 'adaptive' or self.event_loss == 'full':
+            train_e_cost = gen_e_cost
+        else:
+            # train on a sampled estimate of the entropy, gen_e_cost keeps the full softmax for evaluation
+            with tf.variable_scope("Generator_E"):
+                train_e_cost = utils.sampled_output_loss(
+                    'G_E.Output', self.event_hidden, real_e, self.vocab_size, self.num_sampled, self.event_loss,
+                    self.sampler, self.unigram_file() if self.sampler == 'unigram' else None)
         '''The separate training of Generator and Discriminator'''
         gen_params = self.params_all()
 
         '''Use the Adam Optimizer to update the variables'''
-        gen_train_op = tf.train.AdamOptimizer(learning_rate=1e-4, beta1=0.5, beta2=0.9).minimize(gen_e_cost, var_list=gen_params)
+        gen_train_op = tf.train.AdamOptimizer(learning_rate=1e-4, beta1=0.5, beta2=0.9).minimize(train_e_cost, var_list=gen_params)
 
         '''Use the RMSProp Optimizer to update the variables'''
         # gen_train_op = tf.train.RMSPropOptimizer(learning_rate=self.lr).minimize(gen_e_cost, var_list=gen_params)
 
-        return gen_train_op, gen_e_cost
+        return gen_train_op, gen_e_cost, train_e_cost
 
     def build(self):
         """
@@ -155,43 +210,21 @@ class T_Pred(object):
         # self.pred_e = self.g_event(output_re)
         # use the extracted feature from input events and timestamps to generate the time sequence
 
-        gen_train_op, gen_e_cost = self.loss(
+        gen_train_op, gen_e_cost, train_e_cost = self.loss(
             pred_e,
             self.targets_e)
 
         self.g_train_op = gen_train_op
         self.gen_e_cost = gen_e_cost
+        self.gen_e_train_cost = train_e_cost
         self.pred_e = pred_e
 
         logging.info('SHAPE OF Pred_e {} targets_e {}'.format(pred_e.get_shape(), self.targets_e.get_shape()))
 
-        # Hit@k, MRR@k & Recall@k
-        MRR10 = 0.0
-        Recall= 0.
-        rate_sum = 0
-
-        hit_matrix = tf.math.in_top_k(
-            tf.reshape(pred_e, [self.batch_size*self.length, -1]),
-            tf.reshape(self.targets_e, [self.batch_size*self.length]),
-            k=10
-        )
-        self.hit_count = tf.math.count_nonzero(hit_matrix)
-
-        # MRR@k
-        self.batch_precision, self.batch_precision_op = tf.metrics.average_precision_at_k(
-            labels=self.targets_e, predictions=pred_e, k=10, name='precision_k')
-        # Isolate the variables stored behind the scenes by the metric operation
-        self.running_precision_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="precision_k")
-        # Define initializer to initialize/reset running variables
-        self.running_precision_vars_initializer = tf.variables_initializer(var_list=self.running_precision_vars)
-
-        # Recall@k
-        self.batch_recall, self.batch_recall_op = tf.metrics.recall_at_k(
-            labels=self.targets_e, predictions=pred_e, k=10, name='recall_k')
-        # Isolate the variables stored behind the scenes by the metric operation
-        self.running_recall_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="recall_k")
-        # Define initializer to initialize/reset running variables
-        self.running_recall_vars_initializer = tf.variables_initializer(var_list=self.running_recall_vars)
+        # Hit@k, MRR@k & Recall@k from the rank of each target among the top ids,
+        # eval fetches top_k_ids instead of the full [batch_size, length, vocab_size] logits
+        self.top_k_scores, self.top_k_ids = tf.nn.top_k(pred_e, ranking_metrics.MAX_K, name='top_k')
+        self.target_ranks = ranking_metrics.target_ranks_op(self.top_k_ids, self.targets_e)
 
         self.saver = tf.train.Saver(max_to_keep=None)
 
@@ -206,109 +239,63 @@ class T_Pred(object):
             os.makedirs('%s/logs' % self.logdir)
 
         if args.weights is not None:
-            self.saver.restore(sess, args.weights)
+            utils.restore_checkpoint(sess, args.weights)
 
         self.lr = self.learning_rate
 
         for epoch in range(args.iters):
             '''training'''
-            sess.run([self.running_precision_vars_initializer, self.running_recall_vars_initializer])
+            metrics = ranking_metrics.RankingMetrics()
 
             if epoch > 0 and epoch % (args.iters // 5) == 0:
                 self.lr = self.lr * 2. / 3
 
-            # re initialize the metric variables of metric.precision and metric.recall,
-            # to calculate these metric for each epoch
-            batch_precision, batch_recall = 0.0, 0.0
-
-            sum_iter = 0.0
-
-            i_e, t_e, i_t, t_t = read_data.data_iterator(self.train_data,self.num_steps, self.length)
-
-            sample_t = read_data.generate_sample_t(self.batch_size, i_t, t_t)
-
             i = 0
-            hit_sum = 0.0
-            batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+            batch_num = len(self.plans['train'])
             logging.info("Total Batch Number {}".format(batch_num))
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'train'):
 
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
-
-                _, gen_e_cost, hit_count, batch_precision, batch_recall, = sess.run([
+                _, gen_e_cost, target_ranks = sess.run([
                     self.g_train_op,
-                    self.gen_e_cost,
-                    self.hit_count,
-                    self.batch_precision_op,
-                    self.batch_recall_op],
+                    self.gen_e_train_cost,
+                    self.target_ranks],
                     feed_dict=feed_dict)
-                sum_iter = sum_iter + 1
-                hit_sum += hit_count
+                metrics.update_ranks(target_ranks)
                 # if self.cell_type == 'T_LSTMCell':
                 #     sess.run(self.clip_op)
 
                 if i % (batch_num // 10) == 0:
-                    logging.info('[epoch: {}, {}] hit10: {}, gen_e_loss: {}, precision: {}, recall: {}'.format(
-                        epoch, float(i) / batch_num, hit_sum / (sum_iter*self.batch_size*self.length),
-                        gen_e_cost, batch_precision, batch_recall))
+                    logging.info('[epoch: {}, {}] hit10: {}, gen_e_loss: {}, MRR@10: {}'.format(
+                        epoch, float(i) / batch_num, metrics['Recall@10'], gen_e_cost, metrics['MRR@10']))
                 i += 1
+            logging.info('[epoch: {}] train {}'.format(epoch, metrics.summary()))
 
             '''evaluation'''
-
-            # re initialize the metric variables of metric.precision and metric.recall,
-            # to calculate these metric for each epoch
-
-            i_e, t_e, i_t, t_t = read_data.data_iterator(
-                self.valid_data,
-                self.num_steps,
-                self.length)
-
-            sample_t = read_data.generate_sample_t(
-                self.batch_size,
-                i_t,
-                t_t)
-
-            sum_iter = 0.0
-            hit_sum = 0.0
+            metrics = ranking_metrics.RankingMetrics()
             i = 0
 
             self.lr = self.learning_rate
-            batch_num = len(list(read_data.generate_batch(self.batch_size,i_e,t_e,i_t,t_t)))
+            batch_num = len(self.plans['valid'])
             logging.info('Total Batch Number For Evaluation {}'.format(batch_num))
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size,i_e,t_e,i_t,t_t):
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'valid'):
 
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
-
-                gen_e_cost, hit_count, batch_precision, batch_recall = sess.run([
+                gen_e_cost, target_ranks = sess.run([
                     self.gen_e_cost,
-                    self.hit_count,
-                    self.batch_precision,
-                    self.batch_recall],
+                    self.target_ranks],
                     feed_dict=feed_dict)
-                sum_iter = sum_iter + 1
-                hit_sum += hit_count
+                metrics.update_ranks(target_ranks)
                 i += 1
 
                 if i % (batch_num // 10) == 0:
-                    logging.info('{}, gen_e_cost: {}, hit10: {}, precision: {}, recall: {}'.format(
+                    logging.info('{}, gen_e_cost: {}, hit10: {}, MRR@10: {}'.format(
                         float(i) / batch_num,
                         gen_e_cost,
-                        hit_sum / (sum_iter*self.batch_size*self.length),
-                        batch_precision,
-                        batch_recall
+                        metrics['Recall@10'],
+                        metrics['MRR@10']
                         ))
+            logging.info('[epoch: {}] valid {}'.format(epoch, metrics.summary()))
         self.save_model(sess, self.logdir, args.iters)
 
     def eval(self, sess, args):
@@ -319,44 +306,23 @@ class T_Pred(object):
         #     self.test_data = read_data.load_test_dataset(self.dataset_file)
 
         if args.weights is not None:
-            self.saver.restore(sess, args.weights)
+            utils.restore_checkpoint(sess, args.weights)
             print_in_file("Saved")
 
         lr = self.learning_rate
 
-        batch_size = 100
-
-        input_event_data, target_event_data, input_time_data, target_time_data = read_data.data_iterator(
-            self.test_data,
-            self.num_steps,
-            self.length)
-
-        sample_t = read_data.generate_sample_t(
-            batch_size,
-            input_time_data,
-            target_time_data)
-
         f = open(os.path.join(args.logdir, "output_e.txt"), 'w+')
         i = 0
 
-        for e_x, e_y, t_x, t_y in read_data.generate_batch(
-                self.batch_size,
-                input_event_data,
-                target_event_data,
-                input_time_data,
-                target_time_data):
-
-            feed_dict = {
-                self.input_e: e_x,
-                self.inputs_t: np.maximum(np.log(t_x), 0),
-                # self.target_t : t_y_list[i],
-                # self.targets_e : e_y_list[i],
-                self.sample_t: np.maximum(np.log(sample_t), 0)}
-
-            pred_e = sess.run(self.pred_e, feed_dict=feed_dict)
-
-            _, pred_e_index = tf.nn.top_k(pred_e, 1, name=None)
-            f.write('pred_e: ' + '\t'.join([str(v) for v in tf.reshape(tf.squeeze(pred_e_index), [-1]).eval()]))
+        for feed_dict in input_pipeline.feed_batches(sess, self, 'test'):
+
+            top_k_ids, e_y = sess.run([self.top_k_ids, self.targets_e], feed_dict=feed_dict)
+
+            pred_e_index = top_k_ids[:, :, 0].flatten()
+            if self.vocab is not None:
+                # write the raw item ids, OOV as -1
+                pred_e_index, e_y = self.vocab.decode(pred_e_index), self.vocab.decode(e_y)
+            f.write('pred_e: ' + '\t'.join([str(v) for v in pred_e_index]))
             f.write('\n')
             f.write('targ_e: ' + '\t'.join([str(v) for v in np.array(e_y[i]).flatten()]))
             f.write('\n')
@@ -393,18 +359,26 @@ def main():
     parser.add_argument('--logdir', default='log/log_kick', type=str)
     parser.add_argument('--iters', default=100, type=int)
     parser.add_argument('--cell_type', default='T_GRUCell', type=str)
+    parser.add_argument('--input_mode', default='feed', type=str, help='feed or dataset')
+    parser.add_argument('--compact_vocab', default=False, action='store_true',
+                        help='remap item ids by frequency, see min_count and max_vocab_size in model_config')
+    parser.add_argument('--event_loss', default=None, type=str, help='full, sampled or nce, overrides model_config')
     args = parser.parse_args()
 
     assert args.logdir[-1] != '/'
     model_config = get_config(args.mode)
+    if args.event_loss is not None:
+        model_config.event_loss = args.event_loss
     is_training = args.is_training
     cell_type = args.cell_type
-    model = T_Pred(model_config, cell_type, event_file, time_file, is_training)
+    model = T_Pred(model_config, cell_type, event_file, time_file, is_training, args.input_mode, args.compact_vocab)
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     with tf.Session(config=config) as sess:
         sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+        # every op is built by now, adding one in the loops raises instead of growing the graph
+        sess.graph.finalize()
         if not args.eval_only:
             model.train(sess, args)
         model.eval(sess, args)
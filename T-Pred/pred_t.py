@@ -8,6 +8,7 @@ import tensorflow as tf
 import numpy as np
 import utils
 import read_data
+import input_pipeline
 import model_config
 import logging
 import datetime
@@ -42,7 +43,7 @@ def make_noise(shape):
 
 
 class T_Pred(object):
-    def __init__(self, config, cell_type, event_file, time_file, is_training):
+    def __init__(self, config, cell_type, event_file, time_file, is_training, input_mode='feed'):
         self.alpha = 1.0
         self.cell_type = cell_type
         self.event_file = event_file
@@ -55,6 +56,7 @@ class T_Pred(object):
         self.batch_size = config.batch_size
         self.num_steps = config.num_steps
         self.n_g = config.num_gen
+        self.gen_select = config.gen_select
         self.is_training = is_training
         self.keep_prob = config.keep_prob
         self.res_rate = config.res_rate
@@ -67,13 +69,14 @@ class T_Pred(object):
         # self.event_to_id = read_data.build_vocab(self.event_file)
         self.train_data, self.valid_data, self.test_data = read_data.data_split(
             event_file, time_file, shuffle=True)
+        # the windows of each split are cut once and reused by every epoch
+        self.plans = {
+            'train': read_data.BatchPlan(self.train_data, self.num_steps, self.length, self.batch_size, shuffle=True),
+            'valid': read_data.BatchPlan(self.valid_data, self.num_steps, self.length, self.batch_size, shuffle=False),
+            'test': read_data.BatchPlan(self.test_data, self.num_steps, self.length, self.batch_size, shuffle=False)}
         self.embeddings = tf.get_variable(
             "embedding", [self.vocab_size, self.hidden_size], dtype=tf.float32)
-        self.sample_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps + self.length])
-        self.target_t = tf.placeholder(tf.float32, [self.batch_size, self.length])
-        self.inputs_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps])
-        self.targets_e = tf.placeholder(tf.int64, [self.batch_size, self.length])
-        self.input_e = tf.placeholder(tf.int64, [self.batch_size, self.num_steps])
+        input_pipeline.build_inputs(self, input_mode, self.plans)
         self.build()
 
     def encoder_e_t(self, cell_type, inputs, t):
@@ -131,6 +134,28 @@ class T_Pred(object):
             logits = tf.reshape(output, [self.batch_size, self.length, 1])
             return logits
 
+    def g_time_stacked(self, hidden_r, gen_ids=None):
+        """
+        The n_g time generators of g_time as one decoder with stacked weights
+        :param gen_ids: None to run every generator, [n_g, batch_size, length, 1];
+            or the generator of each example, [batch_size, length, 1] evaluating only that one
+        """
+        with tf.variable_scope('Generator_T'):
+            outputs = utils.build_stacked_decoder(
+                hidden_r,
+                self.num_layers,
+                self.hidden_size,
+                self.n_g,
+                self.length,
+                "G_T.RNN",
+                gen_ids)
+            logits = utils.stacked_linear('G_T.Output', self.n_g, self.hidden_size, 1, outputs, gen_ids)
+            if gen_ids is None:
+                logits.set_shape([self.n_g, self.batch_size, self.length, 1])
+            else:
+                logits.set_shape([self.batch_size, self.length, 1])
+            return logits
+
     def attention_g_t(self, hidden_rt, num_gen):
         """
         If there are multiple generator for time sequences,
@@ -186,7 +211,7 @@ class T_Pred(object):
         return [v for v in variables if name in v.name]
 
     def loss_with_wasserstein(self, pred_t, real_t, input_t, sample_t):
-        if self.cell_type == 'T_LSTMCell':
+        if self.cell_type in ('T_LSTMCell', 'FusedT_LSTMCell'):
             variable_content_e = self.params_with_name('time_gate_t1')
         else:
             variable_content_e = None
@@ -254,6 +279,9 @@ class T_Pred(object):
         define the loss function
         define the optimization method
         """
+        # the loss weight is re-estimated on the validation set after every epoch
+        self.gamma, self.gamma_value, self.gamma_assign = utils.loss_weight('gamma', self.gamma)
+
         self.targets_t = tf.expand_dims(self.target_t, 2)
         self.inputs_e = tf.nn.embedding_lookup(self.embeddings, self.input_e)
 
@@ -266,26 +294,17 @@ class T_Pred(object):
         # self.pred_t = pred_t = self.g_time(make_noise(hidden_r.get_shape()))
 
         else:
-            self.pred_t_list = []
-            for i in range(self.n_g):
-                pred_t = self.g_time(tf.reshape(hidden_rt, [self.batch_size, -1]), name=str(i))
-                pred_t = tf.expand_dims(pred_t, 1)
-                self.pred_t_list.append(pred_t)
-            # self.pred_t = self.g_time(output_rt)
-            # use random noise to generate the time sequence
-            # self.pred_t = pred_t = self.g_time(make_noise(hidden_r.get_shape()))
-            # the shape of pred_t_list: [batch_size, num_gen, predicted value]
-            self.pred_t_list = tf.concat(self.pred_t_list, 1)
-
             '''The attention module for select the pred_t from all t-generators'''
             attention_gt = self.attention_g_t(hidden_rt, self.n_g)
-            k = tf.argmax(attention_gt, 1)
-            # print(k.get_shape())
-            pred_t = []
-            for i in range(self.batch_size):
-                pred_t_e = self.pred_t_list[i][k[i]]
-                pred_t.append(tf.expand_dims(pred_t_e, 0))
-            self.pred_t = tf.concat(pred_t, 0)
+            k = tf.argmax(attention_gt, 1, output_type=tf.int32)
+            hidden_rt = tf.reshape(hidden_rt, [self.batch_size, -1])
+            if self.gen_select == 'argmax':
+                # the selection is an argmax, the other generators get no gradient either way
+                self.pred_t = self.g_time_stacked(hidden_rt, k)
+            else:
+                # the shape of pred_t_list: [batch_size, num_gen, length, 1]
+                self.pred_t_list = tf.transpose(self.g_time_stacked(hidden_rt), [1, 0, 2, 3])
+                self.pred_t = tf.gather_nd(self.pred_t_list, tf.stack([tf.range(self.batch_size), k], 1))
 
         gen_train_op, disc_train_op, w_clip_op, gen_t_cost, disc_cost, gen_t_cost_1, huber_t_loss = self.loss_with_wasserstein(
             self.pred_t,
@@ -302,6 +321,7 @@ class T_Pred(object):
         self.huber_t_loss = huber_t_loss
 
         self.deviation = tf.reduce_mean(tf.abs(tf.squeeze(tf.exp(self.pred_t) - self.targets_t)))
+        self.pred_t_exp = tf.exp(self.pred_t)
         self.saver = tf.train.Saver(max_to_keep=None)
 
     def train(self, sess, args):
@@ -315,7 +335,7 @@ class T_Pred(object):
             os.makedirs('%s/logs' % self.logdir)
 
         if args.weights is not None:
-            self.saver.restore(sess, args.weights)
+            utils.restore_checkpoint(sess, args.weights)
 
         self.lr = self.learning_rate
 
@@ -326,24 +346,14 @@ class T_Pred(object):
             average_deviation, sum_deviation = 0.0, 0.0
             d_loss, gen_t_cost, huber_t_loss = 0.0, 0.0, 0.0
 
-            i_e, t_e, i_t, t_t = read_data.data_iterator(self.train_data, self.num_steps, self.length)
-
-            sample_t = read_data.generate_sample_t(self.batch_size, i_t, t_t)
-            batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+            batch_num = len(self.plans['train'])
             logging.info('Training batch num {}'.format(batch_num))
 
             g_iters = 5
             gap = g_iters + 1
             i = 0
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'train'):
 
                 if i > 0 and i % (batch_num // 10) == 0:
                     self.lr = self.lr * 2. / 3
@@ -374,17 +384,7 @@ class T_Pred(object):
 
             '''evaluation'''
 
-            i_e, t_e, i_t, t_t = read_data.data_iterator(
-                self.valid_data,
-                self.num_steps,
-                self.length)
-
-            sample_t = read_data.generate_sample_t(
-                self.batch_size,
-                i_t,
-                t_t)
-
-            batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+            batch_num = len(self.plans['valid'])
             logging.info('Evaluation Batch Num {}'.format(batch_num))
 
             sum_iter = 0.0
@@ -395,13 +395,7 @@ class T_Pred(object):
 
             self.lr = self.learning_rate
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'valid'):
 
                 if i > 0 and i % (batch_num // 10) == 0:
                     self.lr = self.lr * 2. / 3
@@ -422,8 +416,10 @@ class T_Pred(object):
                         gen_t_cost,
                         huber_t_loss))
                 i += 1
-            self.gamma = tf.reduce_mean(t_cost_ratio)
-            logging.info('gamma: {}'.format (sess.run(self.gamma)))
+            gamma = utils.estimate_loss_weight(t_cost_ratio)
+            if gamma is not None:
+                sess.run(self.gamma_assign, feed_dict={self.gamma_value: gamma})
+            logging.info('gamma: {}'.format(sess.run(self.gamma)))
 
         self.save_model(sess, self.logdir, args.iters)
 
@@ -435,34 +431,18 @@ class T_Pred(object):
             self.test_data = read_data.load_test_dataset(self.dataset_file)
 
         if args.weights is not None:
-            self.saver.restore(sess, args.weights)
+            utils.restore_checkpoint(sess, args.weights)
             print_in_file("Saved")
 
         lr = self.learning_rate
 
-        i_e, t_e, i_t, t_t = read_data.data_iterator(
-            self.test_data,
-            self.num_steps,
-            self.length)
-
-        sample_t = read_data.generate_sample_t(
-            self.batch_size,
-            i_t,
-            t_t)
-
-        batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+        batch_num = len(self.plans['test'])
         logging.info('Evaluation Batch Num {}'.format(batch_num))
 
         f = open(os.path.join(args.logdir, "output_t.txt"), 'w+')
         i = 0
 
-        for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-            feed_dict = {
-                # self.input_e: e_x,
-                self.inputs_t: np.maximum(np.log(t_x), 0),
-                self.target_t: t_y,
-                # self.targets_e: e_y,
-                self.sample_t: np.maximum(np.log(sample_t), 0)}
+        for feed_dict in input_pipeline.feed_batches(sess, self, 'test'):
 
             if i > 0 and i % (batch_num // 10) == 0:
                 lr = lr * 2. / 3
@@ -470,12 +450,12 @@ class T_Pred(object):
             # 	[self.correct_pred, self.deviation, self.pred_e, self.pred_t, self.d_cost, self.g_cost,
             # 	self.gen_e_cost, self.gen_t_cost,self.disc_cost_1, self.gradient_penalty],
             # 	feed_dict = feed_dict)
-            pred_t = sess.run(self.pred_t, feed_dict=feed_dict)
+            pred_t, t_y = sess.run([self.pred_t_exp, self.target_t], feed_dict=feed_dict)
 
             # sum_correct_pred = sum_correct_pred + correct_pred
             # sum_iter = sum_iter + 1
             # sum_deviation = sum_deviation + deviation
-            f.write('pred_t: ' + '\t'.join([str(v) for v in tf.exp(pred_t).eval()]))
+            f.write('pred_t: ' + '\t'.join([str(v) for v in pred_t]))
             f.write('\n')
             f.write('targ_t: ' + '\t'.join([str(v) for v in np.array(t_y).flatten()]))
             f.write('\n')
@@ -519,20 +499,28 @@ def main():
     parser.add_argument('--eval_only', default=False, action='store_true')
     parser.add_argument('--logdir', default='log/log_kick', type=str)
     parser.add_argument('--iters', default=30, type=int)
-    parser.add_argument('--cell_type', default='T_GRUCell', type=str)
+    parser.add_argument('--cell_type', default='T_GRUCell', type=str,
+                        help='T_GRUCell, T_LSTMCell, FusedT_GRUCell or FusedT_LSTMCell')
+    parser.add_argument('--input_mode', default='feed', type=str, help='feed or dataset')
+    parser.add_argument('--gen_select', default=None, type=str,
+                        help='all or argmax: run every time generator or only the selected one, overrides model_config')
     args = parser.parse_args()
 
     assert args.logdir[-1] != '/'
     model_config = get_config(args.mode)
+    if args.gen_select is not None:
+        model_config.gen_select = args.gen_select
     is_training = args.is_training
     cell_type = args.cell_type
     # print('vocab_size: ' + str(read_data.vocab_size(event_file)))
-    model = T_Pred(model_config, cell_type, event_file, time_file, is_training)
+    model = T_Pred(model_config, cell_type, event_file, time_file, is_training, args.input_mode)
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     with tf.Session(config=config) as sess:
         sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+        # every op is built by now, adding one in the loops raises instead of growing the graph
+        sess.graph.finalize()
         if not args.eval_only:
             model.train(sess, args)
         model.eval(sess, args)
@@ -8,6 +8,7 @@ import tensorflow as tf
 import numpy as np
 import utils
 import read_data
+import input_pipeline
 import model_config
 import logging
 import datetime
@@ -42,7 +43,7 @@ def make_noise(shape):
 
 
 class T_Pred(object):
-    def __init__(self, config, cell_type, event_file, time_file, is_training):
+    def __init__(self, config, cell_type, event_file, time_file, is_training, input_mode='feed'):
         self.alpha = 1.0
         self.cell_type = cell_type
         self.event_file = event_file
@@ -67,13 +68,14 @@ class T_Pred(object):
         # self.event_to_id = read_data.build_vocab(self.event_file)
         self.train_data, self.valid_data, self.test_data = read_data.data_split(
             event_file, time_file, shuffle=True)
+        # the windows of each split are cut once and reused by every epoch
+        self.plans = {
+            'train': read_data.BatchPlan(self.train_data, self.num_steps, self.length, self.batch_size, shuffle=True),
+            'valid': read_data.BatchPlan(self.valid_data, self.num_steps, self.length, self.batch_size, shuffle=False),
+            'test': read_data.BatchPlan(self.test_data, self.num_steps, self.length, self.batch_size, shuffle=False)}
         self.embeddings = tf.get_variable(
             "embedding", [self.vocab_size, self.hidden_size], dtype=tf.float32)
-        self.sample_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps + self.length])
-        self.target_t = tf.placeholder(tf.float32, [self.batch_size, self.length])
-        self.inputs_t = tf.placeholder(tf.float32, [self.batch_size, self.num_steps])
-        self.targets_e = tf.placeholder(tf.int64, [self.batch_size, self.length])
-        self.input_e = tf.placeholder(tf.int64, [self.batch_size, self.num_steps])
+        input_pipeline.build_inputs(self, input_mode, self.plans)
         self.build()
 
     def encoder_e_t(self, cell_type, inputs, t):
@@ -189,7 +191,7 @@ class T_Pred(object):
             return [v for v in variables if name in v.name]
 
     def loss_with_wasserstein(self, pred_t, real_t, input_t, sample_t):
-        if self.cell_type == 'T_LSTMCell':
+        if self.cell_type in ('T_LSTMCell', 'FusedT_LSTMCell'):
             variable_content_e = self.params_with_name('time_gate_t1')
         else:
             variable_content_e = None
@@ -286,6 +288,7 @@ class T_Pred(object):
         self.gen_t_cost = gen_t_cost
 
         self.deviation = tf.reduce_mean(tf.abs(tf.squeeze(tf.exp(self.pred_t) - self.targets_t)))
+        self.pred_t_exp = tf.exp(self.pred_t)
         self.saver = tf.train.Saver(max_to_keep=None)
 
     def train(self, sess, args):
@@ -310,24 +313,14 @@ class T_Pred(object):
             average_deviation, sum_deviation = 0.0, 0.0
             d_loss, gen_t_cost, huber_t_loss = 0.0, 0.0, 0.0
 
-            i_e, t_e, i_t, t_t = read_data.data_iterator(self.train_data, self.num_steps, self.length)
-
-            sample_t = read_data.generate_sample_t(self.batch_size, i_t, t_t)
-            batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+            batch_num = len(self.plans['train'])
             logging.info('Training batch num {}'.format(batch_num))
 
             g_iters = 5
             gap = g_iters + 1
             i = 0
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'train'):
 
                 if i > 0 and i % (batch_num // 10) == 0:
                     self.lr = self.lr * 2. / 3
@@ -353,17 +346,7 @@ class T_Pred(object):
 
             '''evaluation'''
 
-            i_e, t_e, i_t, t_t = read_data.data_iterator(
-                self.valid_data,
-                self.num_steps,
-                self.length)
-
-            sample_t = read_data.generate_sample_t(
-                self.batch_size,
-                i_t,
-                t_t)
-
-            batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+            batch_num = len(self.plans['valid'])
             logging.info('Evaluation Batch Num {}'.format(batch_num))
 
             sum_iter = 0.0
@@ -374,13 +357,7 @@ class T_Pred(object):
 
             self.lr = self.learning_rate
 
-            for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-                feed_dict = {
-                    self.input_e: e_x,
-                    self.inputs_t: np.maximum(np.log(t_x), 0),
-                    self.target_t: t_y,
-                    self.targets_e: e_y,
-                    self.sample_t: np.maximum(np.log(sample_t), 0)}
+            for feed_dict in input_pipeline.feed_batches(sess, self, 'valid'):
 
                 if i > 0 and i % (batch_num // 10) == 0:
                     self.lr = self.lr * 2. / 3
@@ -413,29 +390,13 @@ class T_Pred(object):
 
         lr = self.learning_rate
 
-        i_e, t_e, i_t, t_t = read_data.data_iterator(
-            self.test_data,
-            self.num_steps,
-            self.length)
-
-        sample_t = read_data.generate_sample_t(
-            self.batch_size,
-            i_t,
-            t_t)
-
-        batch_num = len(list(read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t)))
+        batch_num = len(self.plans['test'])
         logging.info('Evaluation Batch Num {}'.format(batch_num))
 
         f = open(os.path.join(args.logdir, "output_t.txt"), 'w+')
         i = 0
 
-        for e_x, e_y, t_x, t_y in read_data.generate_batch(self.batch_size, i_e, t_e, i_t, t_t):
-            feed_dict = {
-                # self.input_e: e_x,
-                self.inputs_t: np.maximum(np.log(t_x), 0),
-                self.target_t: t_y,
-                # self.targets_e: e_y,
-                self.sample_t: np.maximum(np.log(sample_t), 0)}
+        for feed_dict in input_pipeline.feed_batches(sess, self, 'test'):
 
             if i > 0 and i % (batch_num // 10) == 0:
                 lr = lr * 2. / 3
@@ -443,14 +404,14 @@ class T_Pred(object):
             # 	[self.correct_pred, self.deviation, self.pred_e, self.pred_t, self.d_cost, self.g_cost,
             # 	self.gen_e_cost, self.gen_t_cost,self.disc_cost_1, self.gradient_penalty],
             # 	feed_dict = feed_dict)
-            pred_t = sess.run(self.pred_t, feed_dict=feed_dict)
+            pred_t, t_y = sess.run([self.pred_t_exp, self.target_t], feed_dict=feed_dict)
 
             # sum_correct_pred = sum_correct_pred + correct_pred
             # sum_iter = sum_iter + 1
             # sum_deviation = sum_deviation + deviation
-            f.write('pred_t: ' + '\t'.join([str(v) for v in tf.exp(pred_t).eval()]))
+            f.write('pred_t: ' + '\t'.join([str(v) for v in pred_t]))
             f.write('\n')
-            f.write('targ_t: ' + '\t'.join([str(v) for v in np.array(t_y_list[i]).flatten()]))
+            f.write('targ_t: ' + '\t'.join([str(v) for v in np.array(t_y).flatten()]))
             f.write('\n')
 
             i += 1
@@ -492,7 +453,9 @@ def main():
     parser.add_argument('--eval_only', default=False, action='store_true')
     parser.add_argument('--logdir', default='log/log_kick', type=str)
     parser.add_argument('--iters', default=30, type=int)
-    parser.add_argument('--cell_type', default='T_GRUCell', type=str)
+    parser.add_argument('--cell_type', default='T_GRUCell', type=str,
+                        help='T_GRUCell, T_LSTMCell, FusedT_GRUCell or FusedT_LSTMCell')
+    parser.add_argument('--input_mode', default='feed', type=str, help='feed or dataset')
     args = parser.parse_args()
 
     assert args.logdir[-1] != '/'
@@ -500,12 +463,14 @@ def main():
     is_training = args.is_training
     cell_type = args.cell_type
     # print('vocab_size: ' + str(read_data.vocab_size(event_file)))
-    model = T_Pred(model_config, cell_type, event_file, time_file, is_training)
+    model = T_Pred(model_config, cell_type, event_file, time_file, is_training, args.input_mode)
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     with tf.Session(config=config) as sess:
         sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+        # every op is built by now, adding one in the loops raises instead of growing the graph
+        sess.graph.finalize()
         if not args.eval_only:
             model.train(sess, args)
         model.eval(sess, args)
@@ -0,0 +1,344 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import numbers
+import time
+import argparse
+import threading
+import collections
+import numpy as np
+import vocab
+import numpy_infer
+import prediction_cache
+import model_reloader
+
+try:
+    import queue
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.request import urlopen, Request
+except ImportError:
+    import Queue as queue
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import urlopen, Request
+
+'''
+Long-lived local prediction server: the model is loaded once (an export_numpy.py output, or a
+checkpoint exported on start) and next-event / next-time requests of concurrent clients are
+coalesced into batches of up to max_batch, or whatever arrived within max_delay_ms of the first.
+    POST /predict  {"events": [...], "times": [...], "k": 10}
+                   -> {"events": top-k ids, best first, "time": predicted inter-event time}
+    GET  /stats    -> request count, p50/p99 latency in ms, requests/s, mean batch size
+Requests and responses are in the units of the trace files: raw item ids and raw inter-event times.
+The server applies what T_Pred's input does, np.maximum(np.log(t), 0) on the times and, for an export
+with a compact vocabulary, Vocabulary.encode on the ids (unknown items become OOV); the response ids
+are decoded back to raw ids (OOV as -1) and the time is exp'd back from the predicted log-time.
+Histories are the last num_steps events and times, shorter ones are left-padded with zeros; an empty
+one has nothing to predict from and is rejected.
+A request is checked before it joins a batch, so a bad one gets a 400 and never fails the others;
+anything else that goes wrong is a 500.
+With --cache_size, repeated histories are answered from a prediction_cache.PredictionCache without
+joining a batch; /stats then has its hit and miss counters.
+With --watch, new T_Pred.save_model checkpoints under a directory are loaded in the background and
+swapped in between batches (model_reloader), the cache moving to the new model version.
+usage: python predict_server.py exported --port 8500
+       python predict_server.py exported --bench 10000 --concurrency 32
+'''
+
+
+class InvalidRequest(ValueError):
+    pass
+
+
+def prepare_request(events, times, k, vocab_size, encode=None):
+    """
+    Check a request and convert its raw ids and inter-event times to the model inputs
+    :param encode: Vocabulary.encode of a compact-vocabulary export, then any raw id >= 0 is accepted
+    :return: events and log-times as arrays; raises InvalidRequest for a history the model cannot take
+    """
+    try:
+        events = np.asarray(events, dtype=np.float64)
+        times = np.asarray(times, dtype=np.float64)
+    except (ValueError, TypeError):
+        raise InvalidRequest('events and times must be lists of numbers')
+    if events.ndim != 1 or times.ndim != 1 or len(events) != len(times):
+        raise InvalidRequest('events and times must be flat lists of the same length')
+    if len(events) == 0:
+        raise InvalidRequest('events and times must not be empty')
+    if not (np.all(np.isfinite(events)) and np.all(events == np.floor(events))):
+        raise InvalidRequest('event ids must be integers')
+    if events.min() < 0:
+        raise InvalidRequest('event ids must not be negative')
+    if encode is None and events.max() >= vocab_size:
+        raise InvalidRequest('event ids must be in [0, %d)' % vocab_size)
+    if not np.all(np.isfinite(times)) or times.min() < 0:
+        raise InvalidRequest('times must be finite and not negative')
+    if isinstance(k, bool) or not isinstance(k, numbers.Integral) or k <= 0:
+        raise InvalidRequest('k must be a positive integer')
+    events = events.astype(np.int64)
+    if encode is not None:
+        events = encode(events)
+    with np.errstate(divide='ignore'):
+        times = np.maximum(np.log(times), 0)
+    return events, times
+
+
+def window(histories, num_steps):
+    """[N, num_steps] array of the last num_steps values of every history, left-padded with zeros"""
+    output = np.zeros((len(histories), num_steps))
+    for i, history in enumerate(histories):
+        history = list(history)[-num_steps:]
+        if history:
+            output[i, num_steps - len(history):] = history
+    return output
+
+
+class LatencyStats(object):
+    """Latencies of the most recent requests, and the throughput since the start"""
+
+    def __init__(self, max_samples=100000):
+        self.latencies = collections.deque(maxlen=max_samples)
+        self.requests = 0
+        self.batches = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def record_hit(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+
+    def record_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1e3
+            requests, batches = self.requests, self.batches
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (np.nan, np.nan)
+        return {'requests': requests, 'p50_ms': float(p50), 'p99_ms': float(p99),
+                'requests_per_s': requests / max(time.time() - self.start, 1e-9),
+                'mean_batch_size': requests / max(batches, 1)}
+
+
+class MicroBatcher(object):
+    """Runs predict_fn on batches coalesced from the submit() calls of many threads"""
+
+    def __init__(self, predict_fn, num_steps, vocab_size, max_batch=64, max_delay_ms=5., cache=None, holder=None,
+                 encode=None):
+        """
+        :param predict_fn: (events [N, num_steps], log-times [N, num_steps], k)
+                           -> (top-k raw ids [N, ..., k], times [N, ...])
+        :param encode: raw ids to the model's ids, for a compact-vocabulary export
+        :param cache: an optional prediction_cache.PredictionCache, checked before a request is queued
+        :param holder: the model_reloader.ModelHolder predict_fn serves from, for /stats
+        """
+        self.predict_fn = predict_fn
+        self.num_steps = num_steps
+        self.vocab_size = vocab_size
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1e3
+        self.cache = cache
+        self.holder = holder
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, events, times, k=10):
+        events, times = prepare_request(events, times, k, self.vocab_size, self.encode)
+        # the answer never has more ids than the vocabulary, nor does a cache entry
+        k = min(k, self.vocab_size)
+        if self.cache is not None:
+            start = time.time()
+            cached = self.cache.get(events, times, k)
+            if cached is not None:
+                self.stats.record_hit(time.time() - start)
+                return cached
+        request = {'events': events, 'times': times, 'k': k, 'start': time.time(),
+                   'done': threading.Event(), 'result': None, 'error': None}
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0]['start'] + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                batch.append(self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            # read before the model, so a swap meanwhile only stores under the old version
+            version = self.cache.model_version if self.cache is not None else None
+            try:
+                events = window([r['events'] for r in batch], self.num_steps).astype(np.int64)
+                times = window([r['times'] for r in batch], self.num_steps).astype(np.float32)
+                ids, pred_t = self.predict_fn(events, times, max(r['k'] for r in batch))
+                for i, request in enumerate(batch):
+                    request['result'] = (ids[i].reshape(-1, ids.shape[-1])[0, :request['k']],
+                                         float(pred_t[i].reshape(-1)[0]))
+                    if self.cache is not None:
+                        self.cache.put(request['events'], request['times'], *request['result'], model_version=version)
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            finished = time.time()
+            self.stats.record_batch([finished - r['start'] for r in batch])
+            for request in batch:
+                request['done'].set()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.reply(200, summary(batcher))
+            else:
+                self.reply(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.reply(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                events, times, k = request['events'], request['times'], request.get('k', 10)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                self.reply(400, {'error': 'not the JSON of a request: %s' % e})
+                return
+            try:
+                ids, pred_t = batcher.submit(events, times, k)
+            except InvalidRequest as e:
+                self.reply(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self.reply(500, {'error': '%s: %s' % (type(e).__name__, e)})
+                return
+            self.reply(200, {'events': [int(i) for i in ids], 'time': pred_t})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def summary(batcher):
+    stats = batcher.stats.summary()
+    if batcher.cache is not None:
+        stats['cache'] = batcher.cache.stats()
+    if batcher.holder is not None:
+        stats['model'] = {'version': batcher.holder.version, 'swaps': batcher.holder.swaps}
+    return stats
+
+
+def serve(batcher, host='127.0.0.1', port=8500):
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def bench(url, num_steps, vocab_size, num_requests, concurrency):
+    """concurrency client threads posting random histories"""
+    def client(n):
+        for _ in range(n):
+            length = np.random.randint(1, num_steps + 1)
+            body = json.dumps({'events': np.random.randint(0, vocab_size, length).tolist(),
+                               'times': np.random.exponential(100., length).tolist(), 'k': 10}).encode('utf-8')
+            urlopen(Request(url + '/predict', body, {'Content-Type': 'application/json'})).read()
+
+    threads = [threading.Thread(target=client, args=(num_requests // concurrency,)) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str, help='export_numpy.py output or a checkpoint prefix')
+    parser.add_argument('--mode', default='small', type=str, help='model_config of a checkpoint')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8500, type=int)
+    parser.add_argument('--max_batch', default=64, type=int)
+    parser.add_argument('--max_delay_ms', default=5., type=float)
+    parser.add_argument('--cache_size', default=0, type=int, help='cached histories, 0 for no cache')
+    parser.add_argument('--cache_ttl', default=300., type=float, help='seconds a cached prediction is served')
+    parser.add_argument('--time_resolution', default=0.1, type=float, help='log-time bucket width of the cache keys')
+    parser.add_argument('--watch', default=None, type=str, help='directory polled for new checkpoints')
+    parser.add_argument('--watch_interval', default=10., type=float, help='seconds between polls')
+    parser.add_argument('--bench', default=0, type=int, help='send this many requests, print the stats and exit')
+    parser.add_argument('--concurrency', default=16, type=int)
+    args = parser.parse_args()
+
+    model = numpy_infer.load_model(args.model, args.mode)
+    version = args.model
+    if model_reloader.checkpoint_mtime(args.model) is not None:
+        version = model_reloader.checkpoint_version(args.model)
+    holder = model_reloader.ModelHolder(model, version)
+
+    def predict_fn(events, times, k):
+        model, _ = holder.current()  # one model for the whole batch, whatever a swap does meanwhile
+        pred_e, pred_t, _ = model.predict(events, times)
+        return model.top_k(pred_e, pred_t, k)
+
+    cache = None
+    if args.cache_size > 0:
+        cache = prediction_cache.PredictionCache(model.num_steps, args.cache_size, args.cache_ttl,
+                                                 args.time_resolution, model_version=version)
+        holder.listeners.append(cache.set_version)
+    encode = None
+    if model.raw_ids is not None:
+        encode = vocab.Vocabulary(model.raw_ids, np.zeros(len(model.raw_ids))).encode
+    batcher = MicroBatcher(predict_fn, model.num_steps, model.vocab_size, args.max_batch, args.max_delay_ms, cache,
+                           holder, encode)
+    if args.watch:
+        model_reloader.CheckpointWatcher(holder, args.watch, args.mode, args.watch_interval).start()
+    server = serve(batcher, args.host, args.port)
+    print('serving on http://%s:%d' % (args.host, args.port))
+    if args.bench:
+        bench('http://%s:%d' % (args.host, args.port), model.num_steps, model.vocab_size, args.bench, args.concurrency)
+        print(json.dumps(summary(batcher)))
+        server.shutdown()
+        return
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(summary(batcher)))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
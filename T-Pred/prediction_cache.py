@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import hashlib
+import threading
+import collections
+import numpy as np
+
+'''
+LRU + TTL cache of predictions, in front of the inference path, so repeated histories (the same
+first clicks of many sessions) return the cached top-k without running the model.
+The key is a hash of the model version and the window the model sees: the last num_steps event ids
+and log-times (the model inputs, np.maximum(np.log(t), 0)), the times rounded to time_resolution,
+so histories differing only by jitter of their times share an entry.
+An entry serves requests for up to as many ids as it holds; one asking for more is a miss.
+'''
+
+
+def fingerprint(events, times, num_steps, time_resolution=0.1, model_version=''):
+    """Hash of the last num_steps events and bucketed log-times of a history, under a model version"""
+    events = np.asarray(events, dtype=np.int64).reshape(-1)[-num_steps:]
+    buckets = np.round(np.asarray(times, dtype=np.float64).reshape(-1)[-num_steps:] / time_resolution)
+    digest = hashlib.sha1(str(model_version).encode('utf-8'))
+    digest.update(events.tobytes())
+    digest.update(buckets.astype(np.int64).tobytes())
+    return digest.digest()
+
+
+class PredictionCache(object):
+    def __init__(self, num_steps, max_entries=100000, ttl=300., time_resolution=0.1, model_version=''):
+        """
+        :param num_steps: the window of the model, older events do not change the key
+        :param max_entries: least recently used entries are evicted beyond this
+        :param ttl: seconds an entry is served, 0 for no expiry
+        :param time_resolution: bucket width of the log-times in the key
+        :param model_version: part of every key; set_version() drops what the previous model predicted
+        """
+        self.num_steps = num_steps
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.time_resolution = time_resolution
+        self.model_version = model_version
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, events, times, model_version=None):
+        if model_version is None:
+            model_version = self.model_version
+        return fingerprint(events, times, self.num_steps, self.time_resolution, model_version)
+
+    def get(self, events, times, k):
+        """:return: the cached (top-k ids, time) of the history, None on a miss"""
+        key = self.key(events, times)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.ttl > 0 and time.time() - entry[0] > self.ttl:
+                self.expirations += 1
+                entry = None
+            if entry is None or len(entry[1]) < k:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        return entry[1][:k], entry[2]
+
+    def put(self, events, times, ids, pred_t, model_version=None):
+        """:param model_version: the version read before predicting, if set_version() may run meanwhile"""
+        key = self.key(events, times, model_version)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), np.asarray(ids), pred_t)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_version(self, model_version):
+        """Key new entries under a new model, the old ones can no longer hit"""
+        with self.lock:
+            self.model_version = model_version
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / max(lookups, 1), 'expirations': self.expirations,
+                    'evictions': self.evictions}
@@ -0,0 +1,193 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import json
+import shutil
+import threading
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+'''
+Append-only binary store of the evaluation output, one row per predicted event:
+pred_ids     uint32  [rows, k]  top-k event ids, best first
+pred_scores  float16 [rows, k]  their scores
+targ_e       uint32  [rows]     target event id
+pred_t       float32 [rows]     predicted time
+targ_t       float32 [rows]     target time
+Rows are written in segments of one .npy file per field, <field>-<segment>.npy, so every
+segment can be memory-mapped; meta.json lists the finished segments.
+Ids are the model's ids; raw_ids.npy, when present, maps them back to the raw item ids.
+'''
+FIELDS = (('pred_ids', np.uint32), ('pred_scores', np.float16), ('targ_e', np.uint32),
+          ('pred_t', np.float32), ('targ_t', np.float32))
+META_FILE = 'meta.json'
+RAW_IDS_FILE = 'raw_ids.npy'
+
+
+def segment_file(path, field, segment):
+    return os.path.join(path, '%s-%05d.npy' % (field, segment))
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+def clear(path):
+    """Remove the files of a store, leaving anything else in the directory"""
+    names = [RAW_IDS_FILE, META_FILE, META_FILE + '.tmp']
+    segment_names = re.compile(r'^(%s)-\d{5}\.npy$' % '|'.join(name for name, _ in FIELDS))
+    for name in os.listdir(path):
+        if name in names or segment_names.match(name):
+            os.remove(os.path.join(path, name))
+
+
+def write_meta(path, meta):
+    with open(os.path.join(path, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.rename(os.path.join(path, META_FILE + '.tmp'), os.path.join(path, META_FILE))
+
+
+def merge(paths, path):
+    """
+    Concatenate closed stores into a new one, in the given order, by moving their segment files,
+    so nothing is copied; the emptied stores are removed.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    meta = {'segments': [], 'rows': 0}
+    for shard in paths:
+        # a store that never got a row has no meta
+        shard_meta = read_meta(shard) if os.path.exists(os.path.join(shard, META_FILE)) else {'segments': []}
+        for segment, rows in enumerate(shard_meta['segments']):
+            for name, _ in FIELDS:
+                os.rename(segment_file(shard, name, segment), segment_file(path, name, len(meta['segments'])))
+            meta['segments'].append(rows)
+            meta['rows'] += rows
+        raw_ids_file = os.path.join(shard, RAW_IDS_FILE)
+        if os.path.exists(raw_ids_file) and not os.path.exists(os.path.join(path, RAW_IDS_FILE)):
+            os.rename(raw_ids_file, os.path.join(path, RAW_IDS_FILE))
+        shutil.rmtree(shard)
+    write_meta(path, meta)
+    return meta
+
+
+class PredictionWriter(object):
+    """
+    Buffers the batches of the eval loop and writes full segments from a background thread,
+    add() only blocks when max_pending batches are already waiting for the disk.
+    An existing store at path is replaced, unless append is set.
+    """
+
+    def __init__(self, path, segment_rows=1000000, raw_ids=None, max_pending=16, append=False):
+        self.path = path
+        self.segment_rows = segment_rows
+        if not os.path.exists(path):
+            os.makedirs(path)
+        elif not append:
+            clear(path)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            self.meta = read_meta(path)
+        else:
+            self.meta = {'segments': [], 'rows': 0}
+        if raw_ids is not None:
+            np.save(os.path.join(path, RAW_IDS_FILE), np.asarray(raw_ids, dtype=np.int64))
+
+        self.pending = dict((name, []) for name, _ in FIELDS)
+        self.pending_rows = 0
+        self.error = None
+        self.batches = queue.Queue(maxsize=max_pending)
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def add(self, top_k_ids, top_k_scores, targ_e, pred_t, targ_t):
+        if self.error is not None:
+            raise self.error
+        k = np.shape(top_k_ids)[-1]
+        self.batches.put({
+            'pred_ids': np.asarray(top_k_ids).reshape(-1, k).astype(np.uint32),
+            'pred_scores': np.asarray(top_k_scores).reshape(-1, k).astype(np.float16),
+            'targ_e': np.asarray(targ_e).reshape(-1).astype(np.uint32),
+            'pred_t': np.asarray(pred_t).reshape(-1).astype(np.float32),
+            'targ_t': np.asarray(targ_t).reshape(-1).astype(np.float32)})
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    self.flush()
+                    return
+                for name, _ in FIELDS:
+                    self.pending[name].append(batch[name])
+                self.pending_rows += len(batch['targ_e'])
+                if self.pending_rows >= self.segment_rows:
+                    self.flush()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.batches.task_done()
+
+    def flush(self):
+        if self.pending_rows == 0:
+            return
+        segment = len(self.meta['segments'])
+        for name, dtype in FIELDS:
+            values = np.concatenate(self.pending[name]).astype(dtype)
+            # write then rename, a reader never sees a partial segment
+            tmp_file = segment_file(self.path, name, segment) + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.save(f, values)
+            os.rename(tmp_file, segment_file(self.path, name, segment))
+            self.pending[name] = []
+        self.meta['segments'].append(self.pending_rows)
+        self.meta['rows'] += self.pending_rows
+        self.pending_rows = 0
+        write_meta(self.path, self.meta)
+
+    def close(self):
+        self.batches.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+
+
+class PredictionReader(object):
+    """Memory-mapped access to the segments of a store"""
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        raw_ids_file = os.path.join(path, RAW_IDS_FILE)
+        self.raw_ids = np.load(raw_ids_file) if os.path.exists(raw_ids_file) else None
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def num_segments(self):
+        return len(self.meta['segments'])
+
+    def segment(self, segment, fields=None):
+        return dict((name, np.load(segment_file(self.path, name, segment), mmap_mode='r'))
+                    for name in (fields or [name for name, _ in FIELDS]))
+
+    def iter_segments(self, fields=None):
+        for segment in range(self.num_segments()):
+            yield self.segment(segment, fields)
+
+    def load(self, field):
+        return np.concatenate([s[field] for s in self.iter_segments([field])])
+
+    def decode(self, ids):
+        """Model ids to raw item ids, -1 for OOV"""
+        if self.raw_ids is None:
+            return np.asarray(ids)
+        return self.raw_ids[np.asarray(ids)]
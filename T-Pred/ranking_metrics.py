@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+'''
+Top-k ranking metrics of the next event prediction, for one target per row:
+MRR@k, Recall@k, Precision@k and NDCG@k for several k at once.
+Everything is derived from the 0-based rank of the target among the top-k predicted ids
+(MAX_K when it is not among them), so only the top-k ids are ever needed, never a sort over the vocabulary.
+The ranks come from the graph (target_ranks_op) or from NumPy prediction dumps (target_ranks),
+and RankingMetrics accumulates them over an epoch.
+'''
+METRIC_KS = (1, 5, 10, 20)
+MAX_K = max(METRIC_KS)
+METRIC_NAMES = ('MRR', 'Recall', 'Precision', 'NDCG')
+
+
+def top_k(scores, k=MAX_K):
+    """The ids of the k highest scores of every row, best first, by partial selection"""
+    scores = np.asarray(scores)
+    scores = scores.reshape(-1, scores.shape[-1])
+    k = min(k, scores.shape[-1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+def target_ranks(top_ids, targets):
+    """
+    :param top_ids: [..., k] predicted ids, best first
+    :param targets: [...] target ids
+    :return: [N] 0-based rank of every target among its top ids, MAX_K if it is not among them
+    """
+    top_ids = np.asarray(top_ids)
+    top_ids = top_ids.reshape(-1, top_ids.shape[-1])
+    hits = top_ids == np.asarray(targets).reshape(-1, 1)
+    return np.where(hits.any(axis=1), hits.argmax(axis=1), MAX_K)
+
+
+def target_ranks_op(top_ids, targets):
+    """The in-graph target_ranks, top_ids from tf.nn.top_k(logits, MAX_K)"""
+    import tensorflow as tf  # only the in-graph ops need TensorFlow
+    top_ids = tf.reshape(tf.cast(top_ids, tf.int64), [-1, MAX_K])
+    hits = tf.equal(top_ids, tf.reshape(tf.cast(targets, tf.int64), [-1, 1]))
+    ranks = tf.argmax(tf.cast(hits, tf.int32), axis=1, output_type=tf.int32)
+    return tf.where(tf.reduce_any(hits, axis=1), ranks, tf.fill(tf.shape(ranks), MAX_K))
+
+
+def metric_sums(ranks, ks=METRIC_KS):
+    """Per-metric sums over the rows of one batch of ranks, keyed like 'MRR@10'"""
+    ranks = np.asarray(ranks)
+    reciprocal = 1. / (ranks + 1.)
+    gain = 1. / np.log2(ranks + 2.)
+    sums = {}
+    for k in ks:
+        hit = ranks < k
+        sums['MRR@%d' % k] = reciprocal[hit].sum()
+        sums['Recall@%d' % k] = hit.sum()
+        sums['Precision@%d' % k] = hit.sum() / k
+        # a single relevant item, so the ideal DCG is 1
+        sums['NDCG@%d' % k] = gain[hit].sum()
+    return sums
+
+
+class RankingMetrics(object):
+    """Streaming accumulator of the ranking metrics, mergeable across batches, splits or processes"""
+
+    def __init__(self, ks=METRIC_KS):
+        self.ks = tuple(ks)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sums = dict.fromkeys(self.names(), 0.)
+
+    def names(self):
+        return ['%s@%d' % (name, k) for name in METRIC_NAMES for k in self.ks]
+
+    def update_ranks(self, ranks):
+        ranks = np.asarray(ranks).reshape(-1)
+        for name, value in metric_sums(ranks, self.ks).items():
+            self.sums[name] += value
+        self.count += len(ranks)
+
+    def update(self, top_ids, targets):
+        self.update_ranks(target_ranks(top_ids, targets))
+
+    def merge(self, other):
+        for name in self.sums:
+            self.sums[name] += other.sums[name]
+        self.count += other.count
+
+    def result(self):
+        return dict((name, value / max(self.count, 1)) for name, value in self.sums.items())
+
+    def __getitem__(self, name):
+        return self.sums[name] / max(self.count, 1)
+
+    def summary(self):
+        return ', '.join('%s: %.5f' % (name, self[name]) for name in self.names())
@@ -2,11 +2,140 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import json
+import argparse
+import collections
 import numpy as np
 import random
 
 
+'''The memory-mapped copy of a trace file pair, written once by convert_to_binary:
+    <prefix>.events.npy   int32   [num_events]      all event ids, trace after trace
+    <prefix>.times.npy    float32 [num_events]      the matching delta times
+    <prefix>.offsets.npy  int64   [num_traces + 1]  trace i is [offsets[i], offsets[i + 1])
+    <prefix>.source.json                     size and mtime of the text files it was converted from
+A copy whose text files have since changed is stale: data_split converts them again.
+'''
+TraceData = collections.namedtuple('TraceData', ['events', 'times', 'offsets', 'index'])
+
+
+def binary_prefix(event_file):
+    return os.path.splitext(event_file)[0]
+
+
+def source_stats(*files):
+    return dict((os.path.basename(f), [os.path.getsize(f), os.path.getmtime(f)]) for f in files)
+
+
+def has_binary(prefix, *source_files):
+    """Whether the memory-mapped copy exists and, for the given text files, was converted from them as they are"""
+    if not all(os.path.exists(prefix + suffix) for suffix in ['.events.npy', '.times.npy', '.offsets.npy']):
+        return False
+    if not source_files:
+        return True
+    if not os.path.exists(prefix + '.source.json'):
+        return False
+    with open(prefix + '.source.json', 'r') as f:
+        converted_from = json.load(f)
+    return all(converted_from.get(name) == stats for name, stats in source_stats(*source_files).items())
+
+
+def _parse_trace(event_trace, time_trace):
+    events = [int(event) for event in event_trace.split('\t') if event not in ('', '[EOS]')]
+    times = [float(time) for time in time_trace.split('\t') if time not in ('', '[EOS]')]
+    if len(events) != len(times):
+        print("The length of data traces and that of time traces are noe equal!")
+        events, times = events[:min(len(events), len(times))], times[:min(len(events), len(times))]
+    return events, times
+
+
+def convert_to_binary(event_file, time_file, prefix=None):
+    """
+    One-time conversion of the tab-separated event/time traces into the flat layout above.
+    The first pass only counts, the second pass fills the pre-allocated .npy files,
+    so the text is never held in memory as a whole.
+    """
+    if prefix is None:
+        prefix = binary_prefix(event_file)
+
+    lengths = []
+    with open(event_file, 'r') as read_event, open(time_file, 'r') as read_time:
+        for event_trace, time_trace in zip(read_event, read_time):
+            events, _ = _parse_trace(event_trace.rstrip('\n'), time_trace.rstrip('\n'))
+            lengths.append(len(events))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    events_out = np.lib.format.open_memmap(prefix + '.events.npy', mode='w+', dtype=np.int32, shape=(int(offsets[-1]),))
+    times_out = np.lib.format.open_memmap(prefix + '.times.npy', mode='w+', dtype=np.float32, shape=(int(offsets[-1]),))
+    with open(event_file, 'r') as read_event, open(time_file, 'r') as read_time:
+        for i, (event_trace, time_trace) in enumerate(zip(read_event, read_time)):
+            events, times = _parse_trace(event_trace.rstrip('\n'), time_trace.rstrip('\n'))
+            events_out[offsets[i]:offsets[i + 1]] = events
+            times_out[offsets[i]:offsets[i + 1]] = times
+    events_out.flush()
+    times_out.flush()
+    del events_out, times_out
+    np.save(prefix + '.offsets.npy', offsets)
+    with open(prefix + '.source.json', 'w') as f:
+        json.dump(source_stats(event_file, time_file), f)
+    print('converted traces: ', len(lengths), 'events: ', int(offsets[-1]))
+    return prefix
+
+
+def load_binary(prefix):
+    events = np.load(prefix + '.events.npy', mmap_mode='r')
+    times = np.load(prefix + '.times.npy', mmap_mode='r')
+    offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+    return events, times, offsets
+
+
+def data_split_binary(prefix, shuffle=True):
+    """The same 1 : 8 : 1 test/train/valid split as data_split, over trace indices of the memmap."""
+    num_pieces = 10
+    events, times, offsets = load_binary(prefix)
+    nrow = len(offsets) - 1
+    print('length of traces: ', nrow)
+
+    data_size = nrow // num_pieces
+    index4train = np.arange(data_size, nrow)
+    if shuffle:
+        np.random.shuffle(index4train)
+
+    train_data = TraceData(events, times, offsets, index4train[:8 * data_size])
+    valid_data = TraceData(events, times, offsets, index4train[8 * data_size:-1])
+    test_data = TraceData(events, times, offsets, np.arange(data_size))
+    return train_data, valid_data, test_data
+
+
+def iter_traces(input_data):
+    """Yield the (events, times) arrays of every trace, from either split format."""
+    if isinstance(input_data, TraceData):
+        for i in input_data.index:
+            begin, end = input_data.offsets[i], input_data.offsets[i + 1]
+            yield input_data.events[begin:end], input_data.times[begin:end]
+    else:
+        for event_trace, time_trace in input_data:
+            events = np.array([int(event) for event in event_trace.split('\t') if event != ''], dtype=np.int32)
+            times = np.array([float(time) for time in time_trace.split('\t') if time != ''], dtype=np.float32)
+            yield events, times
+
+
+def num_traces(input_data):
+    if isinstance(input_data, TraceData):
+        return len(input_data.index)
+    return len(input_data)
+
+
 def data_split(event_file=None, time_file=None, shuffle=True):
+    prefix = binary_prefix(event_file)
+    if has_binary(prefix):
+        if not has_binary(prefix, event_file, time_file):
+            print('the trace files changed since their memory-mapped copy was written, converting them again')
+            convert_to_binary(event_file, time_file, prefix)
+        return data_split_binary(prefix, shuffle)
+
     num_pieces = 10
     read_event = open(event_file, "r")
     event_traces = read_event.read().split('\n')
@@ -43,61 +172,132 @@ def data_split(event_file=None, time_file=None, shuffle=True):
     return train_data, valid_data, test_data
 
 
-def data_iterator(input_data, num_steps, length, overlap=True):
-    input_len_sum = 0
-    input_event_data = []
-    target_event_data = []
-    input_time_data = []
-    target_time_data = []
-    print("length of traces: " + str(len(input_data)))  # 9320
-
-    for event_trace, time_trace in input_data:
-        events = np.array([int(event) for event in event_trace.split('\t') if event != ''], dtype=np.int32)
-        times = np.array([float(time) for time in time_trace.split('\t') if time != ''], dtype=np.float32)
-        data_len = len(events)
-        time_len = len(times)
-        # print('length of items in event and time sequence: ', data_len, time_len)
+class WindowColumn(object):
+    """
+    One column (input events, target events, input times or target times) of the sliding windows.
+    Only the start position of every window in the flat array is kept; the rows are gathered
+    with fancy indexing when the column is indexed, i.e. when a batch is assembled.
+    """
 
-        if data_len != time_len:
+    def __init__(self, flat, starts, begin, width):
+        self.flat = flat
+        self.starts = starts
+        self.begin = begin
+        self.width = width
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, item):
+        positions = np.asarray(self.starts[item]) + self.begin
+        return self.flat[positions[..., None] + np.arange(self.width)]
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype)
+
+
+def flatten_data(input_data):
+    """Return flat events, flat times and per-trace (begin, length) of a split, without copying a memmap."""
+    if isinstance(input_data, TraceData):
+        begins = np.asarray(input_data.offsets[input_data.index], dtype=np.int64)
+        lengths = np.asarray(input_data.offsets[input_data.index + 1], dtype=np.int64) - begins
+        return input_data.events, input_data.times, begins, lengths
+
+    event_list, time_list = [], []
+    for events, times in iter_traces(input_data):
+        if len(events) != len(times):
             print("The length of data traces and that of time traces are noe equal!")
+            events, times = events[:min(len(events), len(times))], times[:min(len(events), len(times))]
+        event_list.append(events)
+        time_list.append(times)
+    lengths = np.array([len(events) for events in event_list], dtype=np.int64)
+    begins = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    events = np.concatenate(event_list + [np.zeros(0, dtype=np.int32)])
+    times = np.concatenate(time_list + [np.zeros(0, dtype=np.float32)])
+    return events, times, begins, lengths
 
-        if overlap:
-            input_len = data_len - (num_steps + length)
-            if input_len > 1:
-                for i in range(input_len):
-                    input_event_elem = events[i: i + num_steps]
-                    target_event_elem = events[i + num_steps: i + num_steps + length]
-                    input_time_elem = times[i: i + num_steps]
-                    target_time_elem = times[i + num_steps: i + num_steps + length]
-                    input_event_data.append(input_event_elem)
-                    target_event_data.append(target_event_elem)
-                    input_time_data.append(input_time_elem)
-                    target_time_data.append(target_time_elem)
-                input_len_sum += input_len
-            else:
-                pass
-            # print("the trace is too short")
-        else:
-            input_len = (data_len - 1) // (num_steps + length)
-            seg_length = num_steps + length
-            if input_len > 0:
-                for i in range(input_len):
-                    input_event_elem = events[i * seg_length: i * seg_length + num_steps]
-                    target_event_elem = events[i * seg_length + num_steps: (i + 1) * seg_length]
-                    input_time_elem = times[i * seg_length: i * seg_length + num_steps]
-                    target_time_elem = times[i * seg_length + num_steps: (i + 1) * seg_length]
-                    input_event_data.append(input_event_elem)
-                    target_event_data.append(target_event_elem)
-                    input_time_data.append(input_time_elem)
-                    target_time_data.append(target_time_elem)
-                input_len_sum += input_len
-            else:
-                pass
-            # print("the trace is too short")
 
+def window_counts(lengths, num_steps, length, overlap=True):
+    """The number of windows cut from traces of the given lengths."""
+    if overlap:
+        counts = np.asarray(lengths, dtype=np.int64) - (num_steps + length)
+        counts[counts <= 1] = 0
+    else:
+        counts = (np.asarray(lengths, dtype=np.int64) - 1) // (num_steps + length)
+        counts[counts <= 0] = 0
+    return counts
+
+
+def window_starts(begins, lengths, num_steps, length, overlap=True):
+    """The position in the flat arrays of every window, trace after trace."""
+    counts = window_counts(lengths, num_steps, length, overlap)
+    step = 1 if overlap else num_steps + length
+    trace_of_window = np.repeat(np.arange(len(counts)), counts)
+    first_window = np.cumsum(counts) - counts
+    return begins[trace_of_window] + (np.arange(len(trace_of_window)) - first_window[trace_of_window]) * step
+
+
+def data_iterator(input_data, num_steps, length, overlap=True):
+    """
+    Cut the traces into windows of num_steps inputs followed by length targets.
+    The four returned columns share the flat event/time arrays and only hold one start
+    position per window, so memory is O(number of windows) instead of O(windows * num_steps).
+    """
+    print("length of traces: " + str(num_traces(input_data)))  # 9320
+
+    events, times, begins, lengths = flatten_data(input_data)
+    starts = window_starts(begins, lengths, num_steps, length, overlap)
+
+    input_event_data = WindowColumn(events, starts, 0, num_steps)
+    target_event_data = WindowColumn(events, starts, num_steps, length)
+    input_time_data = WindowColumn(times, starts, 0, num_steps)
+    target_time_data = WindowColumn(times, starts, num_steps, length)
     return input_event_data, target_event_data, input_time_data, target_time_data
 
 
+class BatchPlan(object):
+    """
+    The batches of one split: the windows are cut once, the batch count is known up front,
+    and every call of epoch() replays them in a fresh permutation when shuffle is on.
+    encode, if given, maps the raw event ids of every batch, e.g. vocab.Vocabulary.encode.
+    """
+
+    def __init__(self, input_data, num_steps, length, batch_size, overlap=True, shuffle=True, encode=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.encode = encode
+        self.input_event_data, self.target_event_data, self.input_time_data, self.target_time_data = \
+            data_iterator(input_data, num_steps, length, overlap)
+
+    def __len__(self):
+        return len(self.input_event_data) // self.batch_size
+
+    def num_windows(self):
+        return len(self.input_event_data)
+
+    def epoch_indices(self):
+        if self.shuffle:
+            order = np.random.permutation(self.num_windows())
+        else:
+            order = np.arange(self.num_windows())
+        for i in range(len(self)):
+            yield order[i * self.batch_size:(i + 1) * self.batch_size]
+
+    def gather(self, selected):
+        input_events, target_events = self.input_event_data[selected], self.target_event_data[selected]
+        if self.encode is not None:
+            input_events, target_events = self.encode(input_events), self.encode(target_events)
+        return input_events, target_events, self.input_time_data[selected], self.target_time_data[selected]
+
+    def epoch(self):
+        for selected in self.epoch_indices():
+            yield self.gather(selected)
+
+    def sample_t(self):
+        return generate_sample_t(self.batch_size, self.input_time_data, self.target_time_data)
+
+
 def generate_batch(batch_size, input_event_data, target_event_data, input_time_data, target_time_data):
     batch_num = len(input_event_data) // batch_size
     for i in range(batch_num):
@@ -109,19 +309,16 @@ def generate_batch(batch_size, input_event_data, target_event_data, input_time_d
 
 
 def generate_sample_t(batch_size, input_time_data, target_time_data):
+    if isinstance(input_time_data, WindowColumn):
+        selected = random.sample(range(len(input_time_data)), batch_size)
+        return np.concatenate([input_time_data[selected], target_time_data[selected]], axis=1)
     t_list = np.concatenate([input_time_data, target_time_data], axis=1)
     return random.sample(list(t_list), batch_size)
 
 
 def batch_count(input_data, num_steps, length, batch_size, overlap=True):
     input_len_sum = 0
-    for event_trace, time_trace in input_data:
-        if event_trace == '':
-            print('---------null trace--------')
-            events = times = None
-        else:
-            events = np.array([int(event) for event in event_trace.split('\t')], dtype=np.int32)
-            times = np.array([float(time) for time in time_trace.split('\t')], dtype=np.float32)
+    for events, times in iter_traces(input_data):
         data_len = len(events)
         time_len = len(times)
 
@@ -137,3 +334,162 @@ def batch_count(input_data, num_steps, length, batch_size, overlap=True):
             if input_len > 0:
                 input_len_sum += input_len
     return input_len_sum // batch_size
+
+
+
+def index_chunks(event_file, time_file, chunk_size=10000):
+    """
+    One pass over both trace files that records where every chunk of chunk_size lines starts.
+    Returns [(event_pos, time_pos, num_lines)]; memory is O(number of chunks).
+    """
+    chunks = []
+    with open(event_file, 'rb') as read_event, open(time_file, 'rb') as read_time:
+        event_pos, time_pos, num_lines = 0, 0, 0
+        for event_trace, time_trace in zip(read_event, read_time):
+            num_lines += 1
+            if num_lines == chunk_size:
+                chunks.append((event_pos, time_pos, num_lines))
+                event_pos, time_pos, num_lines = read_event.tell(), read_time.tell(), 0
+        if num_lines > 0:
+            chunks.append((event_pos, time_pos, num_lines))
+    return chunks
+
+
+def read_chunk(event_file, time_file, chunk):
+    """The (event_trace, time_trace) lines of one chunk, in the format returned by data_split."""
+    event_pos, time_pos, num_lines = chunk
+    with open(event_file, 'rb') as read_event, open(time_file, 'rb') as read_time:
+        read_event.seek(event_pos)
+        read_time.seek(time_pos)
+        return [(read_event.readline().decode().rstrip('\n'), read_time.readline().decode().rstrip('\n'))
+                for _ in range(num_lines)]
+
+
+class StreamPlan(object):
+    """
+    The out-of-core counterpart of BatchPlan.
+    The trace files are read one chunk at a time in a fresh chunk order per epoch, and the windows
+    pass through a shuffle buffer of at most buffer_size windows before they are batched.
+    Nothing but the current chunk and the buffer is held in memory, whatever the size of the dataset.
+    """
+
+    def __init__(self, event_file, time_file, chunks, num_steps, length, batch_size, overlap=True, shuffle=True,
+                 buffer_size=100000, encode=None):
+        self.encode = encode
+        self.event_file = event_file
+        self.time_file = time_file
+        self.chunks = chunks
+        self.num_steps = num_steps
+        self.length = length
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, 2 * batch_size)
+        self._len = None
+
+    def __len__(self):
+        """Counts the windows without parsing a single token, once."""
+        if self._len is None:
+            num_windows = 0
+            for chunk in self.chunks:
+                lengths = [min(len([e for e in event_trace.split('\t') if e not in ('', '[EOS]')]),
+                               len([t for t in time_trace.split('\t') if t not in ('', '[EOS]')]))
+                           for event_trace, time_trace in read_chunk(self.event_file, self.time_file, chunk)]
+                num_windows += int(np.sum(window_counts(lengths, self.num_steps, self.length, self.overlap)))
+            self._len = num_windows // self.batch_size
+        return self._len
+
+    def chunk_windows(self, chunk):
+        """All windows of one chunk as two [num_windows, num_steps + length] arrays."""
+        input_data = [_parse_trace(event_trace, time_trace)
+                      for event_trace, time_trace in read_chunk(self.event_file, self.time_file, chunk)]
+        lengths = np.array([len(events) for events, _ in input_data], dtype=np.int64)
+        events = np.array([e for trace, _ in input_data for e in trace], dtype=np.int32)
+        times = np.array([t for _, trace in input_data for t in trace], dtype=np.float32)
+        begins = np.cumsum(lengths) - lengths
+        starts = window_starts(begins, lengths, self.num_steps, self.length, self.overlap)
+        positions = starts[:, None] + np.arange(self.num_steps + self.length)
+        return events[positions], times[positions]
+
+    def split(self, events, times):
+        if self.encode is not None:
+            events = self.encode(events)
+        return events[:, :self.num_steps], events[:, self.num_steps:], \
+            times[:, :self.num_steps], times[:, self.num_steps:]
+
+    def epoch(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.chunks))
+        else:
+            order = np.arange(len(self.chunks))
+
+        buffer_events, buffer_times = [], []
+        buffered = 0
+        for c in order:
+            events, times = self.chunk_windows(self.chunks[c])
+            buffer_events.append(events)
+            buffer_times.append(times)
+            buffered += len(events)
+            if buffered < self.buffer_size:
+                continue
+
+            events, times = np.concatenate(buffer_events), np.concatenate(buffer_times)
+            if self.shuffle:
+                permutation = np.random.permutation(buffered)
+                events, times = events[permutation], times[permutation]
+            # emit about half of the buffer, keep the rest to mix with the next chunks
+            emit = (buffered // 2) // self.batch_size * self.batch_size
+            for i in range(0, emit, self.batch_size):
+                yield self.split(events[i:i + self.batch_size], times[i:i + self.batch_size])
+            buffer_events, buffer_times = [events[emit:]], [times[emit:]]
+            buffered -= emit
+
+        if buffered > 0:
+            events, times = np.concatenate(buffer_events), np.concatenate(buffer_times)
+            if self.shuffle:
+                permutation = np.random.permutation(buffered)
+                events, times = events[permutation], times[permutation]
+            for i in range(0, buffered // self.batch_size * self.batch_size, self.batch_size):
+                yield self.split(events[i:i + self.batch_size], times[i:i + self.batch_size])
+
+    def sample_t(self):
+        """generate_sample_t over the windows of randomly picked chunks."""
+        sample = []
+        for c in np.random.permutation(len(self.chunks)):
+            _, times = self.chunk_windows(self.chunks[c])
+            sample.extend(times)
+            if len(sample) >= self.batch_size:
+                break
+        return np.array(random.sample(sample, self.batch_size))
+
+
+def stream_split(event_file, time_file, num_steps, length, batch_size, chunk_size=10000, buffer_size=100000,
+                 shuffle=True, encode=None):
+    """
+    The 1 : 8 : 1 test/train/valid split of data_split at chunk granularity, as StreamPlans.
+    The first tenth of the chunks is the test set, the rest is shuffled into train and valid.
+    """
+    num_pieces = 10
+    chunks = index_chunks(event_file, time_file, chunk_size)
+    print('number of chunks: ', len(chunks))
+
+    data_size = max(len(chunks) // num_pieces, 1)
+    chunks4train = chunks[data_size:]
+    if shuffle:
+        random.shuffle(chunks4train)
+
+    def plan(plan_chunks, shuffle_windows):
+        return StreamPlan(event_file, time_file, plan_chunks, num_steps, length, batch_size,
+                          shuffle=shuffle_windows, buffer_size=buffer_size, encode=encode)
+
+    return {'train': plan(chunks4train[:8 * data_size], True),
+            'valid': plan(chunks4train[8 * data_size:], False),
+            'test': plan(chunks[:data_size], False)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert event/time traces into the memory-mapped layout')
+    parser.add_argument('event_file', type=str)
+    parser.add_argument('time_file', type=str)
+    parser.add_argument('--prefix', default=None, type=str)
+    args = parser.parse_args()
+    convert_to_binary(args.event_file, args.time_file, args.prefix)
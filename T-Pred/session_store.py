@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import argparse
+import threading
+import collections
+import numpy as np
+import vocab
+import numpy_infer
+
+'''
+Per-session state for online prediction on top of numpy_infer.NumpyT_Pred.
+Each session (user or session id) keeps the NumpyT_Pred.step() state: the recurrent state of the
+event encoder, its self-attention cache and the window of times, so a new event costs one GRU step
+and one attention row (observe) and a prediction runs the time branch and the heads over the
+cached window (predict), never a re-encode of the events. That recurrent state carries over the whole
+session, so its predictions drift from predict() on the same window; with exact=True every observe
+re-encodes the window from a zero state instead (num_steps GRU steps) and the two agree.
+Sessions are evicted least recently used first, to stay under max_bytes and max_sessions.
+observe() takes what a request to predict_server does: a raw id (encoded with the vocabulary of a
+compact-vocabulary export) and the inter-event time, fed to the model as np.maximum(np.log(t), 0).
+usage: python session_store.py exported --sessions 10000 --events 100000 [--exact]
+'''
+
+
+class SessionStore(object):
+    def __init__(self, model, max_bytes=256 * 2 ** 20, max_sessions=0, exact=False):
+        """
+        :param model: a numpy_infer.NumpyT_Pred
+        :param max_bytes: cap of the summed state sizes
+        :param max_sessions: cap of the number of sessions, 0 for none
+        :param exact: re-encode the window on every observe, see NumpyT_Pred.step
+        """
+        self.model = model
+        self.exact = exact
+        self.encode = None
+        if model.raw_ids is not None:
+            self.encode = vocab.Vocabulary(model.raw_ids, np.zeros(len(model.raw_ids))).encode
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.states = collections.OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, session_id):
+        return session_id in self.states
+
+    def get(self, session_id):
+        """The state of a session, a new one if it is unknown or was evicted; marks it most recently used"""
+        state = self.states.pop(session_id, None)
+        if state is None:
+            state = self.model.new_state(self.exact)
+            self.bytes += numpy_infer.state_bytes(state)
+        self.states[session_id] = state
+        return state
+
+    def evict(self):
+        while self.states and (self.bytes > self.max_bytes or 0 < self.max_sessions < len(self.states)):
+            _, state = self.states.popitem(last=False)
+            self.bytes -= numpy_infer.state_bytes(state)
+            self.evictions += 1
+
+    def observe(self, session_id, event, t):
+        """:param event: a raw id, :param t: the time since the previous event"""
+        if self.encode is not None:
+            event = self.encode(np.array([event], dtype=np.int64))[0]
+        with np.errstate(divide='ignore'):
+            dt = np.maximum(np.log(t), 0)
+        with self.lock:
+            self.model.step(self.get(session_id), event, dt)
+            self.evict()
+
+    def reset(self, session_id):
+        with self.lock:
+            state = self.states.pop(session_id, None)
+            if state is not None:
+                self.bytes -= numpy_infer.state_bytes(state)
+
+    def predict(self, session_ids, k=10):
+        """
+        The next event and time of several sessions in one batch.
+        Sessions never observed, or evicted, are not predicted from an empty history: their rows have
+        ids -1 and times NaN and known is False.
+        :return: top-k ids [N, length, k], predicted times [N, length, 1], the observed events per session
+        and known [N]
+        """
+        with self.lock:
+            # copies of what predict_states reads, so observe() does not wait for the prediction
+            snapshots, counts = [], np.zeros(len(session_ids), dtype=np.int64)
+            for i, session_id in enumerate(session_ids):
+                state = self.states.pop(session_id, None)
+                if state is None:
+                    snapshots.append(None)
+                    continue
+                self.states[session_id] = state
+                counts[i] = state['count']
+                snapshots.append(dict((name, state[name].copy()) for name in ('scores', 'v', 'times')))
+        known = np.array([snapshot is not None for snapshot in snapshots], dtype=bool)
+
+        k = min(k, self.model.vocab_size)
+        ids = np.full((len(session_ids), self.model.length, k), -1, dtype=np.int64)
+        times = np.full((len(session_ids), self.model.length, 1), np.nan, dtype=np.float32)
+        if known.any():
+            pred_e, pred_t, _ = self.model.predict_states([snapshot for snapshot in snapshots if snapshot is not None])
+            ids[known], times[known] = self.model.top_k(pred_e, pred_t, k)
+        return ids, times, counts, known
+
+    def drift(self, session_ids):
+        """The max |difference| of the event logits of the sessions from predict() on their windows"""
+        with self.lock:
+            states = [numpy_infer.copy_state(self.states[s]) for s in session_ids if s in self.states]
+        if not states:
+            return 0.
+        pred_e, _, _ = self.model.predict_states(states)
+        expected, _, _ = self.model.predict(np.stack([s['events'] for s in states]),
+                                            np.stack([s['times'] for s in states]))
+        return float(np.abs(pred_e - expected).max())
+
+    def stats(self):
+        return {'sessions': len(self.states), 'bytes': self.bytes, 'evictions': self.evictions}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='export_numpy.py output')
+    parser.add_argument('--sessions', default=10000, type=int)
+    parser.add_argument('--events', default=100000, type=int)
+    parser.add_argument('--max_mb', default=256, type=int)
+    parser.add_argument('--exact', default=False, action='store_true', help='re-encode the window on every event')
+    args = parser.parse_args()
+
+    model = numpy_infer.NumpyT_Pred.load(args.path)
+    store = SessionStore(model, args.max_mb * 2 ** 20, exact=args.exact)
+    session_ids = np.random.randint(0, args.sessions, args.events)
+    events = np.random.randint(0, model.vocab_size, args.events)
+    times = np.abs(np.random.randn(args.events)).astype(np.float32)
+
+    start = time.time()
+    for session_id, event, t in zip(session_ids, events, times):
+        store.observe(session_id, event, t)
+    elapsed = time.time() - start
+    print('observe: %.1f us per event' % (1e6 * elapsed / args.events))
+
+    start = time.time()
+    store.predict(session_ids[-100:])
+    print('predict: %.2f ms for 100 sessions' % (1e3 * (time.time() - start)))
+    print('max |logit drift| from predict() on the same windows: %g' % store.drift(session_ids[-100:]))
+    print(store.stats())
+
+
+if __name__ == '__main__':
+    main()
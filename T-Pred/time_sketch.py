@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+'''
+Constant-memory summaries of the predicted and target inter-event times.
+TimeSketch is a histogram over log-spaced bins between min_value and max_value, plus one bin
+below and one above. Any quantile read from it is within a relative error of half a bin width
+(about 2.3% with the default 50 bins per decade). Sketches with the same bins merge by adding counts,
+so they can be built per batch, per process or per file and combined.
+'''
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+
+class TimeSketch(object):
+    def __init__(self, min_value=1e-2, max_value=1e8, bins_per_decade=50):
+        self.min_value = float(min_value)
+        self.max_value = float(max_value)
+        self.bins_per_decade = int(bins_per_decade)
+        num_bins = int(round(np.log10(self.max_value / self.min_value) * self.bins_per_decade))
+        self.edges = np.logspace(np.log10(self.min_value), np.log10(self.max_value), num_bins + 1)
+        # counts[0] is below min_value (zeros included), counts[-1] from max_value up
+        self.counts = np.zeros(num_bins + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        self.counts += np.bincount(np.searchsorted(self.edges, values, side='right'), minlength=len(self.counts))
+        self.count += len(values)
+        self.total += values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def compatible(self, other):
+        return (self.min_value, self.max_value, self.bins_per_decade) == \
+            (other.min_value, other.max_value, other.bins_per_decade)
+
+    def merge(self, other):
+        if not self.compatible(other):
+            raise ValueError('Cannot merge sketches with different bins')
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def mean(self):
+        return self.total / max(self.count, 1)
+
+    def quantile(self, q):
+        """Estimated quantiles, interpolated geometrically inside the bin and clipped to the seen range"""
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        if self.count == 0:
+            return np.full(len(q), np.nan)
+        cumulative = np.cumsum(self.counts)
+        rank = q * (self.count - 1)
+        b = np.searchsorted(cumulative, rank, side='right')
+        below = np.where(b > 0, cumulative[np.maximum(b - 1, 0)], 0)
+        fraction = (rank - below + 0.5) / np.maximum(self.counts[b], 1)
+        lower = self.edges[np.clip(b - 1, 0, len(self.edges) - 1)]
+        upper = self.edges[np.clip(b, 0, len(self.edges) - 1)]
+        values = lower * np.power(upper / lower, np.clip(fraction, 0., 1.))
+        # the outer bins have no finite bounds, fall back to the extremes
+        values = np.where(b == 0, self.min, np.where(b == len(self.counts) - 1, self.max, values))
+        values = np.where(q >= 1, self.max, np.where(q <= 0, self.min, values))
+        return np.clip(values, self.min, self.max)
+
+    def density(self):
+        """(edges, density) of the inner bins, for plotting"""
+        widths = np.diff(self.edges)
+        return self.edges, self.counts[1:-1] / (max(self.count, 1) * widths)
+
+    def to_dict(self, prefix=''):
+        return {prefix + 'params': np.array([self.min_value, self.max_value, self.bins_per_decade]),
+                prefix + 'counts': self.counts,
+                prefix + 'stats': np.array([self.count, self.total, self.min, self.max])}
+
+    @classmethod
+    def from_dict(cls, data, prefix=''):
+        min_value, max_value, bins_per_decade = data[prefix + 'params']
+        sketch = cls(min_value, max_value, int(bins_per_decade))
+        sketch.counts = np.array(data[prefix + 'counts'], dtype=np.int64)
+        count, sketch.total, sketch.min, sketch.max = data[prefix + 'stats']
+        sketch.count = int(count)
+        return sketch
+
+
+class TimeSketches(object):
+    """The sketches of the predicted times, the target times and the absolute errors of one evaluation"""
+    NAMES = ('pred_t', 'targ_t', 'error_t')
+
+    def __init__(self, **kwargs):
+        self.sketches = dict((name, TimeSketch(**kwargs)) for name in self.NAMES)
+
+    def __getitem__(self, name):
+        return self.sketches[name]
+
+    def update(self, pred_t, targ_t):
+        pred_t = np.asarray(pred_t, dtype=np.float64).reshape(-1)
+        targ_t = np.asarray(targ_t, dtype=np.float64).reshape(-1)
+        n = min(len(pred_t), len(targ_t))
+        self.sketches['pred_t'].update(pred_t)
+        self.sketches['targ_t'].update(targ_t)
+        self.sketches['error_t'].update(np.abs(pred_t[:n] - targ_t[:n]))
+
+    def merge(self, other):
+        for name in self.NAMES:
+            self.sketches[name].merge(other.sketches[name])
+        return self
+
+    def save(self, path):
+        data = {}
+        for name in self.NAMES:
+            data.update(self.sketches[name].to_dict(name + '.'))
+        np.savez(path, **data)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        sketches = cls()
+        sketches.sketches = dict((name, TimeSketch.from_dict(data, name + '.')) for name in cls.NAMES)
+        return sketches
+
+    def report(self, quantiles=QUANTILES):
+        """Quantiles of the predicted vs the target times, and of the absolute error"""
+        pred_t = self.sketches['pred_t'].quantile(quantiles)
+        targ_t = self.sketches['targ_t'].quantile(quantiles)
+        error_t = self.sketches['error_t'].quantile(quantiles)
+        lines = ['quantile\tpred_t\ttarg_t\tratio\tabs_error']
+        for q, p, t, e in zip(quantiles, pred_t, targ_t, error_t):
+            lines.append('%g\t%.3f\t%.3f\t%.3f\t%.3f' % (q, p, t, p / t if t > 0 else np.nan, e))
+        lines.append('mean\t%.3f\t%.3f\t\t%.3f' % (
+            self.sketches['pred_t'].mean(), self.sketches['targ_t'].mean(), self.sketches['error_t'].mean()))
+        return '\n'.join(lines)
@@ -1,10 +1,15 @@
 import os
+import re
+import json
+import logging
 import numpy as np
 import tensorflow as tf
 from RNN_Cell import T_GRUCell
 from RNN_Cell import GRUCell
 from RNN_Cell import T_LSTMCell
 from RNN_Cell import LSTMCell
+from RNN_Cell import FusedT_GRUCell
+from RNN_Cell import FusedT_LSTMCell
 
 _default_weightnorm = False
 
@@ -101,6 +106,99 @@ def build_rnn_graph_decoder2(hidden_r, num_layers, hidden_size, batch_size, leng
     return outputs
 
 
+def _stacked_gru_params(name, num_gen, input_dim, hidden_size):
+    '''
+    GRU weights of num_gen generators stacked on the first axis, split into the input and the recurrent part.
+    Initialized like GRUBlockCellV2: glorot uniform kernels, 1.0 for the reset/update biases.
+    '''
+    with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+        stdev = np.sqrt(6. / (input_dim + hidden_size + 2 * hidden_size))
+        init = tf.random_uniform_initializer(-stdev, stdev)
+        w_x = tf.get_variable('W_x', [num_gen, input_dim, 3 * hidden_size], initializer=init)
+        w_h = tf.get_variable('W_h', [num_gen, hidden_size, 3 * hidden_size], initializer=init)
+        b = tf.get_variable('b', initializer=tf.concat(
+            [tf.ones([num_gen, 2 * hidden_size]), tf.zeros([num_gen, hidden_size])], 1))
+    return w_x, w_h, b
+
+
+def _stacked_gru_step(x_proj, state, w_h, hidden_size):
+    '''
+    One GRU step of every generator, x_proj = x W_x + b is [num_gen, N, 3 * hidden_size]
+    and state is [num_gen, N, hidden_size]; a single batched matmul covers all generators.
+    '''
+    w_ru, w_c = w_h[:, :, :2 * hidden_size], w_h[:, :, 2 * hidden_size:]
+    ru = tf.sigmoid(x_proj[:, :, :2 * hidden_size] + tf.matmul(state, w_ru))
+    r, u = tf.split(ru, 2, axis=2)
+    c = tf.tanh(x_proj[:, :, 2 * hidden_size:] + tf.matmul(r * state, w_c))
+    return u * state + (1. - u) * c
+
+
+def _stacked_decoder(hidden_r, params, hidden_size, length):
+    '''
+    hidden_r [num_gen, N, input_dim] is the input of every timestep (as in build_rnn_graph_decoder1),
+    so its projection into the first layer is computed once instead of length times.
+    :return: [num_gen, N, length, hidden_size]
+    '''
+    batch = tf.shape(hidden_r)[1]
+    x_projs = [tf.matmul(hidden_r, params[0][0]) + tf.expand_dims(params[0][2], 1)]
+    states = [tf.zeros(tf.stack([tf.shape(w_h)[0], batch, hidden_size])) for _, w_h, _ in params]
+    outputs = []
+    for _ in range(length):
+        for layer, (w_x, w_h, b) in enumerate(params):
+            x_proj = x_projs[0] if layer == 0 else tf.matmul(states[layer - 1], w_x) + tf.expand_dims(b, 1)
+            states[layer] = _stacked_gru_step(x_proj, states[layer], w_h, hidden_size)
+        outputs.append(states[-1])
+    return tf.stack(outputs, 2)
+
+
+def build_stacked_decoder(hidden_r, num_layers, hidden_size, num_gen, length, name, gen_ids=None):
+    '''
+    num_gen decoders of the build_rnn_graph_decoder1 form with their weights stacked,
+    so one graph serves all generators instead of num_gen copies.
+    hidden_r: [N, input_dim], the same input for every generator
+    gen_ids:  None to run all generators, returns [num_gen, N, length, hidden_size];
+              or the [N] generator of each example, returns [N, length, hidden_size] and only
+              evaluates that generator per example (the examples are partitioned by generator).
+    '''
+    input_dim = int(hidden_r.get_shape()[-1])
+    with tf.variable_scope(name):
+        params = [_stacked_gru_params('Layer%d' % layer, num_gen, input_dim if layer == 0 else hidden_size,
+                                      hidden_size) for layer in range(num_layers)]
+
+    if gen_ids is None:
+        return _stacked_decoder(tf.tile(tf.expand_dims(hidden_r, 0), [num_gen, 1, 1]), params, hidden_size, length)
+
+    gen_ids = tf.cast(gen_ids, tf.int32)
+    rows = tf.dynamic_partition(tf.range(tf.shape(hidden_r)[0]), gen_ids, num_gen)
+    inputs = tf.dynamic_partition(hidden_r, gen_ids, num_gen)
+    outputs = []
+    for i in range(num_gen):
+        gen_params = [(w_x[i:i + 1], w_h[i:i + 1], b[i:i + 1]) for w_x, w_h, b in params]
+        outputs.append(_stacked_decoder(tf.expand_dims(inputs[i], 0), gen_params, hidden_size, length)[0])
+    return tf.dynamic_stitch(rows, outputs)
+
+
+def stacked_linear(name, num_gen, input_dim, output_dim, inputs, gen_ids=None):
+    '''
+    num_gen linear layers with stacked weights, glorot initialized like linear.
+    inputs: [num_gen, ..., input_dim] when gen_ids is None,
+            otherwise [N, ..., input_dim] and gen_ids [N] picks the layer of each row
+    '''
+    with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+        stdev = np.sqrt(2. / (input_dim + output_dim)) * np.sqrt(3)
+        weight = tf.get_variable('W', [num_gen, input_dim, output_dim],
+                                 initializer=tf.random_uniform_initializer(-stdev, stdev))
+        bias = tf.get_variable('b', [num_gen, output_dim], initializer=tf.zeros_initializer())
+    if gen_ids is not None:
+        # output_dim is small, the per-row weights stay cheap
+        weight = tf.gather(weight, gen_ids)
+        bias = tf.gather(bias, gen_ids)
+    shape = tf.shape(inputs)
+    flat = tf.reshape(inputs, [shape[0], -1, input_dim])
+    result = tf.matmul(flat, weight) + tf.expand_dims(bias, 1)
+    return tf.reshape(result, tf.concat([shape[:-1], [output_dim]], 0))
+
+
 def build_encoder_graph_t(cell_type, inputs, t, hidden_size, num_layers, batch_size, num_steps, keep_prob, is_training,
                           name):
     def make_cell():
@@ -114,6 +212,17 @@ def build_encoder_graph_t(cell_type, inputs, t, hidden_size, num_layers, batch_s
                 hidden_size,
                 reuse=not is_training,
                 name='T_LSTMCell')
+        # same variable names as the unfused cells, checkpoints load into either
+        if cell_type == 'FusedT_GRUCell':
+            cell = FusedT_GRUCell(
+                hidden_size,
+                reuse=not is_training,
+                name='T_GRUCell')
+        if cell_type == 'FusedT_LSTMCell':
+            cell = FusedT_LSTMCell(
+                hidden_size,
+                reuse=not is_training,
+                name='T_LSTMCell')
         if is_training and keep_prob < 1:
             cell = tf.contrib.rnn.DropoutWrapper(cell,
                                                  output_keep_prob=keep_prob)
@@ -226,9 +335,12 @@ def linear(
         biases=True,
         initialization=None,
         weightnorm=None,
-        gain=1.):
+        gain=1.,
+        class_major=False):
     """
     initialization: None, `lecun`, 'glorot', `he`, 'glorot_he', `orthogonal`, `("uniform", range)`
+    class_major: keep the weight as W_t [output_dim, input_dim], one row per output class, so the rows
+    gathered by a sampled loss get sparse (IndexedSlices) gradients
     """
     with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
 
@@ -296,6 +408,20 @@ def linear(
 
         weight_values *= gain
 
+        if class_major:
+            weight = tf.get_variable('W_t', initializer=tf.transpose(weight_values))
+            if weightnorm == None:
+                weightnorm = _default_weightnorm
+            if weightnorm:
+                target_norms = tf.get_variable('g', initializer=tf.norm(weight_values, axis=0))
+                weight = weight * tf.expand_dims(target_norms / tf.norm(weight, axis=1), 1)
+            result = tf.matmul(tf.reshape(inputs, [-1, input_dim]), weight, transpose_b=True)
+            if inputs.get_shape().ndims != 2:
+                result = tf.reshape(result, tf.stack(tf.unstack(tf.shape(inputs))[:-1] + [output_dim]))
+            if biases:
+                result = tf.nn.bias_add(result, tf.get_variable('b', initializer=tf.zeros(output_dim)))
+            return result
+
         weight = tf.get_variable('W', initializer=weight_values)
 
         if weightnorm == None:
@@ -324,4 +450,241 @@ def linear(
         if biases:
             bias = tf.get_variable('b', initializer=tf.zeros(output_dim))
             result = tf.nn.bias_add(result, bias)
-        return result
\ No newline at end of file
+        return result
+
+def sampled_output_loss(
+        name,
+        inputs,
+        labels,
+        vocab_size,
+        num_sampled,
+        loss='sampled',
+        sampler='log_uniform',
+        unigram_file=None):
+    """
+    The training loss of an existing linear(name, input_dim, vocab_size, class_major=True) output layer
+    over num_sampled sampled classes instead of the full softmax. Only the rows of the true and the
+    sampled classes are gathered, so the weight and bias gradients stay sparse.
+    loss: `sampled` for sampled softmax, `nce` for noise-contrastive estimation
+    sampler: `log_uniform` (class ids sorted by decreasing frequency) or `unigram`, from the class counts of
+    unigram_file (one `id,count` line per class, see vocab.write_unigram_file) so they stay out of the graph
+    Must be called in the variable scope that created the layer.
+    """
+    with tf.variable_scope(name, reuse=True):
+        weight = tf.get_variable('W_t')
+        bias = tf.get_variable('b')
+
+    labels = tf.reshape(tf.cast(labels, tf.int64), [-1, 1])
+    if sampler == 'log_uniform':
+        sampled_values = tf.nn.log_uniform_candidate_sampler(
+            labels, 1, num_sampled, unique=True, range_max=vocab_size)
+    elif sampler == 'unigram':
+        sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+            labels, 1, num_sampled, unique=True, range_max=vocab_size, distortion=0.75,
+            vocab_file=unigram_file)
+    else:
+        raise ValueError('Invalid sampler: %s' % sampler)
+
+    # the classes are the rows of the [vocab_size, input_dim] weight
+    if loss == 'sampled':
+        losses = tf.nn.sampled_softmax_loss(
+            weight, bias, labels, inputs, num_sampled, vocab_size, sampled_values=sampled_values)
+    elif loss == 'nce':
+        losses = tf.nn.nce_loss(
+            weight, bias, labels, inputs, num_sampled, vocab_size, sampled_values=sampled_values)
+    else:
+        raise ValueError('Invalid loss: %s' % loss)
+    return tf.reduce_mean(losses)
+
+
+def adaptive_clusters(vocab_size, cutoffs):
+    """The [begin, end) id range of the head and of every tail cluster; ids must be sorted by decreasing frequency"""
+    bounds = [0] + [c for c in cutoffs if 0 < c < vocab_size] + [vocab_size]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def check_adaptive_head(input_dim, min_proj):
+    """Refuse an adaptive head on an input no wider than min_proj: no tail projection would be narrower
+    than the input, so it would cost as much as a dense head and only add the projections"""
+    if int(input_dim) <= min_proj:
+        raise ValueError('softmax_head adaptive needs an input wider than adaptive_min_proj (%d), got %d; '
+                         'use softmax_head dense' % (min_proj, int(input_dim)))
+
+
+def _adaptive_head(name, input_dim, vocab_size, cutoffs, inputs):
+    clusters = adaptive_clusters(vocab_size, cutoffs)
+    # the frequent items plus one entry per tail cluster
+    head_size = clusters[0][1] + len(clusters) - 1
+    return clusters, linear(name + '.Head', input_dim, head_size, inputs)
+
+
+def _adaptive_tail(name, input_dim, cluster, i, div, min_proj, inputs):
+    # the i-th tail cluster works in a projection divided by div ** i, floored at min_proj so a narrow
+    # input does not become a rank-1 bottleneck for most of the vocabulary
+    proj_dim = min(int(input_dim), max(min_proj, int(input_dim) // (div ** i)))
+    output = linear(name + '.Tail%d.Proj' % i, input_dim, proj_dim, inputs, biases=False)
+    return linear(name + '.Tail%d.Output' % i, proj_dim, cluster[1] - cluster[0], output)
+
+
+def adaptive_log_probs(name, input_dim, vocab_size, cutoffs, inputs, div=4, min_proj=32):
+    """
+    The exact normalized log-probabilities [N, vocab_size] of an adaptive softmax head:
+    log p(tail item) = log p(its cluster in the head) + log p(item in the cluster)
+    The saving over a dense head comes from the tail projections, so it shrinks with the input width
+    (none at all when input_dim <= min_proj, see check_adaptive_head); bench_softmax_head.py times it.
+    """
+    clusters, head_logits = _adaptive_head(name, input_dim, vocab_size, cutoffs, inputs)
+    head_log_probs = tf.nn.log_softmax(head_logits)
+    head_end = clusters[0][1]
+    log_probs = [head_log_probs[:, :head_end]]
+    for i, cluster in enumerate(clusters[1:], 1):
+        tail_log_probs = tf.nn.log_softmax(_adaptive_tail(name, input_dim, cluster, i, div, min_proj, inputs))
+        log_probs.append(tail_log_probs + head_log_probs[:, head_end + i - 1:head_end + i])
+    return tf.concat(log_probs, 1)
+
+
+def adaptive_softmax_loss(name, input_dim, vocab_size, cutoffs, inputs, labels, div=4, min_proj=32):
+    """
+    The mean negative log-likelihood of labels under the adaptive softmax head,
+    a tail cluster is only evaluated for the rows whose label falls in it.
+    """
+    clusters, head_logits = _adaptive_head(name, input_dim, vocab_size, cutoffs, inputs)
+    head_end = clusters[0][1]
+    labels = tf.reshape(tf.cast(labels, tf.int32), [-1])
+    num_rows = tf.shape(labels)[0]
+
+    head_labels = labels
+    tail_losses = []
+    for i, cluster in enumerate(clusters[1:], 1):
+        in_cluster = tf.logical_and(labels >= cluster[0], labels < cluster[1])
+        head_labels = tf.where(in_cluster, tf.fill(tf.shape(labels), head_end + i - 1), head_labels)
+        rows = tf.cast(tf.where(in_cluster), tf.int32)
+        tail_logits = _adaptive_tail(name, input_dim, cluster, i, div, min_proj, tf.gather_nd(inputs, rows))
+        tail_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=tf.gather_nd(labels, rows) - cluster[0], logits=tail_logits)
+        tail_losses.append(tf.scatter_nd(rows, tail_loss, [num_rows]))
+
+    loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=head_labels, logits=head_logits)
+    return tf.reduce_mean(tf.add_n([loss] + tail_losses))
+
+
+def loss_weight(name, initial_value):
+    """
+    A non-trainable scalar weight of the loss, with the placeholder and the op that reassign it.
+    A global variable, so the checkpoints save and restore the re-estimated value; restore_checkpoint
+    leaves it at initial_value (the config one) for a checkpoint saved before it was.
+    """
+    with tf.name_scope('LossWeights'):
+        weight = tf.Variable(float(initial_value), trainable=False, name=name)
+        value = tf.placeholder(tf.float32, [], name=name + '_value')
+        assign_op = tf.assign(weight, value)
+    return weight, value, assign_op
+
+
+def estimate_loss_weight(ratios, min_value=1e-3, max_value=1e4):
+    """
+    A loss weight from the ratios of two costs over the validation batches: the mean of their absolute
+    values, clipped to [min_value, max_value] so the weighted term can never change sign.
+    :return: None when no ratio is finite, the weight is then left as it is
+    """
+    ratios = np.abs(np.asarray(ratios, dtype=np.float64))
+    ratios = ratios[np.isfinite(ratios)]
+    if len(ratios) == 0:
+        return None
+    return float(np.clip(ratios.mean(), min_value, max_value))
+
+
+def _class_major_output(name, shape, reader, saved):
+    """A class-major W_t [vocab, dim] (or its optimizer slots) from the [dim, vocab] W of older checkpoints"""
+    match = re.match(r'^(.*/G_E\.Output)/W_t(/.*)?$', name)
+    old_name = match and '%s/W%s' % (match.group(1), match.group(2) or '')
+    if old_name in saved and list(saved[old_name]) == shape[::-1]:
+        return reader.get_tensor(old_name).T
+    return None
+
+
+def gru_block_weights(params):
+    """
+    (W_x, W_h, b) of a GRUBlockCellV2 layer, the form of _stacked_gru_params, from its
+    {'gates/kernel', 'gates/bias', 'candidate/kernel', 'candidate/bias'}
+    """
+    units = params['candidate/bias'].shape[0]
+    input_dim = params['gates/kernel'].shape[0] - units
+    return (np.concatenate([params['gates/kernel'][:input_dim], params['candidate/kernel'][:input_dim]], 1),
+            np.concatenate([params['gates/kernel'][input_dim:], params['candidate/kernel'][input_dim:]], 1),
+            np.concatenate([params['gates/bias'], params['candidate/bias']]))
+
+
+def _stacked_time_generators(name, shape, reader, saved):
+    """
+    A build_stacked_decoder / stacked_linear weight (or its optimizer slots) of the time generators from
+    older checkpoints, with one GRUBlockCellV2 decoder per generator under <scope>0, <scope>1, ...
+    """
+    match = re.match(r'^(.*)/G_T\.RNN/Layer(\d+)/(W_x|W_h|b)(/.*)?$', name)
+    if match:
+        scope, layer, part, slot = match.group(1), int(match.group(2)), match.group(3), match.group(4) or ''
+        stacked = []
+        for g in range(shape[0]):
+            pattern = re.compile(r'^%s%d/G_T\.RNN/.*/cell_%d/[^/]+/(gates|candidate)/(kernel|bias)%s$' % (
+                re.escape(scope), g, layer, re.escape(slot)))
+            params = dict((m.group(1) + '/' + m.group(2), reader.get_tensor(m.group(0)))
+                          for m in (pattern.match(old_name) for old_name in saved) if m)
+            if len(params) != 4:
+                return None
+            stacked.append(gru_block_weights(params)[('W_x', 'W_h', 'b').index(part)])
+    else:
+        match = re.match(r'^(.*)/G_T\.Output/(W|b)(/.*)?$', name)
+        old_names = match and ['%s%d/G_T.Output/%s%s' % (match.group(1), g, match.group(2), match.group(3) or '')
+                               for g in range(shape[0])]
+        if not old_names or any(old_name not in saved for old_name in old_names):
+            return None
+        stacked = [reader.get_tensor(old_name) for old_name in old_names]
+    value = np.stack(stacked)
+    return value if list(value.shape) == shape else None
+
+
+CHECKPOINT_CONVERTERS = [_class_major_output, _stacked_time_generators]
+
+
+def save_checkpoint_meta(checkpoint, meta):
+    """The settings a checkpoint cannot tell by its variables, in <checkpoint>.json next to it"""
+    with open(checkpoint + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def load_checkpoint_meta(checkpoint):
+    """:return: the save_checkpoint_meta settings of a checkpoint, {} for one saved without"""
+    if not os.path.exists(checkpoint + '.json'):
+        return {}
+    with open(checkpoint + '.json', 'r') as f:
+        return json.load(f)
+
+
+def restore_checkpoint(sess, checkpoint, var_list=None, converters=None):
+    """
+    Restore the variables a checkpoint has, in place of Saver.restore, so checkpoints of older layouts load:
+    a variable saved under its own name and shape is restored as is, one saved under an older layout is
+    rebuilt by the first of converters (fn(name, shape, reader, saved shapes) -> value or None) that can,
+    and any other keeps its initial value, e.g. a loss weight keeps its config value.
+    :return: the names of the variables the checkpoint had no value for
+    """
+    reader = tf.train.load_checkpoint(checkpoint)
+    saved = reader.get_variable_to_shape_map()
+    direct, missing = {}, []
+    for variable in var_list if var_list is not None else tf.global_variables():
+        name, shape = variable.op.name, variable.shape.as_list()
+        if name in saved and list(saved[name]) == shape:
+            direct[name] = variable
+            continue
+        for convert in converters if converters is not None else CHECKPOINT_CONVERTERS:
+            value = convert(name, shape, reader, saved)
+            if value is not None:
+                variable.load(value, sess)
+                break
+        else:
+            missing.append(name)
+    if direct:
+        tf.train.Saver(direct).restore(sess, checkpoint)
+    if missing:
+        logging.info('{} has no value for {}, they keep their initial values'.format(checkpoint, missing))
+    return missing
@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+import read_data
+
+'''
+Vocabulary compaction for the event ids.
+Raw item ids are remapped by frequency into the dense range [1, size), the most frequent item first;
+every item under the min count or beyond the top-N cut shares the OOV id 0.
+The mapping is persisted as <prefix>.vocab.npz next to the event file, with the min count and top-N
+it was built with; it is rebuilt when they change.
+'''
+OOV_ID = 0
+
+
+def vocab_file(event_file):
+    return read_data.binary_prefix(event_file) + '.vocab.npz'
+
+
+def count_events(event_file, chunk_tokens=1000000):
+    """Occurrences of every raw event id, indexed by id; reads the memory-mapped copy if there is one."""
+    prefix = read_data.binary_prefix(event_file)
+    if read_data.has_binary(prefix, event_file):
+        events, _, _ = read_data.load_binary(prefix)
+        return np.bincount(events)
+
+    counts = np.zeros(0, dtype=np.int64)
+    pending = []
+
+    def flush(counts):
+        chunk_counts = np.bincount(np.array(pending, dtype=np.int64))
+        if len(chunk_counts) > len(counts):
+            counts = np.concatenate([counts, np.zeros(len(chunk_counts) - len(counts), dtype=np.int64)])
+        counts[:len(chunk_counts)] += chunk_counts
+        del pending[:]
+        return counts
+
+    with open(event_file, 'r') as read_event:
+        for event_trace in read_event:
+            pending.extend(int(event) for event in event_trace.rstrip('\n').split('\t')
+                           if event not in ('', '[EOS]'))
+            if len(pending) >= chunk_tokens:
+                counts = flush(counts)
+    if pending:
+        counts = flush(counts)
+    return counts
+
+
+class Vocabulary(object):
+    def __init__(self, raw_ids, counts, min_count=None, max_size=None):
+        """
+        :param raw_ids: raw id of every dense id, raw_ids[OOV_ID] is -1
+        :param counts: occurrences of every dense id, the OOV id counts all dropped items
+        :param min_count, max_size: the build_vocab parameters, None when unknown
+        """
+        self.min_count = min_count
+        self.max_size = max_size
+        self.raw_ids = np.asarray(raw_ids, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.id_map = np.full(self.raw_ids.max() + 1, OOV_ID, dtype=np.int32)
+        self.id_map[self.raw_ids[1:]] = np.arange(1, len(self.raw_ids), dtype=np.int32)
+
+    @property
+    def size(self):
+        return len(self.raw_ids)
+
+    def encode(self, events):
+        """Raw ids to dense ids; ids never seen when the vocabulary was built are OOV."""
+        events = np.asarray(events)
+        known = (events >= 0) & (events < len(self.id_map))
+        return np.where(known, self.id_map[np.where(known, events, 0)], OOV_ID).astype(events.dtype)
+
+    def decode(self, ids):
+        return self.raw_ids[np.asarray(ids)]
+
+    def save(self, path):
+        params = {}
+        if self.min_count is not None:
+            params = {'min_count': self.min_count, 'max_size': self.max_size}
+        np.savez(path, raw_ids=self.raw_ids, counts=self.counts, **params)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        if 'min_count' in data.files:
+            return cls(data['raw_ids'], data['counts'], int(data['min_count']), int(data['max_size']))
+        return cls(data['raw_ids'], data['counts'])
+
+
+def write_unigram_file(path, counts):
+    """The `id,count` lines read by tf.nn.fixed_unigram_candidate_sampler(vocab_file=...)"""
+    with open(path, 'w') as f:
+        for i, count in enumerate(counts):
+            f.write('%d,%r\n' % (i, float(count)))
+    return path
+
+
+def build_vocab(raw_counts, min_count=1, max_size=0):
+    """
+    :param raw_counts: occurrences indexed by raw id, as returned by count_events
+    :param min_count: items seen fewer times fall into the OOV id
+    :param max_size: keep at most this many items besides OOV, 0 for no limit
+    """
+    raw_counts = np.asarray(raw_counts, dtype=np.int64)
+    kept = np.nonzero(raw_counts >= max(min_count, 1))[0]
+    # most frequent first, ties broken by raw id
+    kept = kept[np.lexsort((kept, -raw_counts[kept]))]
+    if max_size > 0:
+        kept = kept[:max_size]
+    oov_count = raw_counts.sum() - raw_counts[kept].sum()
+    raw_ids = np.concatenate([[-1], kept])
+    counts = np.concatenate([[oov_count], raw_counts[kept]])
+    return Vocabulary(raw_ids, counts, min_count, max_size)
+
+
+def load_or_build_vocab(event_file, min_count=1, max_size=0):
+    """The vocabulary saved next to event_file, rebuilt if it was built with other parameters"""
+    path = vocab_file(event_file)
+    vocab = Vocabulary.load(path) if os.path.exists(path) else None
+    if vocab is None or (vocab.min_count, vocab.max_size) != (min_count, max_size):
+        vocab = build_vocab(count_events(event_file), min_count, max_size)
+        vocab.save(path)
+    print('vocabulary size: ', vocab.size, 'OOV occurrences: ', vocab.counts[OOV_ID])
+    return vocab